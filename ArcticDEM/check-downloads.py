@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# (c) 2020 Andy Aschwanden
+
+"""
+Check the DownloadManager against a local HTTP server.
+
+The server supports range requests, ETags and chunked transfer encoding,
+and injects dropped connections, 503s and corrupt payloads, so resume,
+verification, retries and the bandwidth limit are exercised without
+network access.
+"""
+
+from argparse import ArgumentParser
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing as mp
+import os
+from os.path import exists, join
+import shutil
+import tempfile
+import threading
+import time
+
+from downloads import DownloadError, DownloadManager
+
+# file name: bytes served
+files = {}
+# file name: list of faults of the next GET requests, 'drop', '503', 'corrupt' or 'chunked'
+faults = {}
+# (method, file name, Range header) of all requests
+requests = []
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve files with range requests and injected faults
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_file(body=True)
+
+    def do_HEAD(self):
+        self.send_file(body=False)
+
+    def send_file(self, body=True):
+        name = self.path.rsplit("/", 1)[-1]
+        requests.append((self.command, name, self.headers.get("Range")))
+        if name not in files:
+            self.send_error(404)
+            return
+        data = files[name]
+        fault = faults[name].pop(0) if body and faults.get(name) else None
+        if fault == "503":
+            self.send_error(503)
+            return
+        start = 0
+        byte_range = self.headers.get("Range")
+        if byte_range is not None and self.headers.get("If-Range") in (None, '"v1"'):
+            start = int(byte_range.split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        payload = data[start:]
+        if fault == "corrupt":
+            payload = bytes(len(payload))
+        if fault == "chunked":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            if body:
+                for k in range(0, len(payload), 2 ** 16):
+                    chunk = payload[k : k + 2 ** 16]
+                    self.wfile.write("{:x}\r\n".format(len(chunk)).encode() + chunk + b"\r\n")
+                self.wfile.write(b"0\r\n\r\n")
+            return
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if not body:
+            return
+        if fault == "drop":
+            self.wfile.write(payload[: len(payload) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(payload)
+
+
+def start_server():
+    """
+    Start the server in a thread, return its base URL
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://127.0.0.1:{}/tiles/".format(server.server_port)
+
+
+def init_worker(manager):
+    global download_manager
+    download_manager = manager
+
+
+def download_worker(url):
+    return download_manager.download(url)
+
+
+def check_downloads(url, odir, size=2 ** 21):
+    """
+    Run all checks, return the names of failed checks
+    """
+
+    failed = []
+
+    def check(name, ok):
+        print(("  {:<50s} {}".format(name, "ok" if ok else "FAILED")))
+        if not ok:
+            failed.append(name)
+
+    def is_complete(name):
+        filename = join(odir, name)
+        return exists(filename) and open(filename, "rb").read() == files[name]
+
+    for k in range(8):
+        files["t{}.tar.gz".format(k)] = os.urandom(size + k)
+    manager = DownloadManager(odir, retries=3, backoff=0.01, chunk_size=2 ** 16)
+
+    manager.download(url + "t0.tar.gz")
+    entry = manager.get_entry("t0.tar.gz")
+    check("download", is_complete("t0.tar.gz") and entry["complete"] and entry["size"] == size)
+
+    del requests[:]
+    manager.download(url + "t0.tar.gz")
+    check("verified file is not downloaded again", requests == [])
+
+    faults["t1.tar.gz"] = ["drop", "503"]
+    del requests[:]
+    manager.download(url + "t1.tar.gz")
+    ranges = [r for _, _, r in requests]
+    check("resume after dropped connection and 503", is_complete("t1.tar.gz") and ranges[-1] is not None)
+
+    manager.update_entry("t2.tar.gz", sha256=hashlib.sha256(files["t2.tar.gz"]).hexdigest())
+    faults["t2.tar.gz"] = ["corrupt"]
+    manager.download(url + "t2.tar.gz")
+    check("retry after checksum mismatch", is_complete("t2.tar.gz"))
+
+    with open(join(odir, "t3.tar.gz"), "wb") as f:
+        f.write(files["t3.tar.gz"][:1000])
+    del requests[:]
+    _, received = manager.download(url + "t3.tar.gz")
+    check("resume truncated file without manifest entry", is_complete("t3.tar.gz") and received == size + 3 - 1000)
+
+    faults["t4.tar.gz"] = ["chunked"]
+    manager.download(url + "t4.tar.gz")
+    check("chunked transfer without Content-Length", is_complete("t4.tar.gz") and manager.get_entry("t4.tar.gz")["size"] == size + 4)
+
+    faults["t5.tar.gz"] = ["503"] * 10
+    try:
+        manager.download(url + "t5.tar.gz")
+        check("bounded retries", False)
+    except DownloadError:
+        check("bounded retries", not exists(join(odir, "t5.tar.gz")))
+    faults["t5.tar.gz"] = []
+
+    del requests[:]
+    try:
+        manager.download(url + "missing.tar.gz")
+        check("no retries after 404", False)
+    except DownloadError:
+        check("no retries after 404", len(requests) == 1)
+
+    # two processes share 1 MB/s, downloading 2 x 2 MB takes about 4 s
+    rate = 2 ** 20
+    manager = DownloadManager(join(odir, "limited"), max_rate=rate, max_connections=2, chunk_size=2 ** 16)
+    os.mkdir(manager.out_dir)
+    start = time.time()
+    pool = mp.Pool(2, initializer=init_worker, initargs=(manager,))
+    pool.map(download_worker, [url + "t6.tar.gz", url + "t7.tar.gz"])
+    pool.close()
+    pool.join()
+    elapsed = time.time() - start
+    expected = (2 * size - 2 ** 16) / float(rate)
+    check("bandwidth limit ({:.1f}s, expected {:.1f}s)".format(elapsed, expected), elapsed > 0.9 * expected)
+
+    return failed
+
+
+if __name__ == "__main__":
+
+    __spec__ = None
+
+    parser = ArgumentParser()
+    parser.description = "Check resume, verification, retries and limits of downloads.py against a local HTTP server."
+    parser.add_argument("--keep", dest="keep", action="store_true", help="Keep the downloaded files", default=False)
+    options = parser.parse_args()
+
+    odir = tempfile.mkdtemp(prefix="check-downloads-")
+    url = start_server()
+    print(("Downloading from {} to {}".format(url, odir)))
+    try:
+        failed = check_downloads(url, odir)
+    finally:
+        if not options.keep:
+            shutil.rmtree(odir)
+    if failed:
+        print(("ERROR: {} checks failed ... ending ...".format(len(failed))))
+        import sys
+
+        sys.exit(1)
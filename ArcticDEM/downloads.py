@@ -0,0 +1,401 @@
+# (c) 2020 Andy Aschwanden
+
+"""
+Resumable and verified downloads of tile archives.
+
+Files are downloaded to {name}.part and resumed with HTTP range requests.
+They are renamed when complete, after their size (and SHA-256 checksum if
+known) is verified. A JSON manifest records size, checksum and validators
+of every tile. Expected values can be added to the manifest beforehand.
+A file that is not verified is never treated as done, even if it exists.
+Retries back off exponentially. The number of connections and the
+bandwidth are limited across all processes that share a DownloadManager.
+"""
+
+import hashlib
+import json
+import multiprocessing as mp
+import os
+from os.path import basename, exists, getsize, join
+import socket
+import time
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse, unquote
+from urllib.request import Request, urlopen
+
+# HTTP status codes worth retrying
+RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+
+
+class DownloadError(Exception):
+    """
+    A download failed or could not be verified
+    """
+
+    pass
+
+
+def filename_from_url(url):
+    """
+    Return the file name of a URL
+    """
+
+    return basename(unquote(urlparse(url).path))
+
+
+def get_sha256(filename, block_size=2 ** 22):
+    """
+    Return the SHA-256 checksum of a file as hex string
+    """
+
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def parse_content_range(value):
+    """
+    Return start and total size of a "bytes start-end/total" header
+
+    The total size is None if it is unknown ("*").
+    """
+
+    unit, _, spec = value.strip().partition(" ")
+    byte_range, _, total = spec.partition("/")
+    if unit != "bytes" or byte_range == "*":
+        raise DownloadError("unexpected Content-Range {}".format(value))
+    start = int(byte_range.split("-")[0])
+    return start, (None if total == "*" else int(total))
+
+
+class BandwidthLimiter(object):
+    """
+    Limit the rate of bytes read by all processes sharing the limiter
+
+    A token bucket with a burst of burst bytes, implemented as a shared
+    theoretical arrival time, so it can be passed to worker processes.
+
+    Parameters
+    ----------
+    rate: float, bytes per second
+    burst: int, bytes
+    """
+
+    def __init__(self, rate, burst=2 ** 20, *args, **kwargs):
+        super(BandwidthLimiter, self).__init__(*args, **kwargs)
+        self.rate = float(rate)
+        self.burst = burst
+        self._tat = mp.Value("d", 0.0)
+
+    def __repr__(self):
+        return "BandwidthLimiter"
+
+    def consume(self, nbytes):
+        """
+        Wait until nbytes may be read
+        """
+
+        with self._tat.get_lock():
+            now = time.time()
+            tat = max(self._tat.value, now) + nbytes / self.rate
+            self._tat.value = tat
+        delay = tat - now - self.burst / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DownloadManager(object):
+    """
+    Download files with resume, verification and retries
+
+    The manager uses multiprocessing locks. It is shared between processes
+    by inheritance, e.g. as initargs of a multiprocessing.Pool.
+
+    Parameters
+    ----------
+    out_dir: string, directory of the downloaded files
+    manifest_file: string, JSON manifest. Default is {out_dir}/manifest.json
+    retries: int, number of retries after a failed attempt
+    backoff: float, seconds to wait before the first retry, doubled for each retry
+    max_backoff: float, maximum seconds to wait between attempts
+    timeout: float, socket timeout in seconds
+    max_rate: float, total bandwidth in bytes per second. Default is None (no limit)
+    max_connections: int, number of simultaneous connections. Default is None (no limit)
+    verify_checksums: bool, check the SHA-256 checksum of existing files, not only their size
+    chunk_size: int, bytes read at a time
+    """
+
+    def __init__(
+        self,
+        out_dir=".",
+        manifest_file=None,
+        retries=5,
+        backoff=2.0,
+        max_backoff=300.0,
+        timeout=60.0,
+        max_rate=None,
+        max_connections=None,
+        verify_checksums=False,
+        chunk_size=2 ** 20,
+        *args,
+        **kwargs
+    ):
+        super(DownloadManager, self).__init__(*args, **kwargs)
+        self.out_dir = out_dir
+        self.manifest_file = manifest_file if manifest_file is not None else join(out_dir, "manifest.json")
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.verify_checksums = verify_checksums
+        self.chunk_size = chunk_size
+        self.limiter = BandwidthLimiter(max_rate, burst=chunk_size) if max_rate else None
+        self.connections = mp.BoundedSemaphore(max_connections) if max_connections else None
+        self._manifest_lock = mp.Lock()
+
+    def __repr__(self):
+        return "DownloadManager"
+
+    def read_manifest(self):
+        """
+        Return the manifest as dict of file name: entry
+        """
+
+        if not exists(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def get_entry(self, name):
+        """
+        Return the manifest entry of a file, an empty dict if there is none
+        """
+
+        with self._manifest_lock:
+            return self.read_manifest().get(name, {})
+
+    def update_entry(self, name, **kwargs):
+        """
+        Update the manifest entry of a file
+
+        The manifest is written to a temporary file and renamed, so it is
+        never left half written.
+        """
+
+        with self._manifest_lock:
+            manifest = self.read_manifest()
+            manifest.setdefault(name, {}).update(kwargs)
+            tmp_file = "{}.{}.tmp".format(self.manifest_file, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.manifest_file)
+
+    def get_remote_size(self, url):
+        """
+        Return the Content-Length of url from a HEAD request, None if unknown
+        """
+
+        response = self._open(Request(url, method="HEAD"))
+        with response:
+            length = response.headers.get("Content-Length")
+        return int(length) if length is not None else None
+
+    def verify(self, filename, entry, check_sha256=True):
+        """
+        Check size and SHA-256 checksum of a file against a manifest entry
+
+        Returns
+        -------
+        ok: bool
+        """
+
+        if entry.get("size") is None or getsize(filename) != entry["size"]:
+            return False
+        if check_sha256 and entry.get("sha256") is not None:
+            return get_sha256(filename) == entry["sha256"].lower()
+        return True
+
+    def download(self, url, overwrite=False):
+        """
+        Download url to out_dir unless a verified copy exists
+
+        Parameters
+        ----------
+        url: string
+        overwrite: bool, download again even if the file is verified
+
+        Returns
+        -------
+        out_file : string
+        received : int, number of bytes downloaded
+        """
+
+        name = filename_from_url(url)
+        out_file = join(self.out_dir, name)
+        part_file = out_file + ".part"
+        if overwrite:
+            for filename in (out_file, part_file):
+                if exists(filename):
+                    os.remove(filename)
+            entry = {}
+        else:
+            entry = self.get_entry(name)
+
+        if exists(out_file):
+            if entry.get("complete") and self.verify(out_file, entry, self.verify_checksums):
+                return out_file, 0
+            if entry.get("size") is None:
+                entry["size"] = self._retry(self.get_remote_size, url)
+            if self.verify(out_file, entry):
+                self._finish(name, out_file, entry)
+                return out_file, 0
+            # e.g. a truncated download of an earlier version of this script
+            print("{} is incomplete or corrupt, downloading again".format(out_file))
+            if entry.get("size") is not None and getsize(out_file) < entry["size"] and not exists(part_file):
+                os.replace(out_file, part_file)
+            else:
+                os.remove(out_file)
+
+        offset = getsize(part_file) if exists(part_file) else 0
+        if offset > 0:
+            print("Resuming {} at byte {}".format(url, offset))
+        else:
+            print("Downloading {}".format(url))
+        entry = self._retry(self._fetch_verified, url, part_file, entry)
+        os.replace(part_file, out_file)
+        self._finish(name, out_file, entry)
+        return out_file, max(getsize(out_file) - offset, 0)
+
+    def _finish(self, name, out_file, entry):
+        """
+        Record a verified file in the manifest
+        """
+
+        sha256 = entry.get("sha256")
+        if sha256 is None:
+            sha256 = get_sha256(out_file)
+        self.update_entry(
+            name,
+            size=getsize(out_file),
+            sha256=sha256,
+            etag=entry.get("etag"),
+            last_modified=entry.get("last_modified"),
+            complete=True,
+        )
+
+    def _retry(self, func, *args):
+        """
+        Call func, retrying with exponential backoff after transient errors
+        """
+
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except HTTPError as e:
+                if e.code not in RETRY_STATUS or attempt == self.retries:
+                    raise DownloadError("{} failed: HTTP {}".format(args[0], e.code))
+                error = e
+            except (URLError, HTTPException, socket.timeout, ConnectionError, DownloadError) as e:
+                if attempt == self.retries:
+                    raise DownloadError("{} failed after {} attempts: {}".format(args[0], attempt + 1, e))
+                error = e
+            wait = min(self.backoff * 2 ** attempt, self.max_backoff)
+            print("{} failed ({}), retrying in {:.0f}s".format(args[0], error, wait))
+            time.sleep(wait)
+
+    def _fetch_verified(self, url, part_file, entry):
+        """
+        Download url to part_file and verify it, remove it if it is corrupt
+        """
+
+        entry = self._fetch(url, part_file, entry)
+        if not self.verify(part_file, entry):
+            os.remove(part_file)
+            raise DownloadError("size or checksum of {} does not match the manifest".format(part_file))
+        return entry
+
+    def _open(self, request):
+        return urlopen(request, timeout=self.timeout)
+
+    def _fetch(self, url, part_file, entry):
+        """
+        Download url to part_file, resuming a partial file with a range request
+
+        Returns
+        -------
+        entry : dict with size and validators of the remote file
+        """
+
+        entry = dict(entry)
+        offset = getsize(part_file) if exists(part_file) else 0
+        size = entry.get("size")
+        if size is not None and offset > size:
+            os.remove(part_file)
+            offset = 0
+        if size is not None and offset == size:
+            return entry
+
+        request = Request(url)
+        if offset > 0:
+            request.add_header("Range", "bytes={}-".format(offset))
+            # the server sends the whole file if it changed since the partial download
+            validator = entry.get("etag") or entry.get("last_modified")
+            if validator:
+                request.add_header("If-Range", validator)
+
+        if self.connections is not None:
+            self.connections.acquire()
+        try:
+            try:
+                response = self._open(request)
+            except HTTPError as e:
+                if e.code != 416:
+                    raise
+                # range not satisfiable, the partial file is complete or wrong
+                if size is not None and offset == size:
+                    return entry
+                os.remove(part_file)
+                raise DownloadError("range {}- not satisfiable".format(offset))
+            with response:
+                if response.status == 206:
+                    start, total = parse_content_range(response.headers["Content-Range"])
+                    if start != offset:
+                        raise DownloadError("server resumed at byte {} instead of {}".format(start, offset))
+                    mode = "ab"
+                else:
+                    offset = 0
+                    length = response.headers.get("Content-Length")
+                    total = int(length) if length is not None else None
+                    mode = "wb"
+                if total is not None:
+                    if size is not None and total != size:
+                        raise DownloadError("remote size {} differs from manifest size {}".format(total, size))
+                    entry["size"] = total
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+                if (etag, last_modified) != (entry.get("etag"), entry.get("last_modified")):
+                    entry.update(etag=etag, last_modified=last_modified)
+                    self.update_entry(
+                        filename_from_url(url), size=entry.get("size"), etag=etag, last_modified=last_modified, complete=False
+                    )
+                with open(part_file, mode) as f:
+                    while True:
+                        chunk = response.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        if self.limiter is not None:
+                            self.limiter.consume(len(chunk))
+                        f.write(chunk)
+        finally:
+            if self.connections is not None:
+                self.connections.release()
+
+        received = getsize(part_file)
+        if entry.get("size") is not None and received != entry["size"]:
+            raise DownloadError("received {} of {} bytes".format(received, entry["size"]))
+        if entry.get("size") is None:
+            entry["size"] = received
+        return entry
@@ -4,17 +4,24 @@
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import csv
+from functools import partial
 import gdal
 from glob import glob
 import multiprocessing as mp
 import numpy as np
-from os.path import basename, join, realpath, dirname, exists, split, splitext, isfile
+from os.path import basename, join, realpath, dirname, exists, split, splitext, isfile, getsize
 from os import mkdir
+import queue
 import re
 import tarfile
-import wget
+import time
 script_path = dirname(realpath(__file__))
 
+from downloads import DownloadManager, filename_from_url
+
+# DownloadManager of a worker process, see init_worker
+download_manager = None
+
 
 def dem_files(members):
     for tarinfo in members:
@@ -31,121 +38,266 @@ def extract_tar(file, dem_dir=None):
         tar.extractall(path=dem_dir, members=dem_files(tar))
 
 
-def process_file(tasks, dem_files, dem_hs_files, process_name, options_dict, zf, multiDirectional, tile_pyramid_levels, tar_dir, dem_dir):
+# Stages of a tile: name (as in options_dict), worker pool, and the stages it depends on
+STAGES = [
+    ('download', 'io', []),
+    ('extract', 'cpu', ['download']),
+    ('build_tile_overviews', 'cpu', ['extract']),
+    ('build_tile_hillshade', 'cpu', ['extract']),
+    ('build_tile_hillshade_overviews', 'cpu', ['build_tile_hillshade']),
+]
+
+
+def get_tile_files(url, tar_dir='.', dem_dir='.'):
     '''
-    Download file using wget, extract dem from tar archive, and calculate stats
+    Return the names of the archive, DEM and hillshade files of a tile
     '''
-    while True:
-        url = tasks.get()
-        if not isinstance(url, str):
-            print('[%s] evaluation routine quits' % process_name)
-            # Indicate finished
-            dem_files.put(0)
-            dem_hs_files.put(0)
-            break
-        else:
-            out_file = join(tar_dir, wget.filename_from_url(url))
-            m_file = basename(out_file)
-            root, ext = splitext(m_file)
-            if ext == '.gz':
-                root, ext = splitext(root)
-            m_file = join(dem_dir, root + '_reg_dem.tif')
-            m_ovr_file = join(m_file, ".ovr")
-            m_hs_file = join(dem_dir, root + '_reg_dem_hs.tif')
-            m_hs_ovr_file = join(m_hs_file, ".ovr")
-            if options_dict['download']:
-                if not exists(out_file) or overwrite:
-                    print('Processing file {}'.format(url))
-                    out_file = wget.download(url, out=tar_dir)
-            if options_dict['extract']:
-                # Only extract if DEM file does not exists
-                # FIXME this extracts all files??
-                extract_tar(out_file, dem_dir=dem_dir)
-            if options_dict['build_tile_overviews']:
-                if not exists(m_ovr_file) or overwrite:
-                    calc_stats_and_overviews(m_file, tile_pyramid_levels)
-            if options_dict['build_tile_hillshade']:
-                if not exists(m_hs_file) or overwrite:
-                    create_hillshade(m_file, m_hs_file, zf, multiDirectional)
-            if options_dict['build_tile_hillshade_overviews']:
-                if not exists(m_hs_ovr_file) or overwrite:
-                    calc_stats_and_overviews(m_hs_file, tile_pyramid_levels)
-            dem_files.put(m_file)
-            dem_hs_files.put(m_hs_file)
-    return
-    
-
-def get_fileurls(file):
+    out_file = join(tar_dir, filename_from_url(url))
+    root, ext = splitext(basename(out_file))
+    if ext == '.gz':
+        root, ext = splitext(root)
+    m_file = join(dem_dir, root + '_reg_dem.tif')
+    m_hs_file = join(dem_dir, root + '_reg_dem_hs.tif')
+    return {'url': url,
+            'out_file': out_file,
+            'm_file': m_file,
+            'm_ovr_file': m_file + '.ovr',
+            'm_hs_file': m_hs_file,
+            'm_hs_ovr_file': m_hs_file + '.ovr'}
+
+
+def init_worker(manager):
     '''
-    Get URLs of files
+    Set the DownloadManager shared by all worker processes
     '''
-    with open(file) as f:
-        reader = csv.DictReader(f)
-        fileurls = [row["fileurl"] for row in reader]
-    return fileurls
+    global download_manager
+    download_manager = manager
 
 
-def collect_files_mp(fileurls, num_processes, zf, multiDirectional, tile_pyramid_levels, options_dict, tar_dir='.', dem_dir='.'):
-    '''
-    Collect and process requested files
+def process_stage(stage, files, settings):
     '''
+    Run one stage of a tile in a worker process
 
-    manager = mp.Manager()
+    Returns the elapsed time and the number of bytes downloaded or the
+    size of the file written (0 if the stage was skipped because the file
+    exists)
+    '''
+    start = time.time()
+    overwrite = settings['overwrite']
+    out_file = None
+    if stage == 'download':
+        # verified downloads are skipped by the download manager
+        _, received = download_manager.download(files['url'], overwrite)
+        return time.time() - start, received
+    elif stage == 'extract':
+        # Only extract if DEM file does not exists
+        if not exists(files['m_file']) or overwrite:
+            extract_tar(files['out_file'], dem_dir=settings['dem_dir'])
+            out_file = files['m_file']
+    elif stage == 'build_tile_overviews':
+        if not exists(files['m_ovr_file']) or overwrite:
+            calc_stats_and_overviews(files['m_file'], settings['tile_pyramid_levels'])
+            out_file = files['m_ovr_file']
+    elif stage == 'build_tile_hillshade':
+        if not exists(files['m_hs_file']) or overwrite:
+            create_hillshade(files['m_file'], files['m_hs_file'], settings['zf'], settings['multiDirectional'])
+            out_file = files['m_hs_file']
+    elif stage == 'build_tile_hillshade_overviews':
+        if not exists(files['m_hs_ovr_file']) or overwrite:
+            calc_stats_and_overviews(files['m_hs_file'], settings['tile_pyramid_levels'])
+            out_file = files['m_hs_ovr_file']
+    size = getsize(out_file) if out_file is not None and isfile(out_file) else 0
+    return time.time() - start, size
+
+
+class StageCounter(object):
+    '''
+    Progress and throughput of a stage
+    '''
 
-    # Define a list (queue) for tasks and computation results
-    tasks = manager.Queue()
-    dem_files = mp.Queue()
-    dem_hs_files = mp.Queue()
+    def __init__(self, name, total, *args, **kwargs):
+        super(StageCounter, self).__init__(*args, **kwargs)
+        self.name = name
+        self.total = total
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.nbytes = 0
+        self.start = None
+
+    def __repr__(self):
+        return "StageCounter"
+
+    def submitted(self):
+        if self.start is None:
+            self.start = time.time()
+        self.running += 1
+
+    def finished(self, elapsed=0.0, nbytes=0, failed=False):
+        self.running -= 1
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+            self.busy += elapsed
+            self.nbytes += nbytes
 
-    pool = mp.Pool(processes=num_processes)
-    processes = []
+    def get_rate(self):
+        '''
+        Return finished tiles per minute and MB per second since the first submission
+        '''
+        wall = max(time.time() - self.start, 1e-6) if self.start is not None else 1e-6
+        return 60.0 * self.done / wall, self.nbytes / 1e6 / wall
 
-    for i in range(num_processes):
+    def __str__(self):
+        tiles_per_min, mb_per_s = self.get_rate()
+        return '[{}] {}/{} done, {} failed, {} running, {:.1f} tiles/min, {:.1f} MB/s, {:.0f}s busy'.format(
+            self.name, self.done, self.total, self.failed, self.running, tiles_per_min, mb_per_s, self.busy)
 
-        # Set process name
-        process_name = 'P%i' % i
 
-        # Create the process, and connect it to the worker function
-        new_process = mp.Process(target=process_file, args=(tasks, dem_files, dem_hs_files,
-                                                            process_name, options_dict, zf, multiDirectional, tile_pyramid_levels, tar_dir, dem_dir))
+class TileScheduler(object):
+    '''
+    Run the stages of all tiles as a DAG on an I/O and a CPU process pool
+
+    A stage of a tile is submitted as soon as the stages it depends on are
+    finished, so tiles stream from downloading to GDAL processing while
+    other tiles are still downloading. Stages that are not enabled in
+    options_dict are skipped. If a stage fails, the dependent stages of
+    that tile are not run.
+
+    Parameters
+    ----------
+    fileurls: list of URLs of tile archives
+    options_dict: dict of enabled stages
+    settings: dict with tar_dir, dem_dir, overwrite, zf, multiDirectional and tile_pyramid_levels
+    io_processes: int, number of processes for downloads
+    cpu_processes: int, number of processes for extracting and GDAL processing
+    download_manager: DownloadManager shared by the worker processes
+    '''
 
-        # Add new process to the list of processes
-        processes.append(new_process)
+    def __init__(self, fileurls, options_dict, settings, io_processes=4, cpu_processes=1, download_manager=None, *args, **kwargs):
+        super(TileScheduler, self).__init__(*args, **kwargs)
+        self.settings = settings
+        if download_manager is None:
+            download_manager = DownloadManager(settings['tar_dir'])
+        self.download_manager = download_manager
+        self.tiles = [get_tile_files(url, settings['tar_dir'], settings['dem_dir']) for url in fileurls]
+        self.stages = [(name, pool, [d for d in deps if options_dict[d]])
+                       for name, pool, deps in STAGES if options_dict[name]]
+        self.n_processes = {'io': io_processes, 'cpu': cpu_processes}
+        self.counters = dict((name, StageCounter(name, len(self.tiles))) for name, _, _ in self.stages)
+        self.events = queue.Queue()
+
+    def __repr__(self):
+        return "TileScheduler"
+
+    def _submit(self, pools, k, stage, pool):
+        self.counters[stage].submitted()
+        pools[pool].apply_async(process_stage, (stage, self.tiles[k], self.settings),
+                                callback=partial(self._finished, k, stage),
+                                error_callback=partial(self._failed, k, stage))
+
+    def _finished(self, k, stage, result):
+        self.events.put((k, stage, result, None))
+
+    def _failed(self, k, stage, error):
+        self.events.put((k, stage, None, error))
+
+    def run(self):
+        '''
+        Process all tiles
+
+        Returns
+        -------
+        all_dem_files, all_dem_hs_files: lists of files of tiles without failed stages
+        '''
+        n_tiles = len(self.tiles)
+        done = [set() for k in range(n_tiles)]
+        failed = set()
+        pending = n_tiles * len(self.stages)
+        pools = dict((name, mp.Pool(processes=n, initializer=init_worker, initargs=(self.download_manager,)))
+                     for name, n in list(self.n_processes.items())
+                     if any(pool == name for _, pool, _ in self.stages))
+        start = time.time()
+        try:
+            for k in range(n_tiles):
+                for stage, pool, deps in self.stages:
+                    if not deps:
+                        self._submit(pools, k, stage, pool)
+            while pending > 0:
+                k, stage, result, error = self.events.get()
+                if error is not None:
+                    self.counters[stage].finished(failed=True)
+                    print('[{}] {} failed: {}'.format(stage, self.tiles[k]['url'], error))
+                    failed.add(k)
+                    # this stage and everything downstream of it will not run
+                    pending -= 1 + self._count_dependent(stage)
+                else:
+                    elapsed, nbytes = result
+                    self.counters[stage].finished(elapsed, nbytes)
+                    done[k].add(stage)
+                    pending -= 1
+                    for next_stage, pool, deps in self.stages:
+                        if stage in deps and all(d in done[k] for d in deps):
+                            self._submit(pools, k, next_stage, pool)
+                print(self.counters[stage])
+        finally:
+            for pool in list(pools.values()):
+                if pending > 0:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+
+        print('Processed {} tiles in {:.0f}s'.format(n_tiles, time.time() - start))
+        for stage, _, _ in self.stages:
+            print('  {}'.format(self.counters[stage]))
+        if failed:
+            print('Tiles with failed stages are not used:')
+            for k in sorted(failed):
+                print('  {}'.format(self.tiles[k]['url']))
+        tiles = [tile for k, tile in enumerate(self.tiles) if k not in failed]
+        return [tile['m_file'] for tile in tiles], [tile['m_hs_file'] for tile in tiles]
+
+    def _count_dependent(self, stage):
+        '''
+        Return the number of enabled stages that depend on stage, directly or not
+        '''
+        dependent = set([stage])
+        for name, _, deps in self.stages:
+            if any(d in dependent for d in deps):
+                dependent.add(name)
+        return len(dependent) - 1
 
-        # Start the process
-        new_process.start()
 
-    # Fill task queue
-    task_list = fileurls
-    for single_task in task_list:
-        tasks.put(single_task)
+def get_fileurls(file):
+    '''
+    Get URLs of files
+    '''
+    with open(file) as f:
+        reader = csv.DictReader(f)
+        fileurls = [row["fileurl"] for row in reader]
+    return fileurls
 
-    for i in range(num_processes):
-        tasks.put(0)
 
-    # Read calculation results
-    num_finished_processes = 0
-    all_dem_files = []
-    all_dem_hs_files = []
-    k = 0
-    while True:
-         # Read result
-        dem_result = dem_files.get()
-        hs_result = dem_hs_files.get()
-        # Have a look at the results
-        if dem_result == 0:
-            # Process has finished
-            num_finished_processes += 1
+def collect_files_mp(fileurls, num_processes, zf, multiDirectional, tile_pyramid_levels, options_dict, tar_dir='.', dem_dir='.', num_cpu_processes=1, overwrite=False, download_manager=None):
+    '''
+    Collect and process requested files
 
-            if num_finished_processes == num_processes:
-                break
-        else:
-            # Output result
-            all_dem_files.append(dem_result)
-            all_dem_hs_files.append(hs_result)
-            k += 1
+    Downloads run on num_processes processes, extracting and GDAL
+    processing on num_cpu_processes processes (see TileScheduler)
+    '''
 
-    return all_dem_files, all_dem_hs_files
+    settings = {'tar_dir': tar_dir,
+                'dem_dir': dem_dir,
+                'overwrite': overwrite,
+                'zf': zf,
+                'multiDirectional': multiDirectional,
+                'tile_pyramid_levels': tile_pyramid_levels}
+    scheduler = TileScheduler(fileurls, options_dict, settings, io_processes=num_processes,
+                              cpu_processes=num_cpu_processes, download_manager=download_manager)
+    return scheduler.run()
 
 
 def calc_stats_and_overviews(destName, pyramid_levels):
@@ -167,8 +319,8 @@ def create_hillshade(srcDS, destName, zf, multiDirectional):
     '''
 
     print('Creating hillshade for {}'.format(destName))
-    gdal.DEMProcessingOptions(zFactor=zf, multiDirectional=multiDirectional)
-    gdal.DEMProcessing(destName, srcDS, 'hillshade')
+    options = gdal.DEMProcessingOptions(zFactor=zf, multiDirectional=multiDirectional)
+    gdal.DEMProcessing(destName, srcDS, 'hillshade', options=options)
 
 
 if __name__ == "__main__":
@@ -183,6 +335,9 @@ if __name__ == "__main__":
     parser.add_argument("--num_procs", dest="num_processes",
                         help="Number of simultaneous downloads. Default=4", type=int,
                         default=4)
+    parser.add_argument("--num_cpu_procs", dest="num_cpu_processes",
+                        help="Number of processes for extracting and processing tiles. Default=number of CPUs", type=int,
+                        default=mp.cpu_count())
     parser.add_argument("--zf", dest="zf",
                         help="Number of simultaneous downloads. Default=1",
                         default=1.0)
@@ -203,6 +358,21 @@ if __name__ == "__main__":
                                  'build_vrt_hillshade',
                                  'build_vrt_hillshade_overviews',
                                  'none'])
+    parser.add_argument("--manifest", dest="manifest_file",
+                        help="JSON manifest with sizes and SHA-256 checksums of the tar files. Default='{tar_dir}/manifest.json'",
+                        default=None)
+    parser.add_argument("--retries", dest="retries",
+                        help="Number of retries of a failed download. Default=5", type=int,
+                        default=5)
+    parser.add_argument("--max_rate", dest="max_rate",
+                        help="Total download bandwidth in MB/s. Default=None (no limit)", type=float,
+                        default=None)
+    parser.add_argument("--max_connections", dest="max_connections",
+                        help="Number of simultaneous connections. Default=None (no limit besides --num_procs)", type=int,
+                        default=None)
+    parser.add_argument("--verify_checksums", dest="verify_checksums", action="store_true",
+                        help="Verify checksums of downloaded tar files, not only their size. Default=False",
+                        default=False)
     parser.add_argument("--overwrite", action="store_true",
                         help="Overwrite existing files",
                         default=False)
@@ -234,6 +404,7 @@ if __name__ == "__main__":
     vrt_pyramid_levels = [int(x) for x in options.vrt_levels.split(',')]
     tile_pyramid_levels = [int(x) for x in options.tile_levels.split(',')]
     num_processes = options.num_processes
+    num_cpu_processes = options.num_cpu_processes
     outname_prefix = options.outname_prefix
     tar_dir = options.tar_dir
     dem_dir = options.dem_dir
@@ -241,6 +412,11 @@ if __name__ == "__main__":
     multiDirectional = options.multiDirectional
     process_options = options.process_options
     overwrite = options.overwrite
+    manifest_file = options.manifest_file
+    retries = options.retries
+    max_rate = options.max_rate
+    max_connections = options.max_connections
+    verify_checksums = options.verify_checksums
 
     if process_options == 'all':
         for k in options_dict:
@@ -271,11 +447,16 @@ if __name__ == "__main__":
     if not exists(dem_dir):
         mkdir(dem_dir)
 
+    download_manager = DownloadManager(tar_dir, manifest_file=manifest_file, retries=retries,
+                                       max_rate=max_rate * 1e6 if max_rate else None,
+                                       max_connections=max_connections, verify_checksums=verify_checksums)
+
     # Extract URLs from a CSV file generated from the SHP Tiles File
     fileurls = get_fileurls(csv_file)
     # Collect and process all DEM files using multiprocessing
     all_dem_files, all_dem_hs_files = collect_files_mp(
-        fileurls, num_processes, zf, multiDirectional, tile_pyramid_levels, options_dict, tar_dir=tar_dir, dem_dir=dem_dir)
+        fileurls, num_processes, zf, multiDirectional, tile_pyramid_levels, options_dict, tar_dir=tar_dir, dem_dir=dem_dir,
+        num_cpu_processes=num_cpu_processes, overwrite=overwrite, download_manager=download_manager)
 
     destName = '{prefix}.vrt'.format(prefix=outname_prefix)
     if options_dict['build_vrt_raster']:
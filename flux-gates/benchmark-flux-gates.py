@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# Copyright (C) 2020 Andy Aschwanden
+
+import os
+import sys
+import time
+import resource
+import shutil
+import tempfile
+import itertools
+import tracemalloc
+import numpy as np
+from argparse import ArgumentParser
+from netCDF4 import Dataset as NC
+
+import fluxgates as fg
+
+# Values of parameters in pism_config of synthetic experiments, one for
+# every key of fg.PARAMS_DICT so any --label_params of flux-gate-analysis.py works
+SYNTHETIC_PARAMS = {
+    "dem": ["GIMP", "PRODEM"],
+    "bed": ["BM2", "BM3"],
+    "surface.pdd.factor_ice": [8.0, 12.0, 16.0],
+    "surface.pdd.factor_snow": [2.0, 3.0, 4.0],
+    "basal_resistance.pseudo_plastic.q": [0.25, 0.5, 0.75],
+    "basal_yield_stress.mohr_coulomb.till_effective_fraction_overburden": [0.01, 0.02, 0.04],
+    "stress_balance.sia.enhancement_factor": [1.0, 1.25, 1.5, 2.0],
+    "stress_balance.ssa.enhancement_factor": [0.5, 1.0],
+    "stress_balance.ssa.Glen_exponent": [3.0, 3.25],
+    "stress_balance.sia.Glen_exponent": [3.0],
+    "grid_dx_meters": [600.0, 900.0, 1200.0],
+    "flow_law.gpbld.water_frac_observed_limit": [0.01, 0.02],
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.phi_min": [5.0, 10.0, 15.0],
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.phi_max": [40.0, 45.0],
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.topg_min": [-700.0, -500.0],
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.topg_max": [500.0, 1000.0],
+}
+
+
+def write_profile_file(filename, n_gates, n_points, seed, observations=False, varname="velsurf_mag"):
+    """
+    Write a synthetic profile file.
+
+    The file has the layout of files made by extract_profiles.py:
+    profiles of variable length padded with missing values, profile
+    metadata, and pism_config and run_stats attributes for experiments
+    or an error variable for observations.
+
+    Parameters
+    ----------
+    filename: string
+    n_gates: int, number of profiles
+    n_points: int, maximum number of points per profile
+    seed: int, seed of the random number generator
+    observations: bool, write an observation file
+    varname: string, variable name
+    """
+
+    # Profile geometry is the same in all files
+    geometry = np.random.default_rng(0)
+    lengths = geometry.integers(n_points // 2, n_points + 1, n_gates)
+    mask = np.arange(n_points)[np.newaxis, :] >= lengths[:, np.newaxis]
+    shape = 100.0 + 500.0 * np.sin(np.linspace(0, np.pi, n_points))[np.newaxis, :]
+    shape = shape * geometry.uniform(0.5, 2.0, n_gates)[:, np.newaxis]
+
+    rng = np.random.default_rng(seed)
+    nc = NC(filename, "w")
+    nc.createDimension("profile", n_gates)
+    nc.createDimension("nc", n_points)
+    var = nc.createVariable("profile_name", str, ("profile",))
+    for k in range(n_gates):
+        var[k] = "Gate {}".format(k)
+    var = nc.createVariable("profile_axis", "f8", ("profile", "nc"), fill_value=-2e9)
+    var.units = "m"
+    var.long_name = "distance along profile"
+    var[:] = np.ma.masked_array(np.tile(np.arange(n_points) * 250.0, (n_gates, 1)), mask=mask)
+    nc.createVariable("profile_id", "i4", ("profile",))[:] = np.arange(n_gates)
+    nc.createVariable("clon", "f8", ("profile",))[:] = geometry.uniform(-60, -20, n_gates)
+    nc.createVariable("clat", "f8", ("profile",))[:] = geometry.uniform(60, 80, n_gates)
+    nc.createVariable("flightline", "i4", ("profile",))[:] = geometry.integers(0, 3, n_gates)
+    nc.createVariable("glaciertype", "i4", ("profile",))[:] = geometry.integers(0, 4, n_gates)
+    nc.createVariable("flowtype", "i4", ("profile",))[:] = geometry.integers(0, 3, n_gates)
+    var = nc.createVariable(varname, "f4", ("profile", "nc"), fill_value=-2e9)
+    var.units = "m yr-1"
+    values = shape * rng.uniform(0.7, 1.3) + rng.normal(0, 30, (n_gates, n_points))
+    var[:] = np.ma.masked_array(values, mask=mask)
+    if observations:
+        var = nc.createVariable("_".join([varname, "error"]), "f4", ("profile", "nc"), fill_value=-2e9)
+        var.units = "m yr-1"
+        var[:] = np.ma.masked_array(np.abs(rng.normal(10, 3, (n_gates, n_points))), mask=mask)
+    else:
+        var = nc.createVariable("pism_config", "b")
+        for key in sorted(fg.PARAMS_DICT):
+            var.setncattr(key, rng.choice(SYNTHETIC_PARAMS[key]))
+        var = nc.createVariable("run_stats", "b")
+        var.setncattr("wall_clock_hours", float(seed))
+    nc.close()
+
+
+def make_synthetic_ensemble(odir, n_gates, n_experiments, n_points=200, varname="velsurf_mag"):
+    """
+    Write an observation file and an ensemble of experiment files.
+
+    Returns
+    -------
+    obs_file: string
+    exp_files: list of strings
+    """
+
+    if not os.path.isdir(odir):
+        os.makedirs(odir)
+    obs_file = os.path.join(odir, "observations.nc")
+    write_profile_file(obs_file, n_gates, n_points, seed=12345, observations=True, varname=varname)
+    exp_files = []
+    for k in range(n_experiments):
+        exp_file = os.path.join(odir, "experiment_{:04d}.nc".format(k))
+        write_profile_file(exp_file, n_gates, n_points, seed=k, varname=varname)
+        exp_files.append(exp_file)
+    return obs_file, exp_files
+
+
+def get_max_rss():
+    """
+    Return the maximum resident set size in bytes of this process and its
+    terminated child processes, e.g. workers of reduce_experiments
+    """
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+
+class StageTimer(object):
+
+    """
+    Measure wall clock time and memory of benchmark stages.
+
+    The peak of the traced Python heap (tracemalloc) is measured per stage
+    and in this process only. The maximum RSS includes worker processes
+    but is a high-water mark since the start of the process.
+
+    Use as context manager, e.g. "with timer('stats'):".
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(StageTimer, self).__init__(*args, **kwargs)
+        self.stages = []
+        self.stage = None
+        self.t0 = None
+
+    def __repr__(self):
+        return "StageTimer"
+
+    def __call__(self, stage):
+        self.stage = stage
+        return self
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.t0
+        current, peak = tracemalloc.get_traced_memory()
+        self.stages.append((self.stage, elapsed, peak, get_max_rss()))
+        return False
+
+
+def run_benchmark(obs_file, exp_files, odir, varname="velsurf_mag", n_procs=1):
+    """
+    Run the stages of a flux gate analysis on the given files.
+
+    With n_procs > 1, experiments are read and their fluxes and
+    statistics calculated in worker processes, which is timed as stage
+    "reduce"; the fluxes and stats stages then only finish the results.
+
+    Returns
+    -------
+    stages: list of (stage, time in s, peak traced Python heap in bytes, max RSS in bytes)
+    """
+
+    analysis_config = fg.AnalysisConfig(varname)
+    timer = StageTimer()
+    tracemalloc.start()
+    try:
+        with timer("ingestion"):
+            nc = NC(exp_files[0], "r")
+            flux_gates, layout = fg.read_flux_gates(nc, analysis_config=analysis_config)
+            nc.close()
+            obs = fg.ObservationsDataset(obs_file, varname, layout=layout)
+            for gate in flux_gates:
+                gate.add_observations(obs)
+            if n_procs == 1:
+                for id, exp_file in enumerate(exp_files):
+                    experiment = fg.ExperimentDataset(id, exp_file, varname, layout=layout)
+                    for gate in flux_gates:
+                        gate.add_experiment(experiment)
+        if n_procs > 1:
+            with timer("reduce"):
+                obs_vals = fg.get_observed_values(obs.values.data).reshape(layout.axis.data.shape)
+                obs_error = obs.error.data.reshape(layout.axis.data.shape)
+                results = fg.reduce_experiments(
+                    exp_files, flux_gates, layout, varname, obs_vals=obs_vals, obs_error=obs_error, n_procs=n_procs
+                )
+                for result in results:
+                    for m, gate in enumerate(flux_gates):
+                        gate.add_experiment_result(result, m)
+                for gate in flux_gates:
+                    gate.finalize_results()
+        with timer("fluxes"):
+            fg.calculate_batch_fluxes(flux_gates)
+        with timer("stats"):
+            fg.calculate_batch_stats(flux_gates)
+        with timer("ranking"):
+            table = fg.get_ensemble_table(flux_gates)
+            for by in (None, "flow_type", "glacier_type"):
+                fg.rank_experiments(table, by=by)
+        with timer("output"):
+            fg.write_results_file(os.path.join(odir, "flux_gate_results.nc"), flux_gates)
+            fg.export_ranking_csv(os.path.join(odir, "ranking.csv"), table)
+    finally:
+        tracemalloc.stop()
+    return timer.stages
+
+
+if __name__ == "__main__":
+
+    __spec__ = None
+
+    parser = ArgumentParser()
+    parser.description = "Benchmark the fluxgates package on synthetic profile ensembles."
+    parser.add_argument(
+        "--n_gates", dest="n_gates", help="""comma-separated list of numbers of gates. Default=30,170""", default="30,170"
+    )
+    parser.add_argument(
+        "--n_experiments",
+        dest="n_experiments",
+        help="""comma-separated list of numbers of experiments. Default=10,100""",
+        default="10,100",
+    )
+    parser.add_argument(
+        "--n_points", dest="n_points", type=int, help="""Maximum number of points per profile. Default=200""", default=200
+    )
+    parser.add_argument(
+        "--n_procs", dest="n_procs", type=int, help="""Number of processes to read experiments. Default=1""", default=1
+    )
+    parser.add_argument(
+        "--work_dir", dest="work_dir", help="""Directory for synthetic files. Default is a temporary directory""", default=None
+    )
+    parser.add_argument(
+        "--keep_files", dest="keep_files", action="store_true", help="Keep synthetic files", default=False
+    )
+
+    options = parser.parse_args()
+    n_gates_list = [int(x) for x in options.n_gates.split(",")]
+    n_experiments_list = [int(x) for x in options.n_experiments.split(",")]
+    n_points = options.n_points
+    n_procs = options.n_procs
+    work_dir = options.work_dir
+    keep_files = options.keep_files
+    varname = "velsurf_mag"
+
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="flux-gates-benchmark-")
+
+    report = []
+    for n_gates, n_experiments in itertools.product(n_gates_list, n_experiments_list):
+        odir = os.path.join(work_dir, "g{}_e{}".format(n_gates, n_experiments))
+        print(("Generating {} gates x {} experiments in {}".format(n_gates, n_experiments, odir)))
+        obs_file, exp_files = make_synthetic_ensemble(odir, n_gates, n_experiments, n_points, varname=varname)
+        stages = run_benchmark(obs_file, exp_files, odir, varname=varname, n_procs=n_procs)
+        for stage, elapsed, peak, max_rss in stages:
+            report.append((n_gates, n_experiments, stage, elapsed, peak, max_rss))
+        if not keep_files:
+            shutil.rmtree(odir)
+
+    if not keep_files and options.work_dir is None:
+        shutil.rmtree(work_dir)
+
+    print("")
+    print(
+        "{:>6} {:>6} {:<10} {:>10} {:>26} {:>14}".format(
+            "gates", "exps", "stage", "time (s)", "traced Python heap (MB)", "max RSS (MB)"
+        )
+    )
+    for n_gates, n_experiments, stage, elapsed, peak, max_rss in report:
+        print(
+            "{:>6} {:>6} {:<10} {:>10.3f} {:>26.1f} {:>14.1f}".format(
+                n_gates, n_experiments, stage, elapsed, peak / 2.0 ** 20, max_rss / 2.0 ** 20
+            )
+        )
+    print("")
+    print("traced Python heap: peak per stage, allocations of this process only (tracemalloc)")
+    print("max RSS: high-water mark of this process and finished worker processes since the start")
+    if n_procs > 1:
+        print("reduce: experiments are read and their fluxes and stats calculated in {} worker processes".format(n_procs))
@@ -5,8 +5,8 @@ import ogr
 import osr
 import os
 from unidecode import unidecode
-import itertools
 import codecs
+import multiprocessing as mp
 import operator
 import numpy as np
 import pylab as plt
@@ -14,12 +14,12 @@ import matplotlib as mpl
 from colorsys import rgb_to_hls, hls_to_rgb
 import matplotlib.cm as cmx
 import matplotlib.colors as mplcolors
+from matplotlib.backends.backend_pdf import PdfPages
 from argparse import ArgumentParser
 import pandas as pa
 from palettable import colorbrewer
 import statsmodels.api as sm
 from netCDF4 import Dataset as NC
-import re
 
 try:
     import pypismtools.pypismtools as ppt
@@ -28,6 +28,40 @@ except:
 
 import cf_units
 
+from fluxgates import (
+    AnalysisConfig,
+    ExperimentDataset,
+    ExperimentIndex,
+    GaussianProcessEmulator,
+    ObservationSampler,
+    ObservationsDataset,
+    PolynomialEmulator,
+    ResultCache,
+    calculate_batch_envelopes,
+    calculate_batch_fluxes,
+    calculate_batch_observed_fluxes,
+    calculate_batch_stats,
+    calculate_observed_flux_intervals,
+    export_pareto_csv,
+    export_ranking_csv,
+    get_emulator_outputs,
+    get_ensemble_table,
+    get_file_hash,
+    get_observed_values,
+    get_parameter_matrix,
+    get_ranking_robustness,
+    has_time_series,
+    propose_experiments,
+    rank_experiments,
+    read_flux_gates,
+    read_results_file,
+    read_results_metadata,
+    reduce_experiments,
+    select_gates,
+    write_results_file,
+    write_timeseries_file,
+)
+
 
 def reverse_enumerate(iterable):
     """
@@ -37,729 +71,6 @@ def reverse_enumerate(iterable):
     return zip(reversed(range(len(iterable))), reversed(iterable))
 
 
-def get_rmsd(a, b, w=None):
-    """
-    Returns the (weighted) root mean square differences between a and b.
-
-    Parameters
-    ----------
-    a, b : array_like
-    w : weights
-
-    Returns
-    -------
-    rmsd : scalar
-    """
-
-    if w is None:
-        w = np.ones_like(a)
-    # If observations or errors have missing values, don't count them
-    c = (a.ravel() - b.ravel()) / w.ravel()
-    if isinstance(c, np.ma.MaskedArray):
-        # count all non-masked elements
-        N = c.count()
-        # reduce to non-masked elements
-        return np.sqrt(np.linalg.norm(np.ma.compressed(c), 2) ** 2.0 / N), N
-    else:
-        N = c.shape[0]
-        return np.sqrt(np.linalg.norm(c, 2) ** 2.0 / N), N
-
-
-class FluxGate(object):
-
-    """
-    A class for FluxGates.
-
-    Parameters
-    ----------
-    pos_id: int, pos of gate in array
-    gate_name: string, name of flux gate
-    gate_id: int, gate identification
-    profile_axis: 1-d array, profile axis values
-    profile_axis_units: string, udunits unit of axis
-    profile_axis_name: string, descriptive name of axis
-
-    """
-
-    def __init__(
-        self,
-        pos_id,
-        gate_name,
-        gate_id,
-        profile_axis,
-        profile_axis_units,
-        profile_axis_name,
-        clon,
-        clat,
-        flightline,
-        glaciertype,
-        flowtype,
-        *args,
-        **kwargs
-    ):
-        super(FluxGate, self).__init__(*args, **kwargs)
-        self.pos_id = pos_id
-        self.gate_name = gate_name
-        self.gate_id = gate_id
-        self.profile_axis = profile_axis
-        self.profile_axis_units = profile_axis_units
-        self.profile_axis_name = profile_axis_name
-        self.clon = clon
-        self.clat = clat
-        self.flightline = flightline
-        self.glaciertype = glaciertype
-        self.flowtype = flowtype
-        self.best_rmsd_exp_id = None
-        self.best_rmsd = None
-        self.best_corr_exp_id = None
-        self.best_corr = None
-        self.corr = None
-        self.corr_units = None
-        self.experiments = []
-        self.exp_counter = 0
-        self.has_observations = None
-        self.has_fluxes = None
-        self.has_stats = None
-        self.linear_trend = None
-        self.linear_bias = None
-        self.linear_r2 = None
-        self.linear_p = None
-        self.N_corr = None
-        self.N_rmsd = None
-        self.observed_flux = None
-        self.observed_flux_units = None
-        self.observed_flux_error = None
-        self.observed_mean = None
-        self.observed_mean_units = None
-        self.p_ols = None
-        self.r2 = None
-        self.r2_units = None
-        self.rmsd = None
-        self.rmsd_units = None
-        self.S = None
-        self.S_units = None
-        self.sigma_obs = None
-        self.sigma_obs_N = None
-        self.sigma_obs_units = None
-        self.varname = None
-        self.varname_units = None
-
-    def __repr__(self):
-        return "FluxGate"
-
-    def add_experiment(self, data):
-        """
-        Add an experiment to FluxGate
-
-        """
-
-        print(("      adding experiment to flux gate {0}".format(self.gate_name)))
-        pos_id = self.pos_id
-        fg_exp = FluxGateExperiment(data, pos_id)
-        self.experiments.append(fg_exp)
-        if self.varname is None:
-            self.varname = data.varname
-        if self.varname_units is None:
-            self.varname_units = data.varname_units
-        self.exp_counter += 1
-
-    def add_observations(self, data):
-        """
-        Add observations to FluxGate
-
-        """
-
-        print(("      adding observations to flux gate {0}".format(self.gate_name)))
-        pos_id = self.pos_id
-        fg_obs = FluxGateObservations(data, pos_id)
-        self.observations = fg_obs
-        if self.has_observations is not None:
-            print(("Flux gate {0} already has observations, overriding".format(self.gate_name.encode("utf-8"))))
-        self.has_observations = True
-
-    def calculate_fluxes(self):
-        """
-        Calculate fluxes
-
-        """
-
-        if self.has_observations:
-            self._calculate_observed_flux()
-        self._calculate_experiment_fluxes()
-        self.has_fluxes = True
-
-    def calculate_stats(self):
-        """
-        Calculate statistics
-        """
-
-        if not self.has_fluxes:
-            self.calculate_fluxes()
-        corr = {}
-        N_corr = {}
-        N_rmsd = {}
-        p_ols = {}
-        r2 = {}
-        rmsd = {}
-        S = {}
-        for exp in self.experiments:
-            id = exp.id
-            x = np.squeeze(self.profile_axis)
-            obs_vals = np.squeeze(self.observations.values)
-            sigma_obs = self.sigma_obs
-            # mask values where obs is zero
-            obs_vals = np.ma.masked_where(obs_vals == 0, obs_vals)
-            if isinstance(obs_vals, np.ma.MaskedArray):
-                obs_vals = obs_vals.filled(0)
-            exp_vals = np.squeeze(self.experiments[id].values)
-            # Calculate root mean square difference (RMSD), convert units
-            my_rmsd, my_N_rmsd = get_rmsd(exp_vals, obs_vals)
-            i_units = self.varname_units
-            o_units = v_o_units
-            i_units_cf = cf_units.Unit(i_units)
-            o_units_cf = cf_units.Unit(o_units)
-            rmsd[id] = i_units_cf.convert(my_rmsd, o_units_cf)
-            N_rmsd[id] = my_N_rmsd
-            obsS = pa.Series(data=obs_vals, index=x)
-            expS = pa.Series(data=exp_vals, index=x)
-            p_ols[id] = sm.OLS(expS, sm.add_constant(obsS), missing="drop").fit()
-            r2[id] = p_ols[id].rsquared
-            corr[id] = obsS.corr(expS)
-        best_rmsd_exp_id = sorted(p_ols, key=lambda x: rmsd[x], reverse=False)[0]
-        best_corr_exp_id = sorted(p_ols, key=lambda x: corr[x], reverse=True)[0]
-        self.p_ols = p_ols
-        self.best_rmsd_exp_id = best_rmsd_exp_id
-        self.best_rmsd = rmsd[best_rmsd_exp_id]
-        self.best_corr_exp_id = best_corr_exp_id
-        self.best_corr = corr[best_corr_exp_id]
-        self.rmsd = rmsd
-        self.rmsd_units = v_o_units
-        self.N_rmsd = N_rmsd
-        self.S = S
-        self.S_units = "1"
-        self.r2 = r2
-        self.r2_units = "1"
-        self.corr = corr
-        self.corr_units = "1"
-        self.has_stats = True
-        self.observed_mean = np.mean(self.observations.values)
-        self.observed_mean_units = self.varname_units
-
-    def _calculate_observed_flux(self):
-        """
-        Calculate observed flux
-
-        Calculate observed flux using trapezoidal rule. If observations have
-        asscociated errors, the error in observed flux is calculated as well.
-        """
-
-        x = self.profile_axis
-        y = self.observations.values
-        x_units = self.profile_axis_units
-        y_units = self.varname_units
-        int_val = self._line_integral(y, x)
-        # Here we need to directly access udunits2 since we want to
-        # multiply units
-        if vol_to_mass:
-            i_units_cf = cf_units.Unit(x_units) * cf_units.Unit(y_units) * cf_units.Unit(ice_density_units)
-        else:
-            i_units_cf = cf_units.Unit(x_units) * cf_units.Unit(y_units)
-        o_units_cf = cf_units.Unit(v_flux_o_units)
-        o_units_str = v_flux_o_units_str
-        o_val = i_units_cf.convert(int_val, o_units_cf)
-        observed_flux = o_val
-        observed_flux_units = o_units_str
-        if self.observations.has_error:
-            y = self.observations.error
-            int_val = self._line_integral(y, x)
-            i_error = int_val
-            o_error = i_units_cf.convert(i_error, o_units_cf)
-            error_norm, N = get_rmsd(y, np.zeros_like(y, dtype="float32"))
-            self.sigma_obs = error_norm
-            self.sigma_obs_N = N
-            self.sigma_obs_units = self.varname_units
-            self.observed_flux_error = o_error
-
-        self.observed_flux = observed_flux
-        self.observed_flux_units = observed_flux_units
-
-    def _calculate_experiment_fluxes(self):
-        """
-        Calculate experiment fluxes
-
-        Calculated experiment fluxes using trapeziodal rule.
-
-        """
-
-        experiment_fluxes = {}
-        experiment_fluxes_units = {}
-        for exp in self.experiments:
-            id = exp.id
-            x = self.profile_axis
-            y = exp.values
-            x_units = self.profile_axis_units
-            y_units = self.varname_units
-            int_val = self._line_integral(y, x)
-            # Here we need to directly access udunits2 since we want to
-            # multiply units
-            if vol_to_mass:
-                i_units = cf_units.Unit(x_units) * cf_units.Unit(y_units) * cf_units.Unit(ice_density_units)
-            else:
-                i_units = cf_units.Unit(x_units) * cf_units.Unit(y_units)
-            o_units = cf_units.Unit(v_flux_o_units)
-            o_units_str = v_flux_o_units_str
-            o_val = i_units.convert(int_val, o_units)
-            experiment_fluxes[id] = o_val
-            experiment_fluxes_units[id] = o_units_str
-            config = exp.config
-            my_exp_str = ", ".join(
-                [
-                    "=".join([params_dict[key]["abbr"], params_dict[key]["format"].format(config.get(key))])
-                    for key in label_params
-                ]
-            )
-        self.experiment_fluxes = experiment_fluxes
-        self.experiment_fluxes_units = experiment_fluxes_units
-
-    def length(self):
-        """
-        Return length of the profile, rounded to the nearest meter.
-        """
-
-        return np.around(self.profile_axis.max())
-
-    def return_gate_flux_str(self, islast):
-        """
-        Returns a LaTeX-table compatible string
-        """
-
-        if not self.has_stats:
-            self.calculate_stats()
-        gate_name = self.gate_name
-        p_ols = self.p_ols
-        observed_flux = self.observed_flux
-        observed_flux_units = self.observed_flux_units
-        experiment_fluxes = self.experiment_fluxes
-        experiment_fluxes_units = self.experiment_fluxes_units
-        observed_flux_error = self.observed_flux_error
-        if observed_flux_error:
-            obs_str = "$\pm$".join(["{:2.1f}".format(observed_flux), "{:2.1f}".format(observed_flux_error)])
-        else:
-            obs_str = "{:2.1f}".format(observed_flux)
-        exp_str = " & ".join(
-            [
-                "".join(["{:2.1f}".format(experiment_fluxes[key]), "({:1.2f})".format(p_ols[key].rsquared)])
-                for key in experiment_fluxes
-            ]
-        )
-        if islast:
-            gate_str = " & ".join([gate_name, obs_str, "", exp_str])
-        else:
-            gate_str = " & ".join([gate_name, obs_str, "", " ".join([exp_str, r" \\"])])
-        return gate_str
-
-    def return_gate_flux_str_short(self):
-        """
-        Returns a LaTeX-table compatible string
-        """
-
-        if not self.has_stats:
-            self.calculate_stats()
-        gate_name = self.gate_name
-        p_ols = self.p_ols
-        observed_flux = self.observed_flux
-        observed_flux_units = self.observed_flux_units
-        experiment_fluxes = self.experiment_fluxes
-        experiment_fluxes_units = self.experiment_fluxes_units
-        observed_flux_error = self.observed_flux_error
-        if observed_flux_error:
-            obs_str = "$\pm$".join(["{:2.1f}".format(observed_flux), "{:2.1f}".format(observed_flux_error)])
-        else:
-            obs_str = "{:2.1f}".format(observed_flux)
-        gate_str = " & ".join([gate_name, obs_str])
-        return gate_str
-
-    def _line_integral(self, y, x):
-        """
-        Return line integral using the composite trapezoidal rule
-
-        Parameters
-        ----------
-        y: 1-d array_like
-           Input array to integrate
-        x: 1-d array_like
-           Spacing between elements
-
-        Returns
-        -------
-        trapz : float
-                Definite integral as approximated by trapezoidal rule.
-        """
-
-        # Due to the variable length of profiles, we have masked arrays, with
-        # masked values at the profile end. We can assume zero error here,
-        # since it's not used for the computation
-
-        if isinstance(y, np.ma.MaskedArray):
-            y = y.filled(0)
-
-        return float(np.squeeze(np.trapz(y, x)))
-
-    def make_line_plot(self, **kwargs):
-        """
-        Make a plot.
-
-        Make a line plot along a flux gate.
-        """
-
-        gate_name = self.gate_name
-        experiments = self.experiments
-        profile_axis = self.profile_axis
-        profile_axis_name = self.profile_axis_name
-        profile_axis_units = self.profile_axis_units
-        i_units_cf = cf_units.Unit(profile_axis_units)
-        o_units_cf = cf_units.Unit(profile_axis_out_units)
-        profile_axis_out = i_units_cf.convert(profile_axis, o_units_cf)
-        varname = self.varname
-        v_units = self.varname_units
-        has_observations = self.has_observations
-        if not self.has_fluxes:
-            self.calculate_fluxes()
-        if has_observations:
-            self.calculate_stats()
-
-        labels = []
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        if has_observations:
-            obs = self.observations
-            if legend == "long":
-                if obs.has_error:
-                    label = "obs: {:6.1f}$\pm${:4.1f}".format(self.observed_flux, self.observed_flux_error)
-                else:
-                    label = "obs: {:6.1f}".format(self.observed_flux)
-            elif legend in ("short", "regress", "exp"):
-                label = "observed"
-            elif legend in ("attr"):
-                label = "AERODEM"
-            else:
-                if obs.has_error:
-                    label = "{:6.1f}$\pm${:4.1f}".format(self.observed_flux, self.observed_flux_error)
-                else:
-                    label = "{:6.1f}".format(self.observed_flux)
-            has_error = obs.has_error
-            i_vals = obs.values
-            i_units_cf = cf_units.Unit(v_units)
-            o_units_cf = cf_units.Unit(v_o_units)
-            obs_o_vals = i_units_cf.convert(i_vals, o_units_cf)
-            obs_max = np.max(obs_o_vals)
-            if has_error:
-                i_vals = obs.error
-                obs_error_o_vals = i_units_cf.convert(i_vals, o_units_cf)
-                ax.fill_between(
-                    profile_axis_out, obs_o_vals - obs_error_o_vals, obs_o_vals + obs_error_o_vals, color="0.85"
-                )
-
-            if simple_plot:
-                ax.plot(profile_axis_out, obs_o_vals, "-", color="0.35", label=label)
-            else:
-                ax.plot(profile_axis_out, obs_o_vals, "-", color="0.5")
-                ax.plot(
-                    profile_axis_out,
-                    obs_o_vals,
-                    dash_style,
-                    color=obscolor,
-                    markeredgewidth=markeredgewidth,
-                    markeredgecolor=markeredgecolor,
-                    label=label,
-                )
-
-        ne = len(experiments)
-        lines_d = []
-        lines_c = []
-        # We need to carefully reverse list and properly order
-        # handles and labels to have first experiment plotted on top
-        for k, exp in enumerate(reversed(experiments)):
-            i_vals = exp.values
-            i_units_cf = cf_units.Unit(v_units)
-            o_units_cf = cf_units.Unit(v_o_units)
-            exp_o_vals = i_units_cf.convert(i_vals, o_units_cf)
-            if normalize:
-                exp_max = np.max(exp_o_vals)
-                exp_o_vals *= obs_max / exp_max
-            if "label_param_list" in list(kwargs.keys()):
-                params = kwargs["label_param_list"]
-                config = exp.config
-                id = exp.id
-                exp_str = ", ".join(
-                    [
-                        "=".join([params_dict[key]["abbr"], params_dict[key]["format"].format(config.get(key))])
-                        for key in params
-                    ]
-                )
-                if has_observations:
-                    if legend == "long":
-                        label = ", ".join(
-                            [
-                                ": ".join([exp_str, "{:6.1f}".format(self.experiment_fluxes[id])]),
-                                "=".join(["r", "{:1.2f}".format(self.corr[id])]),
-                            ]
-                        )
-                        # label = ', '.join(['{:6.1f}'.format(self.experiment_fluxes[id]), '='.join(['r', '{:1.2f}'.format(self.corr[id])])])
-                    elif legend == "attr":
-                        [key for key in params]
-                    elif legend == "exp":
-                        # # Use this 
-                        # exp_str = ", ".join(
-                        #     [
-                        #         "=".join(
-                        #             [
-                        #                 params_dict[key]["abbr"],
-                        #                 params_dict[key]["format"].format(config.get(key) * ice_density),
-                        #             ]
-                        #         )
-                        #         for key in params
-                        #     ]
-                        # )
-                        exp_str = ", ".join(
-                            [
-                                "=".join(
-                                    [params_dict[key]["abbr"], params_dict[key]["format"].format(config.get(key))]
-                                )
-                                for key in params
-                            ]
-                        )
-                        label = exp_str
-                    else:
-                        label = "r={:1.2f}".format(self.corr[id])
-                    if legend == "regress":
-                        label = "{:4.0f}m, r={:1.2f}".format(config["grid_dx_meters"], self.corr[id])
-                    elif legend == "short":
-                        label = "r={:1.2f}".format(self.corr[id])
-                    else:
-                        pass
-                else:
-                    label = config.get("dem")
-                    # label = ", ".join([": ".join([exp_str, "{:6.1f}".format(self.experiment_fluxes[id])])])
-                labels.append(label)
-
-            my_color = my_colors[k]
-            my_color_light = my_colors_light[k]
-            if simple_plot:
-                line_c, = ax.plot(profile_axis_out, exp_o_vals, color=my_color, label=label)
-                line_d, = ax.plot(profile_axis_out, exp_o_vals, color=my_color)
-            else:
-                line_c, = ax.plot(profile_axis_out, exp_o_vals, "-", color=my_color, alpha=0.5)
-                line_d, = ax.plot(
-                    profile_axis_out,
-                    exp_o_vals,
-                    dash_style,
-                    color=my_color,
-                    markeredgewidth=markeredgewidth,
-                    markeredgecolor=markeredgecolor,
-                    label=label,
-                )
-            labels.append(label)
-            lines_d.append(line_d)
-            lines_c.append(line_c)
-
-        # ax.text(0.05, 0.85, 'r={:1.2f}'.format(self.corr[id]), transform=ax.transAxes)
-        ax.set_xlim(0, np.max(profile_axis_out))
-        xlabel = "{0} ({1})".format(profile_axis_name, profile_axis_out_units)
-        ax.set_xlabel(xlabel)
-        if varname in list(var_name_dict.keys()):
-            v_name = var_name_dict[varname]
-        else:
-            v_name = varname
-        ylabel = "{0} ({1})".format(v_name, v_o_units_str)
-        ax.set_ylabel(ylabel)
-        ax.set_ylim(bottom=y_lim_min, top=y_lim_max)
-        handles, labels = ax.get_legend_handles_labels()
-        ordered_handles = handles[:0:-1]
-        ordered_labels = labels[:0:-1]
-        ordered_handles.insert(0, handles[0])
-        ordered_labels.insert(0, labels[0])
-        if legend != "none":
-            if (legend == "short") or (legend == "regress") or (legend == "attr"):
-                lg = ax.legend(
-                    ordered_handles,
-                    ordered_labels,
-                    loc="upper right",
-                    shadow=True,
-                    numpoints=numpoints,
-                    bbox_to_anchor=(0, 0, 1, 1),
-                    bbox_transform=plt.gcf().transFigure,
-                )
-            else:
-                lg = ax.legend(
-                    ordered_handles,
-                    ordered_labels,
-                    loc="upper right",
-                    title="{} ({})".format(flux_type, self.experiment_fluxes_units[0]),
-                    shadow=True,
-                    numpoints=numpoints,
-                    bbox_to_anchor=(0, 0, 1, 1),
-                    bbox_transform=plt.gcf().transFigure,
-                )
-            fr = lg.get_frame()
-            fr.set_lw(legend_frame_width)
-        # Replot observations
-        if has_observations:
-            if simple_plot:
-                ax.plot(profile_axis_out, obs_o_vals, "-", color="0.35")
-            else:
-                ax.plot(profile_axis_out, obs_o_vals, "-", color="0.5")
-                ax.plot(profile_axis_out, obs_o_vals, dash_style, color=obscolor, markeredgewidth=markeredgewidth, markeredgecolor=markeredgecolor,
-)
-        if plot_title:
-            plt.title(gate_name, loc="left")
-
-        if normalize:
-            gate_name = "_".join([unidecode(gate.gate_name), varname, "normalized", "profile"])
-        else:
-            gate_name = "_".join([unidecode(gate.gate_name), varname, "profile"])
-        outname = ".".join([gate_name, "pdf"]).replace(" ", "_")
-        print(("Saving {0}".format(outname)))
-        fig.tight_layout()
-        fig.savefig(outname)
-        plt.close(fig)
-
-
-class FluxGateExperiment(object):
-    def __init__(self, data, pos_id, *args, **kwargs):
-        super(FluxGateExperiment, self).__init__(*args, **kwargs)
-        self.values = data.values[pos_id, Ellipsis]
-        self.config = data.config
-        self.id = data.id
-
-    def __repr__(self):
-        return "FluxGateExperiment"
-
-
-class FluxGateObservations(object):
-    def __init__(self, data, pos_id, *args, **kwargs):
-        super(FluxGateObservations, self).__init__(*args, **kwargs)
-        self.has_error = None
-        self.values = data.values[pos_id, Ellipsis]
-        if data.has_error:
-            self.error = data.error[pos_id, Ellipsis]
-            self.has_error = True
-
-    def __repr__(self):
-        return "FluxGateObservations"
-
-
-class Dataset(object):
-
-    """
-    A base class for Experiments or Observations.
-
-    Constructor opens netCDF file, attaches pointer to nc instance.
-
-    """
-
-    def __init__(self, filename, varname, *args, **kwargs):
-        super(Dataset, self).__init__(*args, **kwargs)
-        print(("  opening NetCDF file %s ..." % filename))
-        try:
-            nc = NC(filename, "r")
-        except:
-            print(("ERROR:  file '%s' not found or not NetCDF format ... ending ..." % filename))
-            import sys
-
-            sys.exit(1)
-
-        for name in nc.variables:
-            v = nc.variables[name]
-            if getattr(v, "standard_name", "") == varname:
-                print(("variabe {0} found by its standard_name {1}".format(name, varname)))
-                varname = name
-
-        self.values = nc.variables[varname][:]
-        self.varname_units = nc.variables[varname].units
-        self.varname = varname
-        self.nc = nc
-
-    def __repr__(self):
-        return "Dataset"
-
-    def __del__(self):
-        # Close open file
-        self.nc.close()
-
-
-class ExperimentDataset(Dataset):
-
-    """
-    A derived class for experiments
-
-    A derived class for handling PISM experiments.
-
-    Experiments are identified by id. Config and run_stats
-    attributes are attached to object as config dictionary.
-
-    """
-
-    def __init__(self, id, *args, **kwargs):
-        super(ExperimentDataset, self).__init__(*args, **kwargs)
-
-        print("Experiment {}".format(id))
-        self.id = id
-        self.config = dict()
-        for v in ["pism_config", "run_stats"]:
-            if v in self.nc.variables:
-                ncv = self.nc.variables[v]
-                for attr in ncv.ncattrs():
-                    self.config[attr] = getattr(ncv, attr)
-            else:
-                print("Variable {} not found".format(v))
-                
-    def __repr__(self):
-        return "ExperimentDataset"
-
-
-class ObservationsDataset(Dataset):
-
-    """
-    A derived class for observations.
-
-    A derived class for handling observations.
-
-    """
-
-    def __init__(self, *args, **kwargs):
-        super(ObservationsDataset, self).__init__(*args, **kwargs)
-        self.has_error = None
-        try:
-            self.clon = self.nc.variables["clon"][:]
-        except:
-            self.clon = None
-        try:
-            self.clat = self.nc.variables["clat"][:]
-        except:
-            self.clat = None
-        try:
-            self.flightline = self.nc.variables["flightline"][:]
-        except:
-            self.flightline = None
-        try:
-            self.glaciertype = self.nc.variables["glaciertype"][:]
-        except:
-            self.glaciertype = None
-        try:
-            self.flowtype = self.nc.variables["flowtype"][:]
-        except:
-            self.flowtype = None
-        varname = self.varname
-        error_varname = "_".join([varname, "error"])
-        if error_varname in list(self.nc.variables.keys()):
-            self.error = self.nc.variables[error_varname][:]
-            self.has_error = True
-
-    def __repr__(self):
-        return "ObservationsDataset"
-
-
 def export_latex_table_flux(filename, flux_gates, params):
     """
     Create a latex table with fluxes through gates.
@@ -783,8 +94,7 @@ def export_latex_table_flux(filename, flux_gates, params):
     f.write(" &  ({}) &  ({}) \\\ \n".format(v_flux_o_units_str_tex, profile_axis_out_units))
     f.write("\midrule \n")
     # We need to calculate fluxes first
-    for gate in flux_gates:
-        gate.calculate_fluxes()
+    calculate_batch_fluxes(flux_gates)
     cum_flux = 0
     cum_flux_error = 0
     cum_length = 0
@@ -919,7 +229,7 @@ def export_latex_table_corr(filename, gate):
     f.close()
 
 
-def export_gate_table_rmsd(filename, exp):
+def export_gate_table_rmsd(filename, exp, gates=None):
     """
     Creates a latex table of flux gates sorted by rmsd.
 
@@ -927,14 +237,20 @@ def export_gate_table_rmsd(filename, exp):
     ----------
     filename: string
     exp: FluxGateExperiment
+    gates: list of FluxGates, default is all flux gates
 
     """
 
+    if gates is None:
+        gates = flux_gates
+
     means = {}
     rmsds = {}
     rmsds_rels = {}
-    for gate in flux_gates:
+    gates_by_id = {}
+    for gate in gates:
         id = gate.pos_id
+        gates_by_id[id] = gate
         # Get uncertainty and convert units
         i_units_cf = cf_units.Unit(gate.observed_mean_units)
         o_units_cf = cf_units.Unit(v_o_units)
@@ -959,7 +275,7 @@ def export_gate_table_rmsd(filename, exp):
     f.write("\midrule \n")
 
     for k in rmsds_rels_sorted:
-        gate = flux_gates[k]
+        gate = gates_by_id[k]
         line_str = " & ".join(
             [
                 unidecode(gate.gate_name),
@@ -1017,73 +333,352 @@ def write_experiment_table(outname):
     f.close()
 
 
-def make_correlation_figure(filename, exp):
+def render_line_plot(data):
+    """
+    Render and save a line plot along a flux gate.
+
+    Parameters
+    ----------
+    data: dict as returned by FluxGate.get_line_plot_data. Experiments
+          are in plotting order, i.e. reversed.
+    """
+
+    profile_axis_out = data["profile_axis_out"]
+    obs_o_vals = data["obs_values"]
+    obs_error_o_vals = data["obs_error"]
+    has_observations = obs_o_vals is not None
+    envelope = data.get("envelope")
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    if has_observations:
+        label = data["obs_label"]
+        if obs_error_o_vals is not None:
+            ax.fill_between(
+                profile_axis_out, obs_o_vals - obs_error_o_vals, obs_o_vals + obs_error_o_vals, color="0.85"
+            )
+
+        if simple_plot:
+            ax.plot(profile_axis_out, obs_o_vals, "-", color="0.35", label=label)
+        else:
+            ax.plot(profile_axis_out, obs_o_vals, "-", color="0.5")
+            ax.plot(
+                profile_axis_out,
+                obs_o_vals,
+                dash_style,
+                color=obscolor,
+                markeredgewidth=markeredgewidth,
+                markeredgecolor=markeredgecolor,
+                label=label,
+            )
+
+    if envelope is not None:
+        # The cost of an envelope does not depend on the ensemble size
+        env_color = my_colors[-1]
+        ax.fill_between(profile_axis_out, envelope[0], envelope[4], color=env_color, alpha=0.25, lw=0, label="5-95%")
+        ax.fill_between(profile_axis_out, envelope[1], envelope[3], color=env_color, alpha=0.5, lw=0, label="16-84%")
+        ax.plot(profile_axis_out, envelope[2], "-", color=env_color, label=data["envelope_label"])
+
+    for k, (exp_o_vals, label) in enumerate(zip(data["exp_values"], data["exp_labels"])):
+        my_color = my_colors[k]
+        if simple_plot:
+            line_c, = ax.plot(profile_axis_out, exp_o_vals, color=my_color, label=label)
+            line_d, = ax.plot(profile_axis_out, exp_o_vals, color=my_color)
+        else:
+            line_c, = ax.plot(profile_axis_out, exp_o_vals, "-", color=my_color, alpha=0.5)
+            line_d, = ax.plot(
+                profile_axis_out,
+                exp_o_vals,
+                dash_style,
+                color=my_color,
+                markeredgewidth=markeredgewidth,
+                markeredgecolor=markeredgecolor,
+                label=label,
+            )
+
+    ax.set_xlim(0, np.nanmax(profile_axis_out))
+    ax.set_xlabel(data["xlabel"])
+    ax.set_ylabel(data["ylabel"])
+    ax.set_ylim(bottom=y_lim_min, top=y_lim_max)
+    handles, labels = ax.get_legend_handles_labels()
+    ordered_handles = handles[:0:-1]
+    ordered_labels = labels[:0:-1]
+    ordered_handles.insert(0, handles[0])
+    ordered_labels.insert(0, labels[0])
+    if legend != "none":
+        if (legend == "short") or (legend == "regress") or (legend == "attr"):
+            lg = ax.legend(
+                ordered_handles,
+                ordered_labels,
+                loc="upper right",
+                shadow=True,
+                numpoints=numpoints,
+                bbox_to_anchor=(0, 0, 1, 1),
+                bbox_transform=plt.gcf().transFigure,
+            )
+        else:
+            lg = ax.legend(
+                ordered_handles,
+                ordered_labels,
+                loc="upper right",
+                title=data["legend_title"],
+                shadow=True,
+                numpoints=numpoints,
+                bbox_to_anchor=(0, 0, 1, 1),
+                bbox_transform=plt.gcf().transFigure,
+            )
+        fr = lg.get_frame()
+        fr.set_lw(legend_frame_width)
+    # Replot observations
+    if has_observations:
+        if simple_plot:
+            ax.plot(profile_axis_out, obs_o_vals, "-", color="0.35")
+        else:
+            ax.plot(profile_axis_out, obs_o_vals, "-", color="0.5")
+            ax.plot(
+                profile_axis_out,
+                obs_o_vals,
+                dash_style,
+                color=obscolor,
+                markeredgewidth=markeredgewidth,
+                markeredgecolor=markeredgecolor,
+            )
+    if plot_title:
+        plt.title(data["gate_name"], loc="left")
+
+    outname = data["outname"]
+    print(("Saving {0}".format(outname)))
+    fig.tight_layout()
+    fig.savefig(outname)
+    plt.close(fig)
+
+
+def _init_render_worker(settings, rc_params):
+    """
+    Initialize a figure rendering worker process
+
+    Figures are rendered with the headless Agg backend. Module globals
+    and matplotlib settings of the parent process are set from settings
+    and rc_params.
+    """
+
+    plt.switch_backend("agg")
+    mpl.rcParams.update(rc_params)
+    globals().update(settings)
+
+
+def render_line_plots_mp(plot_data, settings, n_procs=1):
+    """
+    Render line plots in a pool of processes.
+
+    Only the arrays and strings prepared by FluxGate.get_line_plot_data
+    are sent to the workers.
+
+    Parameters
+    ----------
+    plot_data: iterable of dicts as returned by FluxGate.get_line_plot_data
+    settings: dict, module globals needed to render figures
+    n_procs: int, number of processes
+    """
+
+    rc_params = dict((key, val) for key, val in list(mpl.rcParams.items()) if key != "backend")
+    pool = mp.Pool(processes=n_procs, initializer=_init_render_worker, initargs=(settings, rc_params))
+    try:
+        for _ in pool.imap_unordered(render_line_plot, plot_data):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+
+class CorrelationFigure(object):
+
+    """
+    A reusable figure of Pearson correlations of all gates.
+
+    The figure, its artists and its layout are made once. Drawing an
+    experiment only updates line segments, marker positions, colors
+    and tick labels, so the same figure can be saved for any number of
+    experiments.
+
+    Parameters
+    ----------
+    gates: list of FluxGates with statistics
+    title: bool, show the experiment as title, e.g. for pages of a
+           multi-page PDF
+
+    """
+
+    def __init__(self, gates, title=False, *args, **kwargs):
+        super(CorrelationFigure, self).__init__(*args, **kwargs)
+        self.gates = gates
+        self.gates_by_id = dict((gate.pos_id, gate) for gate in gates)
+        self.labels = dict((gate.pos_id, "{} ({})".format(gate.gate_name, gate.gate_id)) for gate in gates)
+        lw, pad_inches = ppt.set_mode(print_mode, aspect_ratio=1.2)
+        fig = plt.figure(figsize=[6.4, 12])
+        ax = fig.add_subplot(111)
+        self.y = np.arange(len(gates)) + 1.25
+        self.lines = ax.hlines([], -1, [], linestyle="dotted")
+        # one marker artist per correlation class
+        self.markers = dict(
+            (color, ax.plot([], [], "o", markersize=5, color=color)[0]) for color in ("#d7191c", "#ff7f00", "#33a02c")
+        )
+        self.median = ax.vlines([0], 0, [1], linestyle="dotted", color="0.5")
+        self.title = None
+        if title:
+            self.title = ax.set_title(" ")
+        ax.set_xlabel("r (-)", labelpad=0.2)
+        ax.set_xlim(-1, 1.1)
+        ticks = [-1, -0.5, 0, 0.5, 1]
+        ax.set_xticks(ticks)
+        ax.set_xticklabels(ticks)
+        ax.spines["bottom"].set_bounds(-1, 1)
+        # Hide the right and top spines
+        ax.spines["right"].set_visible(False)
+        ax.spines["top"].set_visible(False)
+        # Only show ticks on the left and bottom spines
+        ax.yaxis.set_ticks_position("left")
+        ax.xaxis.set_ticks_position("bottom")
+        # The layout is the same for every experiment, gates are only reordered
+        ax.set_yticks(self.y)
+        ax.set_yticklabels([self.labels[gate.pos_id] for gate in gates])
+        ax.set_ylim(0, self.y[-1] + 1)
+        fig.tight_layout()
+        self.fig = fig
+        self.ax = ax
+
+    def __repr__(self):
+        return "CorrelationFigure"
+
+    def draw(self, exp):
+        """
+        Update the figure for an experiment.
+
+        Gates are sorted by increasing correlation, gates without
+        correlation are left out.
+
+        Parameters
+        ----------
+        exp: FluxGateExperiment
+
+        Returns
+        -------
+        corrs_dict: dict of correlations by gate id, sorted
+        """
+
+        corrs = {}
+        for gate in self.gates:
+            id = gate.pos_id
+            r = gate.corr[exp.id]
+            if not np.isnan(r):
+                corrs[id] = r
+        sort_order = sorted(corrs, key=lambda x: corrs[x])
+        corrs_sorted = np.array([corrs[x] for x in sort_order])
+        gate_id_sorted = [self.gates_by_id[x].gate_id for x in sort_order]
+        corrs_dict = dict(zip(gate_id_sorted, corrs_sorted))
+        n = len(corrs_sorted)
+        y = self.y[:n]
+        colors = np.full(n, "#33a02c")
+        colors[(corrs_sorted >= pearson_r_threshold_low) & (corrs_sorted < pearson_r_threshold_high)] = "#ff7f00"
+        colors[corrs_sorted < 0.5] = "#d7191c"
+        self.lines.set_segments([[(-1, y[k]), (corr, y[k])] for k, corr in enumerate(corrs_sorted)])
+        self.lines.set_colors(list(colors))
+        for color, marker in list(self.markers.items()):
+            marker.set_data(corrs_sorted[colors == color], y[colors == color])
+
+        ax = self.ax
+        if n > 0:
+            corr_median = np.nanmedian(corrs_sorted)
+            self.median.set_segments([[(corr_median, 0), (corr_median, y[-1])]])
+            print(("median correlation: {:1.2f}".format(corr_median)))
+            ax.set_yticks(y)
+            ax.set_yticklabels([self.labels[x] for x in sort_order])
+            ax.set_ylim(0, y[-1] + 1)
+            # Only draw spine between the y-ticks
+            ax.spines["left"].set_bounds(y[0], y[-1])
+        else:
+            self.median.set_segments([])
+            ax.set_yticks([])
+        if self.title is not None:
+            self.title.set_text("Experiment {}".format(exp.id))
+        return corrs_dict
+
+    def save(self, filename):
+        """
+        Save the figure to a file name or a PdfPages object
+        """
+
+        if isinstance(filename, str):
+            print(("Saving {0}".format(filename)))
+            self.fig.savefig(filename)
+        else:
+            filename.savefig(self.fig)
+
+    def close(self):
+        plt.close(self.fig)
+
+
+def make_correlation_figure(filename, exp, gates=None):
     """
     Create a Pearson R correlation plot.
 
     Create a correlation plot for a given experiment, sorted by
-    decreasing correlation
+    decreasing correlation. To plot many experiments, use
+    CorrelationFigure directly.
 
     Parameters
     ----------
     filename: string
     exp: FluxGateExperiment
+    gates: list of FluxGates, default is all flux gates
 
     """
-    corrs = {}
-    for gate in flux_gates:
-        id = gate.pos_id
-        r = gate.corr[exp.id]
-        if not np.isnan(r):
-            corrs[id] = r
-    sort_order = sorted(corrs, key=lambda x: corrs[x])
-    corrs_sorted = [corrs[x] for x in sort_order]
-    names_sorted = [flux_gates[x].gate_name for x in sort_order]
-    gate_id_sorted = [flux_gates[x].gate_id for x in sort_order]
-    corrs_dict = dict(zip(gate_id_sorted, corrs_sorted))
-    lw, pad_inches = ppt.set_mode(print_mode, aspect_ratio=1.2)
-    fig = plt.figure(figsize=[6.4, 12])
-    ax = fig.add_subplot(111)
-    height = 0.4
-    y = np.arange(len(list(corrs.keys()))) + 1.25
-    for k, corr in enumerate(corrs_sorted):
-        if corr < 0.5:
-            colorVal = "#d7191c"
-        elif (corr >= pearson_r_threshold_low) and (corr < pearson_r_threshold_high):
-            colorVal = "#ff7f00"
-        else:
-            colorVal = "#33a02c"
-        ax.hlines(y[k], -1, corr, colors=colorVal, linestyle="dotted")
-        ax.plot(corr, y[k], "o", markersize=5, color=colorVal)
-
-    corr_median = np.nanmedian(list(corrs.values()))
-    ax.vlines(corr_median, 0, y[-1], linestyle="dotted", color="0.5")
-    print(("median correlation: {:1.2f}".format(corr_median)))
-    plt.yticks(y, ["{} ({})".format(flux_gates[x].gate_name, flux_gates[x].gate_id) for x in sort_order])
-    ax.set_xlabel("r (-)", labelpad=0.2)
-    ax.set_xlim(-1, 1.1)
-    ax.set_ylim(0, y[-1] + 1)
-    ticks = [-1, -0.5, 0, 0.5, 1]
-    ax.set_xticks(ticks)
-    ax.set_xticklabels(ticks)
-    # Only draw spine between the y-ticks
-    ax.spines["left"].set_bounds(y[0], y[-1])
-    ax.spines["bottom"].set_bounds(-1, 1)
-    # Hide the right and top spines
-    ax.spines["right"].set_visible(False)
-    ax.spines["top"].set_visible(False)
-    # Only show ticks on the left and bottom spines
-    ax.yaxis.set_ticks_position("left")
-    ax.xaxis.set_ticks_position("bottom")
-    fig.tight_layout()
-    print(("Saving {0}".format(filename)))
-    fig.savefig(filename)
-    plt.close("all")
+    if gates is None:
+        gates = flux_gates
+    figure = CorrelationFigure(gates)
+    corrs_dict = figure.draw(exp)
+    figure.save(filename)
+    figure.close()
     return corrs_dict
 
 
-def make_regression():
-    grid_dx_meters = [x.config["grid_dx_meters"] for x in gate.experiments]
+def get_flow_type_rmsd(ranking_flow_type, flow_type, ids):
+    """
+    Return the cumulative RMSD of gates of one flow type per experiment
+
+    Parameters
+    ----------
+    ranking_flow_type: pandas.DataFrame as returned by rank_experiments(table, by="flow_type")
+    flow_type: int, 0 (isbrae), 1 (ice-stream) or 2 (undetermined)
+    ids: list of experiment ids
+
+    Returns
+    -------
+    rmsd : pandas.Series indexed by ids, NaN if there are no gates of this flow type
+    """
+
+    rmsd = ranking_flow_type["rmsd"]
+    if flow_type not in rmsd.index.get_level_values("flow_type"):
+        return pa.Series(np.nan, index=ids)
+    return rmsd.xs(flow_type, level="flow_type").reindex(ids)
+
+
+def make_regression(ranking, ranking_flow_type):
+    """
+    Make grid resolution regression plots of RMSD, r2 and correlation
+
+    Parameters
+    ----------
+    ranking: pandas.DataFrame as returned by rank_experiments(table)
+    ranking_flow_type: pandas.DataFrame as returned by rank_experiments(table, by="flow_type")
+    """
+
+    ids = [x.id for x in flux_gates[0].experiments]
+    grid_dx_meters = [x.config["grid_dx_meters"] for x in flux_gates[0].experiments]
+    rmsd_cum = ranking["rmsd"].reindex(ids)
+    rmsd_isbrae_cum = get_flow_type_rmsd(ranking_flow_type, 0, ids)
+    rmsd_ice_stream_cum = get_flow_type_rmsd(ranking_flow_type, 1, ids)
+    r2_cum = pa.Series([np.nanmedian([gate.r2[id] for gate in flux_gates]) for id in ids], index=ids)
     for gate in flux_gates:
 
         # RMSD
@@ -1123,7 +718,6 @@ def make_regression():
     colormap = ["RdYlGn", "Diverging", nocol, 0]
     my_ok_colors = colorbrewer.get_map(*colormap).mpl_colors
 
-    grid_dx_meters = [x.config["grid_dx_meters"] for x in gate.experiments]
     lw, pad_inches = ppt.set_mode(print_mode, aspect_ratio=1.25)
 
     # Create RMSD figure
@@ -1147,7 +741,7 @@ def make_regression():
         # r-squared value
         r2 = model.rsquared
         # p-value
-        p = model.fpvalue
+        p = model.f_pvalue
         f = model.fvalue
 
         gate.linear_trend = trend
@@ -1183,6 +777,8 @@ def make_regression():
         )
 
     for id in (1, 11, 19, 23):
+        if id >= len(flux_gates):
+            continue
 
         gate = flux_gates[id]
         # print(u"selecting glacier {}".format(gate.gate_name))
@@ -1236,8 +832,8 @@ def make_regression():
         legend_handles.append(line_l)
 
     # all isbrae RMSD
-    rmsd_data = list(rmsd_isbrae_cum_dict.values())
-    rmsdS = pa.Series(data=rmsd_data, index=list(rmsd_isbrae_cum_dict.keys()))
+    rmsd_data = list(rmsd_isbrae_cum.values)
+    rmsdS = rmsd_isbrae_cum
     gridS = pa.Series(data=grid_dx_meters, index=list(gate.rmsd.keys()))
     d = {"grid_resolution": gridS, "RMSD": rmsdS}
     df = pa.DataFrame(d)
@@ -1267,8 +863,8 @@ def make_regression():
     print(("Isbrae regression r2 = {:2.2f}".format(r2_isbrae)))
 
     # all ice-stream RMSD
-    rmsd_data = list(rmsd_ice_stream_cum_dict.values())
-    rmsdS = pa.Series(data=rmsd_data, index=list(rmsd_ice_stream_cum_dict.keys()))
+    rmsd_data = list(rmsd_ice_stream_cum.values)
+    rmsdS = rmsd_ice_stream_cum
     gridS = pa.Series(data=grid_dx_meters, index=list(gate.rmsd.keys()))
     d = {"grid_resolution": gridS, "RMSD": rmsdS}
     df = pa.DataFrame(d)
@@ -1299,8 +895,8 @@ def make_regression():
     print(("Ice-stream regression r2 = {:2.2f}".format(r2_ice_stream)))
 
     # global RMSD
-    rmsd_data = list(rmsd_cum_dict.values())
-    rmsdS = pa.Series(data=rmsd_data, index=list(rmsd_cum_dict.keys()))
+    rmsd_data = list(rmsd_cum.values)
+    rmsdS = rmsd_cum
     gridS = pa.Series(data=grid_dx_meters, index=list(gate.rmsd.keys()))
     d = {"grid_resolution": gridS, "RMSD": rmsdS}
     df = pa.DataFrame(d)
@@ -1360,7 +956,7 @@ def make_regression():
         df = pa.DataFrame(d)
         model = sm.OLS(r2S, sm.add_constant(gridS)).fit()
         # Calculate PISM trends and biases (intercepts)
-        bis, trend = model.params
+        bias, trend = model.params
         # Calculate r-squared value
         r2 = model.rsquared
 
@@ -1381,12 +977,12 @@ def make_regression():
         )
 
     # global R2
-    r2_data = list(r2_cum_dict.values())
-    r2S = pa.Series(data=r2_data, index=list(r2_cum_dict.keys()))
+    r2_data = list(r2_cum.values)
+    r2S = r2_cum
     gridS = pa.Series(data=grid_dx_meters, index=list(gate.r2.keys()))
     d = {"grid_resolution": gridS, "R2": r2S}
     df = pa.DataFrame(d)
-    model = sm.OLS(gridS, sm.add_constant(r2S)).fit()
+    model = sm.OLS(r2S, sm.add_constant(gridS)).fit()
     # Calculate PISM trends and biases (intercepts)
     bias, trend = model.params
     # Calculate r-squared value
@@ -1429,15 +1025,6 @@ def make_regression():
     for n, gate in enumerate(flux_gates):
         # correlation
         corr_data = list(gate.corr.values())
-        corrS = pa.Series(data=corr_data, index=list(gate.corr.keys()))
-        gridS = pa.Series(data=grid_dx_meters, index=list(gate.corr.keys()))
-        d = {"grid_resolution": gridS, "correlation": corrS}
-        df = pa.DataFrame(d)
-        model = pa.ols(x=gridS, y=corrS)
-        # Calculate PISM trends and biases (intercepts)
-        trend, bias = model.beta
-        # Calculate r-squared value
-        r2 = model.r2
 
         colorVal = scalarMap.to_rgba(n)
         if corr_data[0] >= 0.85:
@@ -1468,6 +1055,60 @@ def make_regression():
     plt.close("all")
 
 
+def write_result_views(flux_gates, multipage=False):
+    """
+    Write per-gate and per-experiment tables and figures.
+
+    Writes a LaTeX table of experiments sorted by RMSD and a CSV file of
+    correlations for each gate, and a correlation figure, a CSV file of
+    correlations and a LaTeX table of gates sorted by RMSD for each
+    experiment.
+
+    Parameters
+    ----------
+    flux_gates: list of FluxGates with statistics
+    multipage: bool, write the correlation figures of all experiments as
+               pages of one PDF file
+    """
+
+    # write rmsd and pearson r tables per gate
+    for gate in flux_gates:
+        gate_name = "_".join([unidecode(gate.gate_name), "rmsd", varname])
+        outname = ".".join([gate_name, "tex"]).replace(" ", "_")
+        export_latex_table_rmsd(outname, gate)
+        gate_name = "_".join([unidecode(gate.gate_name), "pearson_r", varname])
+        outname = ".".join([gate_name, "csv"]).replace(" ", "_")
+        ids = sorted(gate.p_ols, key=lambda x: gate.corr[x], reverse=True)
+        corrs = [gate.corr[x] for x in ids]
+        corrs_dict = dict(zip(ids, corrs))
+        export_csv_from_dict(outname, corrs_dict, header="id,correlation")
+        # outname = ".".join([gate_name, "tex"]).replace(" ", "_")
+        # export_latex_table_corr(outname, gate)
+    # write rmsd and person r figure per experiment
+    figure = CorrelationFigure(flux_gates, title=multipage)
+    pdf = None
+    if multipage:
+        outname = ".".join(["_".join(["pearson_r_experiments", varname]), "pdf"])
+        print(("Saving {0}".format(outname)))
+        pdf = PdfPages(outname)
+    for exp in flux_gates[0].experiments:
+        corrs = figure.draw(exp)
+        if pdf is not None:
+            figure.save(pdf)
+        else:
+            exp_str = "_".join(["pearson_r_experiment", str(exp.id), varname])
+            figure.save(".".join([exp_str, "pdf"]))
+        exp_str = "_".join(["coors_experiment", str(exp.id), varname])
+        outname = ".".join([exp_str, "csv"])
+        export_csv_from_dict(outname, corrs, header="id,correlation")
+        exp_str = "_".join(["rmsd_experiment", str(exp.id), varname])
+        outname = ".".join([exp_str, "tex"])
+        export_gate_table_rmsd(outname, exp, flux_gates)
+    if pdf is not None:
+        pdf.close()
+    figure.close()
+
+
 def write_shapefile(filename, flux_gates):
     """
     Writes metrics to a ESRI shape file.
@@ -1596,11 +1237,21 @@ def write_shapefile(filename, flux_gates):
     ds = None
 
 
-def export_rmsd_latex_table():
+def export_rmsd_latex_table(ranking, ranking_flow_type):
     """
     Used for "Complex Greenland Outlet Glacier Flow Captured
+
+    Parameters
+    ----------
+    ranking: pandas.DataFrame as returned by rank_experiments(table)
+    ranking_flow_type: pandas.DataFrame as returned by rank_experiments(table, by="flow_type")
     """
 
+    ids = list(ranking.index)
+    rmsd_cum_dict_sorted = sorted(iter(ranking["rmsd"].items()), key=operator.itemgetter(1))
+    rmsd_isbrae_cum_dict = get_flow_type_rmsd(ranking_flow_type, 0, ids).to_dict()
+    rmsd_ice_stream_cum_dict = get_flow_type_rmsd(ranking_flow_type, 1, ids).to_dict()
+
     # RMSD LaTeX table
     outname = ".".join(["rmsd_cum_table", "tex"])
     print(("Saving {0}".format(outname)))
@@ -1695,7 +1346,28 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     parser.description = "Analyze flux gates. Used for 'Complex Greenland Outlet Glacier Flow Captured'."
     parser.add_argument("FILE", nargs="*")
+    parser.add_argument(
+        "--append",
+        dest="append",
+        action="store_true",
+        help="""Add experiments to the results file of a previous run. Only files not yet in the results file are read. Profile figures are not made.
+                      Not supported with --mc_samples""",
+        default=False,
+    )
     parser.add_argument("--aspect_ratio", dest="aspect_ratio", type=float, help='''Plot aspect ratio"''', default=0.8)
+    parser.add_argument(
+        "--cache_dir",
+        dest="cache_dir",
+        help="""Directory to cache fluxes and statistics of experiments between runs. Default is None (no caching)""",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_size",
+        dest="cache_size",
+        type=float,
+        help="""Maximum size of the cache in MB. Default=1024""",
+        default=1024.0,
+    )
     parser.add_argument(
         "--colormap",
         dest="colormap",
@@ -1720,6 +1392,20 @@ if __name__ == "__main__":
     parser.add_argument(
         "--obs_file", dest="obs_file", help="""Profile file with observations. Default is None""", default=None
     )
+    parser.add_argument(
+        "--export_views",
+        dest="export_views",
+        action="store_true",
+        help="""Also write tables and figures per gate and per experiment. If no experiment files are given, they are made from the results file""",
+        default=False,
+    )
+    parser.add_argument(
+        "--multipage",
+        dest="multipage",
+        action="store_true",
+        help="""With --export_views, write the correlation figures of all experiments as pages of one PDF file""",
+        default=False,
+    )
     parser.add_argument(
         "--export_table_file",
         dest="table_file",
@@ -1729,6 +1415,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--no_figures", dest="make_figures", action="store_false", help="Do not make profile figures", default=True
     )
+    parser.add_argument(
+        "--plot_mode",
+        dest="plot_mode",
+        choices=["lines", "envelope"],
+        help="""Profile figures show one line per experiment ('lines', default) or
+                      the 5/16/50/84/95 percentiles of the ensemble ('envelope')""",
+        default="lines",
+    )
+    parser.add_argument(
+        "--highlight_best",
+        dest="highlight_best",
+        action="store_true",
+        help="In envelope mode, also draw the experiment with the lowest RMSD",
+        default=False,
+    )
     parser.add_argument(
         "--do_regress", dest="do_regress", action="store_true", help="Make grid resolution regression plots", default=False
     )
@@ -1740,6 +1441,27 @@ if __name__ == "__main__":
                         'default' (default), 'none, 'short', long', 'regress'",
         default="default",
     )
+    parser.add_argument(
+        "--n_procs",
+        dest="n_procs",
+        type=int,
+        help="""Number of processes to read experiments and make profile figures. Default=1""",
+        default=1,
+    )
+    parser.add_argument(
+        "--index_file",
+        dest="index_file",
+        help="""SQLite file with an index of experiment parameters, used with --select. Default=experiment_index.sqlite""",
+        default="experiment_index.sqlite",
+    )
+    parser.add_argument(
+        "--gates",
+        dest="gates",
+        help="""Only analyze gates matching a semicolon-separated list of conditions key=values
+                      with keys id, name, glaciertype, flowtype and bbox (lon_min,lat_min,lon_max,lat_max),
+                      e.g. "flowtype=0,1;bbox=-55,68,-45,72". Default is None (all gates)""",
+        default=None,
+    )
     parser.add_argument("--o_dir", dest="odir", help="output directory. Default: current directory", default="foo")
     parser.add_argument(
         "--plot_title", dest="plot_title", action="store_true", help="Plots the flux gate name as title", default=False
@@ -1747,6 +1469,78 @@ if __name__ == "__main__":
     parser.add_argument(
         "--simple_plot", dest="simple_plot", action="store_true", help="Make simple line plot", default=False
     )
+    parser.add_argument(
+        "--streaming",
+        dest="streaming",
+        action="store_true",
+        help="Reduce each experiment to fluxes and statistics right after reading it and release it. Profile figures are not made.",
+        default=False,
+    )
+    parser.add_argument(
+        "--results_file",
+        dest="results_file",
+        help="""netCDF file with fluxes and statistics of all gates and experiments. Default is flux_gate_results_VARNAME.nc""",
+        default=None,
+    )
+    parser.add_argument(
+        "--mc_samples",
+        dest="mc_samples",
+        type=int,
+        help="""Number of perturbed observations drawn from the observational errors to estimate
+                      observed flux percentiles and the robustness of the experiment ranking. Default=0 (off)""",
+        default=0,
+    )
+    parser.add_argument(
+        "--mc_seed", dest="mc_seed", type=int, help="""Seed of the random number generator. Default=0""", default=0
+    )
+    parser.add_argument(
+        "--mc_correlated",
+        dest="mc_correlated",
+        action="store_true",
+        help="""Observational errors are fully correlated along each gate. Default is independent errors""",
+        default=False,
+    )
+    parser.add_argument(
+        "--emulator",
+        dest="emulator",
+        choices=["none", "polynomial", "gp"],
+        help="""Fit a surrogate of gate fluxes and misfits to the experiment parameters and propose
+                      the next experiments: polynomial chaos or Gaussian process. Default=none""",
+        default="none",
+    )
+    parser.add_argument(
+        "--emulator_params",
+        dest="emulator_params",
+        help="""Comma-separated list of parameters of the emulator. Default is --label_params""",
+        default=None,
+    )
+    parser.add_argument(
+        "--emulator_degree",
+        dest="emulator_degree",
+        type=int,
+        help="""Total degree of the polynomial emulator. Default=2""",
+        default=2,
+    )
+    parser.add_argument(
+        "--n_proposals",
+        dest="n_proposals",
+        type=int,
+        help="""Number of proposed experiments. Default=5""",
+        default=5,
+    )
+    parser.add_argument(
+        "--timeseries_file",
+        dest="timeseries_file",
+        help="""netCDF file with flux and misfit time series of transient experiments. Default is flux_gate_timeseries_VARNAME.nc""",
+        default=None,
+    )
+    parser.add_argument(
+        "--select",
+        dest="select",
+        help="""Only use experiments whose parameters match a comma-separated list of conditions,
+                      e.g. "stress_balance.sia.enhancement_factor>=1.5,grid_dx_meters=900". Default is None""",
+        default=None,
+    )
     parser.add_argument("--no_legend", dest="plot_legend", action="store_false", help="Don't plot a legend", default=True)
     parser.add_argument(
         "-p",
@@ -1775,7 +1569,10 @@ if __name__ == "__main__":
     args = options.FILE
 
     np.seterr(all="warn")
+    append = options.append
     aspect_ratio = options.aspect_ratio
+    cache_dir = options.cache_dir
+    cache_size = options.cache_size
     tol = 1e-6
     normalize = options.normalize
     print_mode = options.print_mode
@@ -1783,20 +1580,67 @@ if __name__ == "__main__":
     out_res = int(options.out_res)
     varname = options.varname
     table_file = options.table_file
+    export_views = options.export_views
+    multipage = options.multipage
+    results_file = options.results_file
+    timeseries_file = options.timeseries_file
+    mc_samples = options.mc_samples
+    mc_seed = options.mc_seed
+    mc_correlated = options.mc_correlated
     label_params = list(options.label_params.split(","))
+    emulator_kind = options.emulator
+    emulator_degree = options.emulator_degree
+    n_proposals = options.n_proposals
+    if options.emulator_params is None:
+        emulator_params = label_params
+    else:
+        emulator_params = list(options.emulator_params.split(","))
     plot_title = options.plot_title
     legend = options.legend
     do_regress = options.do_regress
     make_figures = options.make_figures
+    plot_mode = options.plot_mode
+    highlight_best = options.highlight_best
+    n_procs = options.n_procs
+    index_file = options.index_file
+    gates_selector = options.gates
+    select = options.select
     odir = options.odir
     simple_plot = options.simple_plot
+    streaming = options.streaming
     y_lim_min, y_lim_max = options.y_lim
-    ice_density = 910.0
-    ice_density_units = "910 kg m-3"
-    vol_to_mass = False
-    profile_axis_out_units = "km"
-    pearson_r_threshold_high = 0.85
-    pearson_r_threshold_low = 0.50
+
+    try:
+        analysis_config = AnalysisConfig(varname, label_params=label_params, legend=legend, normalize=normalize)
+    except ValueError as e:
+        print(("ERROR: {} ... ending ...".format(e)))
+        import sys
+
+        sys.exit(1)
+    # Tables, regressions and shapefiles use the units of the config
+    flux_type = analysis_config.flux_type
+    v_o_units = analysis_config.v_o_units
+    v_o_units_str = analysis_config.v_o_units_str
+    v_o_units_str_tex = analysis_config.v_o_units_str_tex
+    vol_to_mass = analysis_config.vol_to_mass
+    v_flux_o_units = analysis_config.v_flux_o_units
+    v_flux_o_units_str = analysis_config.v_flux_o_units_str
+    v_flux_o_units_str_tex = analysis_config.v_flux_o_units_str_tex
+    ice_density_units = analysis_config.ice_density_units
+    profile_axis_out_units = analysis_config.profile_axis_out_units
+    pearson_r_threshold_high = analysis_config.pearson_r_threshold_high
+    pearson_r_threshold_low = analysis_config.pearson_r_threshold_low
+    params_dict = analysis_config.params_dict
+    flow_types = analysis_config.flow_types
+    glacier_types = analysis_config.glacier_types
+
+    if streaming and make_figures:
+        print("Streaming mode does not keep profiles, not making profile figures")
+        make_figures = False
+
+    if append and make_figures:
+        print("Results of previous runs have no profiles, not making profile figures")
+        make_figures = False
 
     if y_lim_min is not None:
         y_lim_min = np.float(y_lim_min)
@@ -1804,45 +1648,6 @@ if __name__ == "__main__":
         y_lim_max = np.float(y_lim_max)
 
 
-    if varname in ("velsurf_mag", "velbase_mag", "velsurf_normal"):
-        flux_type = "line flux"
-        v_o_units = "m yr-1"
-        v_o_units_str = "m yr$^\mathregular{{-1}}$"
-        v_o_units_str_tex = "m\,yr$^{-1}$"
-        v_flux_o_units = "km2 yr-1"
-        v_flux_o_units_str = "km$^\mathregular{2}$ yr$^\mathregular{{-1}}$"
-        v_flux_o_units_str_tex = "km$^2$\,yr$^{-1}$"
-    elif varname in ("flux_mag", "flux_normal"):
-        flux_type = "mass flux"
-        v_o_units = "km2 yr-1"
-        v_o_units_str = "km$^\mathregular{2}$ yr$^\mathregular{{-1}}$"
-        v_o_units_str_tex = "km$^2$\,yr$^{-1}$"
-        vol_to_mass = True
-        v_flux_o_units = "Gt yr-1"
-        v_flux_o_units_str = "Gt yr$^\mathregular{{-1}}$"
-        v_flux_o_units_str_tex = "Gt\,yr$^{-1}$"
-    elif varname in ("thk", "thickness", "land_ice_thickness"):
-        flux_type = "area"
-        v_o_units = "m"
-        v_o_units_str = "m"
-        v_o_units_str_tex = "m"
-        vol_to_mass = False
-        v_flux_o_units = "km2"
-        v_flux_o_units_str = "km$^\mathregular{2}$"
-        v_flux_o_units_str_tex = "km$^2$"
-    elif varname in ("usurf", "surface", "surface_altitude"):
-        flux_type = "area"
-        v_o_units = "m"
-        v_o_units_str = "m"
-        v_o_units_str_tex = "m"
-        vol_to_mass = False
-        v_flux_o_units = "km2"
-        v_flux_o_units_str = "km$^\mathregular{2}$"
-        v_flux_o_units_str_tex = "km$^2$"
-    else:
-        print(("variable {} not supported".format(varname)))
-
-
     na = len(args)
     shade = 0.15
     colormap = options.colormap
@@ -1865,56 +1670,68 @@ if __name__ == "__main__":
     markeredgecolor = 'k'
     obscolor = "0.4"
 
-    params_dict = {
-        "dem": {"abbr": "DEM", "format": "{}"},
-        "bed": {"abbr": "bed", "format": "{}"},
-        "surface.pdd.factor_ice": {"abbr": "$f_{\mathregular{i}}$", "format": "{:1.0f}"},
-        "surface.pdd.factor_snow": {"abbr": "$f_{\mathregular{s}}$", "format": "{:1.0f}"},
-        "basal_resistance.pseudo_plastic.q": {"abbr": "$q$", "format": "{:1.2f}"},
-        "basal_yield_stress.mohr_coulomb.till_effective_fraction_overburden": {"abbr": "$\\delta$", "format": "{:1.4f}"},
-        "stress_balance.sia.enhancement_factor": {"abbr": "$E_{\mathregular{SIA}}$", "format": "{:1.2f}"},
-        "stress_balance.ssa.enhancement_factor": {"abbr": "$E_{\mathregular{SSA}}$", "format": "{:1.2f}"},
-        "stress_balance.ssa.Glen_exponent": {"abbr": "$n_{\mathregular{SSA}}$", "format": "{:1.2f}"},
-        "stress_balance.sia.Glen_exponent": {"abbr": "$n_{\mathregular{SIA}}$", "format": "{:1.2f}"},
-        "grid_dx_meters": {"abbr": "ds", "format": "{:.0f}"},
-        "flow_law.gpbld.water_frac_observed_limit": {"abbr": "$\omega$", "format": "{:1.2}"},
-        "basal_yield_stress.mohr_coulomb.topg_to_phi.phi_min": {"abbr": "$\phi_{\mathregular{min}}$", "format": "{:4.2f}"},
-        "basal_yield_stress.mohr_coulomb.topg_to_phi.phi_max": {"abbr": "$\phi_{\mathregular{max}}$", "format": "{:4.2f}"},
-        "basal_yield_stress.mohr_coulomb.topg_to_phi.topg_min": {"abbr": "$z_{\mathregular{min}}$", "format": "{:1.0f}"},
-        "basal_yield_stress.mohr_coulomb.topg_to_phi.topg_max": {"abbr": "$z_{\mathregular{max}}$", "format": "{:1.0f}"},
-    }
-
-
-    var_long = (
-        "velsurf_mag",
-        "velbase_mag",
-        "velsurf_normal",
-        "flux_mag",
-        "flux_normal",
-        "surface",
-        "usurf",
-        "surface_altitude" "thk",
-        "thickness",
-        "land_ice_thickness",
-    )
-    var_short = (
-        "speed",
-        "sliding speed",
-        "speed",
-        "flux",
-        "flux",
-        "altitude",
-        "altitude",
-        "altitude",
-        "ice thickness",
-        "ice thickness",
-        "ice thickness",
-    )
-    var_name_dict = dict(list(zip(var_long, var_short)))
+    if results_file is None:
+        results_file = ".".join(["flux_gate_results_{}".format(varname), "nc"])
+    if timeseries_file is None:
+        timeseries_file = ".".join(["flux_gate_timeseries_{}".format(varname), "nc"])
+
+    if export_views and not args:
+        # Make tables and figures from an existing results file
+        flux_gates = read_results_file(results_file, analysis_config)
+        if flux_gates[0].has_stats:
+            write_result_views(flux_gates, multipage=multipage)
+        import sys
+
+        sys.exit(0)
+
+    # Select experiments by parameters
+    if select:
+        index = ExperimentIndex(index_file)
+        index.update(args, n_procs=n_procs)
+        args = index.select(args, select)
+        index.close()
+        print(("  selected {} experiments with {}".format(len(args), select)))
+        if not args:
+            print("ERROR: no experiments match ... ending ...")
+            import sys
+
+            sys.exit(1)
+
+    obs_hash = None
+    if obs_file:
+        obs_hash = get_file_hash(obs_file)
+
+    experiment_files = list(args)
+    ids = list(range(len(args)))
+    previous_gates = None
+    if append and os.path.isfile(results_file):
+        # RMSD samples are not stored, a ranking of new experiments only would be wrong
+        if mc_samples > 0:
+            print("ERROR: append mode is not supported with Monte Carlo samples (--mc_samples) ... ending ...")
+            import sys
 
-    flow_types = {0: "isbr{\\ae}", 1: "ice-stream", 2: "undefined"}
-    glacier_types = {0: "ffmt", 1: "lvmt", 2: "ist", 3: "lt"}
+            sys.exit(1)
+        previous_files, previous_obs_hash = read_results_metadata(results_file)
+        if previous_files is None:
+            print(("ERROR: results file '%s' has no experiment files ... ending ..." % results_file))
+            import sys
 
+            sys.exit(1)
+        if previous_obs_hash != obs_hash:
+            print(("ERROR: observations differ from those in results file '%s' ... ending ..." % results_file))
+            import sys
+
+            sys.exit(1)
+        args = [filename for filename in args if os.path.abspath(filename) not in previous_files]
+        print(("  appending {} new experiments to {} experiments in {}".format(len(args), len(previous_files), results_file)))
+        if not args:
+            import sys
+
+            sys.exit(0)
+        previous_gates = read_results_file(results_file, analysis_config)
+        first_id = max([exp.id for exp in previous_gates[0].experiments]) + 1
+        experiment_files = previous_files + args
+        ids = list(range(first_id, first_id + len(args)))
 
     # Open first file
     filename = args[0]
@@ -1930,63 +1747,127 @@ if __name__ == "__main__":
     # Get profiles from first file
     # All experiments have to contain the same profiles
     # Create flux gates
-    profile_names = nc0.variables["profile_name"][:]
-    flux_gates = []
-    for pos_id, profile_name in enumerate(profile_names):
-        profile_axis = nc0.variables["profile_axis"][pos_id]
-        profile_axis_units = nc0.variables["profile_axis"].units
-        profile_axis_name = nc0.variables["profile_axis"].long_name
-        profile_id = int(nc0.variables["profile_id"][pos_id])
-        try:
-            clon = nc0.variables["clon"][pos_id]
-        except:
-            clon = 0.0
-        try:
-            clat = nc0.variables["clat"][pos_id]
-        except:
-            clat = 0.0
-        try:
-            flightline = nc0.variables["flightline"][pos_id]
-        except:
-            flightline = 0
-        try:
-            glaciertype = nc0.variables["glaciertype"][pos_id]
-        except:
-            glaciertype = ""
-        try:
-            flowtype = nc0.variables["flowtype"][pos_id]
-        except:
-            flowtype = ""
-        flux_gate = FluxGate(
-            pos_id,
-            profile_name,
-            profile_id,
-            profile_axis,
-            profile_axis_units,
-            profile_axis_name,
-            clon,
-            clat,
-            flightline,
-            glaciertype,
-            flowtype,
-        )
-        flux_gates.append(flux_gate)
+    rows = None
+    if gates_selector:
+        rows = select_gates(nc0, gates_selector)
+        print(("  selected {} of {} gates with {}".format(len(rows), len(nc0.variables["profile_name"]), gates_selector)))
+        if len(rows) == 0:
+            print("ERROR: no gates match ... ending ...")
+            import sys
+
+            sys.exit(1)
+    flux_gates, layout = read_flux_gates(nc0, rows, analysis_config)
+    transient = has_time_series(nc0, varname)
     nc0.close()
+    if transient and append:
+        print("ERROR: append mode is not supported for profiles with a time dimension ... ending ...")
+        import sys
+
+        sys.exit(1)
 
     # If observations are provided, load observations
+    obs_vals = None
+    obs_error = None
+    sampler = None
     if obs_file:
-        obs = ObservationsDataset(obs_file, varname)
+        obs = ObservationsDataset(obs_file, varname, layout=layout)
         for flux_gate in flux_gates:
             flux_gate.add_observations(obs)
+        obs_vals = get_observed_values(obs.values.data).reshape(layout.axis.data.shape)
+        if obs.has_error:
+            obs_error = obs.error.data.reshape(layout.axis.data.shape)
+            if mc_samples > 0 and not transient:
+                sampler = ObservationSampler(
+                    obs_vals, obs_error, layout.offsets, mc_samples, seed=mc_seed, correlated=mc_correlated
+                )
+        elif mc_samples > 0:
+            print("ERROR: Monte Carlo error propagation needs observational errors ... ending ...")
+            import sys
+
+            sys.exit(1)
+
+    cache = None
+    if cache_dir:
+        if rows is None:
+            context_rows = None
+        else:
+            context_rows = [int(row) for row in rows]
+        context = [
+            varname,
+            obs_hash,
+            context_rows,
+            [gate.pos_id for gate in flux_gates],
+            sorted(analysis_config.get_flux_settings().items()),
+            [mc_samples, mc_seed, mc_correlated],
+        ]
+        cache = ResultCache(cache_dir, context, max_size=cache_size)
+
+    if transient:
+        # Reduce every experiment to (time, gate) fluxes and statistics
+        print("  profiles have a time dimension, calculating time series")
+        results = list(
+            reduce_experiments(
+                args,
+                flux_gates,
+                layout,
+                varname,
+                obs_vals=obs_vals,
+                n_procs=n_procs,
+                cache=cache,
+                ids=ids,
+                obs_error=obs_error,
+            )
+        )
+        for flux_gate in flux_gates:
+            flux_gate.varname = results[0].varname
+            flux_gate.varname_units = results[0].varname_units
+        calculate_batch_observed_fluxes(flux_gates)
+        write_timeseries_file(
+            timeseries_file, flux_gates, results, experiment_files=experiment_files, observations_hash=obs_hash
+        )
+        import sys
+
+        sys.exit(0)
 
     # Add experiments to flux gates
-    for k, filename in enumerate(args):
-        # id = re.search("id_(\b0*([1-9][0-9]*|0)\b)", filename).group(1)
-        # pid = int(filename.split("id_")[1].split("_")[0])
-        id = k
-        experiment = ExperimentDataset(id, filename, varname)
+    rmsd_samples = {}
+    if streaming or n_procs > 1 or cache is not None or append or sampler is not None:
+        results = reduce_experiments(
+            args,
+            flux_gates,
+            layout,
+            varname,
+            obs_vals=obs_vals,
+            keep_values=make_figures,
+            n_procs=n_procs,
+            cache=cache,
+            ids=ids,
+            obs_error=obs_error,
+            sampler=sampler,
+        )
+        for result in results:
+            if result.rmsd_samples is not None:
+                rmsd_samples[result.id] = result.rmsd_samples
+            for m, flux_gate in enumerate(flux_gates):
+                flux_gate.add_experiment_result(result, m)
         for flux_gate in flux_gates:
-            flux_gate.add_experiment(experiment)
+            flux_gate.finalize_results()
+        if previous_gates is not None:
+            if [gate.gate_name for gate in previous_gates] != [gate.gate_name for gate in flux_gates]:
+                print(("ERROR: flux gates differ from those in results file '%s' ... ending ..." % results_file))
+                import sys
+
+                sys.exit(1)
+            for flux_gate, previous_gate in zip(flux_gates, previous_gates):
+                flux_gate.add_results(previous_gate)
+    else:
+        for k, filename in enumerate(args):
+            # id = re.search("id_(\b0*([1-9][0-9]*|0)\b)", filename).group(1)
+            # pid = int(filename.split("id_")[1].split("_")[0])
+            id = k
+            experiment = ExperimentDataset(id, filename, varname, layout=layout)
+            for flux_gate in flux_gates:
+                flux_gate.add_experiment(experiment)
 
 
     # set the print mode
@@ -1995,154 +1876,172 @@ if __name__ == "__main__":
     ne = len(flux_gates[0].experiments)
     ng = len(flux_gates)
 
+    calculate_batch_fluxes(flux_gates)
+    if obs_file:
+        calculate_batch_stats(flux_gates)
+    if sampler is not None:
+        calculate_observed_flux_intervals(flux_gates, sampler)
+
     if table_file and obs_file:
         export_latex_table_flux(table_file, flux_gates, label_params)
 
     # make figure for each flux gate
-    for gate in flux_gates:
-        if make_figures:
-            gate.make_line_plot(label_param_list=label_params)
+    if make_figures:
+        envelope = plot_mode == "envelope"
+        if envelope:
+            calculate_batch_envelopes(flux_gates)
+        plot_data = (
+            gate.get_line_plot_data(label_param_list=label_params, envelope=envelope, highlight_best=highlight_best)
+            for gate in flux_gates
+        )
+        if n_procs > 1:
+            figure_settings = {
+                "legend": legend,
+                "simple_plot": simple_plot,
+                "plot_title": plot_title,
+                "y_lim_min": y_lim_min,
+                "y_lim_max": y_lim_max,
+                "my_colors": my_colors,
+                "my_colors_light": my_colors_light,
+                "dash_style": dash_style,
+                "numpoints": numpoints,
+                "legend_frame_width": legend_frame_width,
+                "markeredgewidth": markeredgewidth,
+                "markeredgecolor": markeredgecolor,
+                "obscolor": obscolor,
+            }
+            render_line_plots_mp(plot_data, figure_settings, n_procs=n_procs)
         else:
+            for data in plot_data:
+                render_line_plot(data)
+    else:
+        for gate in flux_gates:
             if not gate.has_fluxes:
                 gate.calculate_fluxes()
-            if gate.has_observations:
+            if gate.has_observations and not gate.has_stats:
                 gate.calculate_stats()
 
 
+    write_results_file(results_file, flux_gates, experiment_files=experiment_files, observations_hash=obs_hash)
+
     if obs_file:
-        # write rmsd and pearson r tables per gate
-        for gate in flux_gates:
-            gate_name = "_".join([unidecode(gate.gate_name), "rmsd", varname])
-            outname = ".".join([gate_name, "tex"]).replace(" ", "_")
-            export_latex_table_rmsd(outname, gate)
-            gate_name = "_".join([unidecode(gate.gate_name), "pearson_r", varname])
-            outname = ".".join([gate_name, "csv"]).replace(" ", "_")
-            ids = sorted(gate.p_ols, key=lambda x: gate.corr[x], reverse=True)
-            corrs = [gate.corr[x] for x in ids]
-            corrs_dict = dict(zip(ids, corrs))
-            export_csv_from_dict(outname, corrs_dict, header="id,correlation")
-            # outname = ".".join([gate_name, "tex"]).replace(" ", "_")
-            # export_latex_table_corr(outname, gate)
-        # write rmsd and person r figure per experiment
-        for exp in flux_gates[0].experiments:
-            exp_str = "_".join(["pearson_r_experiment", str(exp.id), varname])
-            outname = ".".join([exp_str, "pdf"])
-            corrs = make_correlation_figure(outname, exp)
-            exp_str = "_".join(["coors_experiment", str(exp.id), varname])
-            outname = ".".join([exp_str, "csv"])
-            export_csv_from_dict(outname, corrs, header="id,correlation")
-            exp_str = "_".join(["rmsd_experiment", str(exp.id), varname])
-            outname = ".".join([exp_str, "tex"])
-            export_gate_table_rmsd(outname, exp)
-
-        experiments_df = []
-        experiments_isbrae_df = []
-        experiments_ice_stream_df = []
-        experiments_undetermined_df = []
-        glaciers_above_threshold = []
-        lengths = [gate.length() for gate in flux_gates]
-        for exp in range(ne):
-            names = [gate.gate_name for gate in flux_gates]
-            corrs = [gate.corr[exp] for gate in flux_gates]
-            rmsds = [gate.rmsd[exp] for gate in flux_gates]
-            Ns = [gate.N_rmsd[exp] for gate in flux_gates]
-            gl_types = [int(gate.glaciertype) for gate in flux_gates]
-            fl_types = [int(gate.flowtype) for gate in flux_gates]
-            d = {
-                "name": names,
-                "correlation": corrs,
-                "rmsd": rmsds,
-                "N": Ns,
-                "glacier_type": gl_types,
-                "flow_type": fl_types,
-                "length": lengths,
-            }
-            df = pa.DataFrame(d)
-            # Select glaciers with correlation above threshold
-            # df = df[df["correlation"] > pearson_r_threshold_high]
-            exp_rmsd_cum = np.sqrt(np.sum(df["rmsd"].values ** 2 * df["N"].values) * (1.0 / df["N"].values.sum()))
-            experiments_df.append(df)
-            # It would be nice to select for flow types later, with something like:
-            #  [
-            # np.sqrt(np.sum(df["rmsd"].values ** 2 * df["N"].values) * (1.0 / df["N"].values.sum()))
-            # for df in experiments_df if df[df["flow_type"] == 0]
-            # ]
-            #
-            experiments_isbrae_df.append(df[df["flow_type"] == 0])
-            experiments_ice_stream_df.append(df[df["flow_type"] == 1])
-            experiments_undetermined_df.append(df[df["flow_type"] == 2])
-
-            no_glaciers_above_threshold = len(df[df["correlation"] > pearson_r_threshold_high])
+        if export_views:
+            write_result_views(read_results_file(results_file, analysis_config), multipage=multipage)
 
+        table = get_ensemble_table(flux_gates)
+        ranking = rank_experiments(table, threshold=pearson_r_threshold_high)
+        ranking_flow_type = rank_experiments(table, by="flow_type", threshold=pearson_r_threshold_high)
+        for exp, row in ranking.iterrows():
             print("Experiment {}".format(exp))
+            print("  Number of glaciers with r(all) > {}: {}".format(pearson_r_threshold_high, int(row["no_glaciers"])))
+            print("  RMS difference {:4.0f}".format(row["rmsd"]))
+            print("  median(pearson r(all): {:1.2f}".format(row["correlation"]))
+            for flow_type, flow_type_name in ((0, "isbrae"), (1, "ice-stream"), (2, "undetermined")):
+                if (exp, flow_type) in ranking_flow_type.index:
+                    corr_median = ranking_flow_type.loc[(exp, flow_type), "correlation"]
+                else:
+                    corr_median = np.nan
+                print("  median(pearson r({}): {:1.2f}".format(flow_type_name, corr_median))
+
+        outname = ".".join(["ranking_{}".format(varname), "csv"])
+        print(("  - saving {0}".format(outname)))
+        export_ranking_csv(outname, table, threshold=pearson_r_threshold_high)
+
+        outname = ".".join(["pareto_{}".format(varname), "csv"])
+        print(("  - saving {0}".format(outname)))
+        pareto = export_pareto_csv(outname, table, threshold=pearson_r_threshold_high)
+        print(("  non-dominated experiments: {}".format(", ".join([str(exp) for exp in pareto.index[pareto["front"] == 0]]))))
+
+        if rmsd_samples:
+            # Experiments of a previous run have no samples
+            robustness = get_ranking_robustness(rmsd_samples)
+            i_units_cf = cf_units.Unit(flux_gates[0].varname_units)
+            o_units_cf = cf_units.Unit(v_o_units)
+            for name in ("rmsd_05", "rmsd_95"):
+                robustness[name] = i_units_cf.convert(robustness[name].values, o_units_cf)
+            for exp, row in robustness.sort_values("mean_rank").iterrows():
+                print(
+                    "Experiment {}: best in {:2.0f}% of {} samples, rank {:1.0f}-{:1.0f}".format(
+                        exp, 100 * row["p_best"], mc_samples, row["rank_05"], row["rank_95"]
+                    )
+                )
+            outname = ".".join(["ranking_robustness_{}".format(varname), "csv"])
+            print(("  - saving {0}".format(outname)))
+            robustness.to_csv(outname, float_format="%.4f")
+
+        if emulator_kind != "none":
+            print(("Fitting {} emulator to {}".format(emulator_kind, ", ".join(emulator_params))))
+            outputs = get_emulator_outputs(table, ranking)
+            experiments = [exp for exp in flux_gates[0].experiments if exp.id in outputs.index]
+            try:
+                X = get_parameter_matrix(experiments, emulator_params)
+            except ValueError as e:
+                print(("ERROR: {}, ending".format(e)))
+                import sys
+
+                sys.exit(1)
+            Y = outputs.loc[[exp.id for exp in experiments]].values
+            if emulator_kind == "polynomial":
+                emulator = PolynomialEmulator(degree=emulator_degree)
+            else:
+                emulator = GaussianProcessEmulator()
+            try:
+                emulator.fit(X, Y)
+            except ValueError as e:
+                print(("ERROR: {}, ending".format(e)))
+                import sys
+
+                sys.exit(1)
+            loo = emulator.loo_residuals()
+            objective = list(outputs.columns).index("rmsd")
             print(
-                "  Number of glaciers with r(all) > {}: {}".format(pearson_r_threshold_high, no_glaciers_above_threshold)
-            )
-            glaciers_above_threshold.append(no_glaciers_above_threshold)
-            print(
-                "  RMS difference {:4.0f}".format(
-                    np.sqrt(np.sum(df["rmsd"].values ** 2 * df["N"].values) * (1.0 / df["N"].values.sum()))
+                (
+                    "  leave-one-out RMS error of cumulative RMSD: {:4.0f}".format(
+                        np.sqrt(np.mean(loo[:, objective] ** 2))
+                    )
                 )
             )
-            print("  median(pearson r(all): {:1.2f}".format(df["correlation"].median()))
-            print("  median(pearson r(isbrae): {:1.2f}".format(df[df["flow_type"] == 0]["correlation"].median()))
-            print("  median(pearson r(ice-stream): {:1.2f}".format(df[df["flow_type"] == 1]["correlation"].median()))
-            print("  median(pearson r(undetermined): {:1.2f}".format(df[df["flow_type"] == 2]["correlation"].median()))
-
-        # Calculate cumulative values of rms differences of all glaciers together
-        rmsd_cum_dict = {}
-        rmsd_isbrae_cum_dict = {}
-        rmsd_ice_stream_cum_dict = {}
-        rmsd_undetermined_cum_dict = {}
-        keys = range(ne)
-        rmsd_cum = [
-            np.sqrt(np.sum(df["rmsd"].values ** 2 * df["N"].values) * (1.0 / df["N"].values.sum()))
-            for df in experiments_df
-        ]
-        rmsd_cum_dict = dict(zip(keys, rmsd_cum))
-
-        rmsd_isbrae_cum = [
-            np.sqrt(np.sum(df["rmsd"].values ** 2 * df["N"].values) * (1.0 / df["N"].values.sum()))
-            for df in experiments_isbrae_df
-        ]
-        rmsd_isbrae_cum_dict = dict(zip(keys, rmsd_isbrae_cum))
+            outname = ".".join(["emulator_{}".format(varname), "npz"])
+            print(("  - saving {0}".format(outname)))
+            emulator.save(
+                outname, params=np.array(emulator_params, dtype="str"), outputs=np.array(outputs.columns, dtype="str")
+            )
 
-        rmsd_ice_stream_cum = [
-            np.sqrt(np.sum(df["rmsd"].values ** 2 * df["N"].values) * (1.0 / df["N"].values.sum()))
-            for df in experiments_isbrae_df
-        ]
-        rmsd_ice_stream_cum_dict = dict(zip(keys, rmsd_isbrae_cum))
+            proposals, mean, std, ei = propose_experiments(emulator, X, Y, objective, n_proposals)
+            proposals = pa.DataFrame(proposals, columns=emulator_params)
+            proposals["rmsd"] = mean
+            proposals["rmsd_std"] = std
+            proposals["expected_improvement"] = ei
+            proposals.index.name = "proposal"
+            outname = ".".join(["proposals_{}".format(varname), "csv"])
+            print(("  - saving {0}".format(outname)))
+            proposals.to_csv(outname, float_format="%.4f")
 
-        rmsd_undetermined_cum = [
-            np.sqrt(np.sum(df["rmsd"].values ** 2 * df["N"].values) * (1.0 / df["N"].values.sum()))
-            for df in experiments_isbrae_df
-        ]
-        rmsd_undetermined_cum_dict = dict(zip(keys, rmsd_isbrae_cum))
-        rmsd_cum_dict_sorted = sorted(iter(rmsd_cum_dict.items()), key=operator.itemgetter(1))
+        rmsd_cum_dict_sorted = sorted(iter(ranking["rmsd"].items()), key=operator.itemgetter(1))
 
         outname = ".".join(["rmsd_sorted_{}".format(varname), "csv"])
         print(("  - saving {0}".format(outname)))
         export_csv_from_dict(outname, dict(rmsd_cum_dict_sorted), header="id,rmsd")
 
-        corr = [df["correlation"].median() for df in experiments_df]
-        corr_dict = dict(zip(keys, corr))
-        corr_dict_sorted = sorted(iter(corr_dict.items()), key=operator.itemgetter(1), reverse=True)
+        corr_dict_sorted = sorted(iter(ranking["correlation"].items()), key=operator.itemgetter(1), reverse=True)
 
         outname = ".".join(["pearson_r_sorted_{}".format(varname), "csv"])
         print(("  - saving {0}".format(outname)))
         export_csv_from_dict(outname, dict(corr_dict_sorted), header="id,correlation")
 
-        glaciers_dict = dict(zip(keys, glaciers_above_threshold))
-        glaciers_dict_sorted = sorted(iter(glaciers_dict.items()), key=operator.itemgetter(1), reverse=True)
+        glaciers_dict_sorted = sorted(iter(ranking["no_glaciers"].items()), key=operator.itemgetter(1), reverse=True)
 
         outname = ".".join(["glaciers_above_threshold_{}".format(varname), "csv"])
         print(("  - saving {0}".format(outname)))
         export_csv_from_dict(outname, dict(glaciers_dict_sorted), header="id,no_glaciers", fmt=["%i", "%i"])
 
+        # make a global regression figure
+        if do_regress:
+            make_regression(ranking, ranking_flow_type)
+    elif do_regress:
+        print("Regression plots need observations (--obs_file), skipping")
+
     gate = flux_gates[0]
-    # make a global regression figure
-    if do_regress:
-        make_regression()
 
     # Write results to shape file
     outname = "statistics.shp"
@@ -0,0 +1,117 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Flux gate analysis of ensembles of ice sheet model experiments.
+
+The scripts flux-gate-analysis.py, profile-analysis.py,
+sample-profiles.py and benchmark-flux-gates.py are front ends to this
+package. Settings are passed explicitly with an AnalysisConfig, e.g.
+
+>>> from fluxgates import AnalysisConfig, Ensemble
+>>> ensemble = Ensemble(files, "observations.nc", AnalysisConfig("velsurf_mag"))
+>>> ranking = ensemble.rank(by="glacier_type")
+"""
+
+from .config import (
+    VARIABLE_UNITS,
+    PARAMS_DICT,
+    VAR_NAME_DICT,
+    FLOW_TYPES,
+    GLACIER_TYPES,
+    AnalysisConfig,
+)
+from .stats import (
+    get_rmsd,
+    get_observed_values,
+    segment_sum,
+    segment_trapz,
+    get_segment_stats,
+    get_batch_stats,
+    get_sample_rmsd,
+    ObservationSampler,
+    get_ranking_robustness,
+    get_ensemble_percentiles,
+)
+from .profiles import ProfileLayout, PackedProfiles, read_rows, select_gates
+from .datasets import (
+    CONFIG_VARS,
+    Dataset,
+    get_experiment_config,
+    read_experiment_header,
+    parse_parameter_query,
+    ExperimentIndex,
+    ExperimentDataset,
+    ObservationsDataset,
+    ExperimentResult,
+    has_time_series,
+)
+from .gates import (
+    convert_flux,
+    LinearFit,
+    GateCatalog,
+    FluxGate,
+    FluxGateExperiment,
+    FluxGateObservations,
+    read_gate_catalog,
+    read_flux_gates,
+    calculate_batch_fluxes,
+    calculate_batch_observed_fluxes,
+    calculate_batch_envelopes,
+    calculate_observed_flux_intervals,
+    calculate_batch_stats,
+)
+from .reduce import (
+    reduce_experiment,
+    read_and_reduce,
+    reduce_experiments_mp,
+    get_file_hash,
+    ResultCache,
+    reduce_experiments,
+)
+from .ranking import (
+    get_ensemble_table,
+    rank_experiments,
+    export_ranking_csv,
+    get_objectives,
+    count_dominators,
+    non_dominated_sort,
+    crowding_distance,
+    get_pareto_fronts,
+    export_pareto_csv,
+)
+from .emulator import (
+    get_parameter_matrix,
+    get_emulator_outputs,
+    Emulator,
+    PolynomialEmulator,
+    GaussianProcessEmulator,
+    load_emulator,
+    get_expected_improvement,
+    propose_experiments,
+)
+from .results import (
+    write_results_file,
+    write_gate_metric,
+    write_gate_variables,
+    write_config_group,
+    write_timeseries_file,
+    read_results_file,
+    read_results_metadata,
+)
+from .sampling import (
+    PROFILE_FILL_VALUE,
+    NORMAL_COMPONENTS,
+    resample_line,
+    get_normals,
+    GateGeometry,
+    read_gate_lines,
+    get_grid_projection,
+    get_grid,
+    InterpolationOperator,
+    get_interpolation_operator,
+    get_grid_variables,
+    write_profile_header,
+    sample_profiles,
+    sample_profiles_mp,
+)
+from .ensemble import Ensemble
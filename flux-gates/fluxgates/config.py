@@ -0,0 +1,189 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Configuration of flux gate analyses.
+"""
+
+import copy
+
+
+# Output units of supported variables: flux type, units of profiles and
+# misfits, whether volume fluxes are converted to mass fluxes, and units
+# of line integrals. "_str" units are for matplotlib, "_tex" units for
+# LaTeX tables.
+VARIABLE_UNITS = {}
+for _names, _units in (
+    (
+        ("velsurf_mag", "velbase_mag", "velsurf_normal"),
+        {
+            "flux_type": "line flux",
+            "v_o_units": "m yr-1",
+            "v_o_units_str": "m yr$^\mathregular{{-1}}$",
+            "v_o_units_str_tex": "m\,yr$^{-1}$",
+            "vol_to_mass": False,
+            "v_flux_o_units": "km2 yr-1",
+            "v_flux_o_units_str": "km$^\mathregular{2}$ yr$^\mathregular{{-1}}$",
+            "v_flux_o_units_str_tex": "km$^2$\,yr$^{-1}$",
+        },
+    ),
+    (
+        ("flux_mag", "flux_normal"),
+        {
+            "flux_type": "mass flux",
+            "v_o_units": "km2 yr-1",
+            "v_o_units_str": "km$^\mathregular{2}$ yr$^\mathregular{{-1}}$",
+            "v_o_units_str_tex": "km$^2$\,yr$^{-1}$",
+            "vol_to_mass": True,
+            "v_flux_o_units": "Gt yr-1",
+            "v_flux_o_units_str": "Gt yr$^\mathregular{{-1}}$",
+            "v_flux_o_units_str_tex": "Gt\,yr$^{-1}$",
+        },
+    ),
+    (
+        ("thk", "thickness", "land_ice_thickness", "usurf", "surface", "surface_altitude"),
+        {
+            "flux_type": "area",
+            "v_o_units": "m",
+            "v_o_units_str": "m",
+            "v_o_units_str_tex": "m",
+            "vol_to_mass": False,
+            "v_flux_o_units": "km2",
+            "v_flux_o_units_str": "km$^\mathregular{2}$",
+            "v_flux_o_units_str_tex": "km$^2$",
+        },
+    ),
+):
+    for _name in _names:
+        VARIABLE_UNITS[_name] = _units
+
+# Abbreviations and formats of experiment parameters in legends and tables
+PARAMS_DICT = {
+    "dem": {"abbr": "DEM", "format": "{}"},
+    "bed": {"abbr": "bed", "format": "{}"},
+    "surface.pdd.factor_ice": {"abbr": "$f_{\mathregular{i}}$", "format": "{:1.0f}"},
+    "surface.pdd.factor_snow": {"abbr": "$f_{\mathregular{s}}$", "format": "{:1.0f}"},
+    "basal_resistance.pseudo_plastic.q": {"abbr": "$q$", "format": "{:1.2f}"},
+    "basal_yield_stress.mohr_coulomb.till_effective_fraction_overburden": {"abbr": "$\\delta$", "format": "{:1.4f}"},
+    "stress_balance.sia.enhancement_factor": {"abbr": "$E_{\mathregular{SIA}}$", "format": "{:1.2f}"},
+    "stress_balance.ssa.enhancement_factor": {"abbr": "$E_{\mathregular{SSA}}$", "format": "{:1.2f}"},
+    "stress_balance.ssa.Glen_exponent": {"abbr": "$n_{\mathregular{SSA}}$", "format": "{:1.2f}"},
+    "stress_balance.sia.Glen_exponent": {"abbr": "$n_{\mathregular{SIA}}$", "format": "{:1.2f}"},
+    "grid_dx_meters": {"abbr": "ds", "format": "{:.0f}"},
+    "flow_law.gpbld.water_frac_observed_limit": {"abbr": "$\omega$", "format": "{:1.2}"},
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.phi_min": {"abbr": "$\phi_{\mathregular{min}}$", "format": "{:4.2f}"},
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.phi_max": {"abbr": "$\phi_{\mathregular{max}}$", "format": "{:4.2f}"},
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.topg_min": {"abbr": "$z_{\mathregular{min}}$", "format": "{:1.0f}"},
+    "basal_yield_stress.mohr_coulomb.topg_to_phi.topg_max": {"abbr": "$z_{\mathregular{max}}$", "format": "{:1.0f}"},
+}
+
+# Short names of variables in axis labels
+VAR_NAME_DICT = {
+    "velsurf_mag": "speed",
+    "velbase_mag": "sliding speed",
+    "velsurf_normal": "speed",
+    "flux_mag": "flux",
+    "flux_normal": "flux",
+    "surface": "altitude",
+    "usurf": "altitude",
+    "surface_altitude": "altitude",
+    "thk": "ice thickness",
+    "thickness": "ice thickness",
+    "land_ice_thickness": "ice thickness",
+}
+
+FLOW_TYPES = {0: "isbr{\\ae}", 1: "ice-stream", 2: "undefined"}
+GLACIER_TYPES = {0: "ffmt", 1: "lvmt", 2: "ist", 3: "lt"}
+
+
+class AnalysisConfig(object):
+
+    """
+    Settings of a flux gate analysis.
+
+    Output units follow from the variable, see VARIABLE_UNITS. A config
+    is attached to every FluxGate and travels with it to worker
+    processes, so analyses do not depend on module globals.
+
+    Parameters
+    ----------
+    varname: string, variable name
+    label_params: list of parameters that appear in legends
+    legend: string, legend style of profile figures
+    normalize: bool, normalize experiments by max(obs)/max(experiment) in figures
+    ice_density_units: string, density used to convert volume to mass fluxes
+    profile_axis_out_units: string, udunits unit of profile axes in figures
+    pearson_r_threshold_high, pearson_r_threshold_low: float, correlation thresholds
+    params_dict: dict, abbreviations and formats of parameters, default PARAMS_DICT
+
+    """
+
+    def __init__(
+        self,
+        varname="velsurf_mag",
+        label_params=None,
+        legend="default",
+        normalize=False,
+        ice_density_units="910 kg m-3",
+        profile_axis_out_units="km",
+        pearson_r_threshold_high=0.85,
+        pearson_r_threshold_low=0.50,
+        params_dict=None,
+        *args,
+        **kwargs
+    ):
+        super(AnalysisConfig, self).__init__(*args, **kwargs)
+        if varname not in VARIABLE_UNITS:
+            raise ValueError("variable {} not supported".format(varname))
+        self.varname = varname
+        self.label_params = list(label_params or [])
+        self.legend = legend
+        self.normalize = normalize
+        self.ice_density_units = ice_density_units
+        self.profile_axis_out_units = profile_axis_out_units
+        self.pearson_r_threshold_high = pearson_r_threshold_high
+        self.pearson_r_threshold_low = pearson_r_threshold_low
+        if params_dict is None:
+            params_dict = copy.deepcopy(PARAMS_DICT)
+        self.params_dict = params_dict
+        self.var_name_dict = dict(VAR_NAME_DICT)
+        self.flow_types = dict(FLOW_TYPES)
+        self.glacier_types = dict(GLACIER_TYPES)
+        for key, value in list(VARIABLE_UNITS[varname].items()):
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return "AnalysisConfig"
+
+    def get_flux_settings(self):
+        """
+        Return the settings fluxes depend on, e.g. as cache context
+        """
+
+        return {
+            "vol_to_mass": self.vol_to_mass,
+            "ice_density_units": self.ice_density_units,
+            "v_flux_o_units": self.v_flux_o_units,
+        }
+
+    def get_label(self, config, params=None):
+        """
+        Return a label of an experiment from its parameters
+
+        Parameters
+        ----------
+        config: dict, parameters of the experiment
+        params: list of parameters, default label_params
+
+        Returns
+        -------
+        label : string, e.g. "$q$=0.25, $E_{\mathregular{SIA}}$=1.25"
+        """
+
+        if params is None:
+            params = self.label_params
+        return ", ".join(
+            [
+                "=".join([self.params_dict[key]["abbr"], self.params_dict[key]["format"].format(config.get(key))])
+                for key in params
+            ]
+        )
@@ -0,0 +1,403 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Experiment and observation files.
+"""
+
+import os
+import re
+import sqlite3
+import multiprocessing as mp
+import numpy as np
+from netCDF4 import Dataset as NC
+
+from .profiles import read_rows
+
+
+# Variables whose attributes hold the parameters of an experiment:
+# PISM runs have pism_config and run_stats, profiles of DEMs have config
+CONFIG_VARS = ["pism_config", "run_stats", "config"]
+
+
+class Dataset(object):
+
+    """
+    A base class for Experiments or Observations.
+
+    Constructor opens netCDF file, attaches pointer to nc instance.
+    If a ProfileLayout is given, only its rows are read and values
+    are packed.
+
+    """
+
+    def __init__(self, filename, varname, layout=None, *args, **kwargs):
+        super(Dataset, self).__init__(*args, **kwargs)
+        print(("  opening NetCDF file %s ..." % filename))
+        try:
+            nc = NC(filename, "r")
+        except:
+            print(("ERROR:  file '%s' not found or not NetCDF format ... ending ..." % filename))
+            import sys
+
+            sys.exit(1)
+
+        for name in nc.variables:
+            v = nc.variables[name]
+            if getattr(v, "standard_name", "") == varname:
+                print(("variabe {0} found by its standard_name {1}".format(name, varname)))
+                varname = name
+
+        rows = None
+        if layout is not None:
+            rows = layout.rows
+        self.values = read_rows(nc.variables[varname], rows)
+        if layout is not None:
+            self.values = layout.pack(self.values)
+        self.varname_units = nc.variables[varname].units
+        self.varname = varname
+        self.time = None
+        self.time_units = None
+        self.time_calendar = None
+        if "time" in nc.variables[varname].dimensions and "time" in nc.variables:
+            time = nc.variables["time"]
+            self.time = np.array(time[:], dtype="float64")
+            self.time_units = time.units
+            self.time_calendar = getattr(time, "calendar", "standard")
+        self.layout = layout
+        self.nc = nc
+
+    def __repr__(self):
+        return "Dataset"
+
+    def close(self):
+        """
+        Close open file and release values
+        """
+
+        if getattr(self, "nc", None) is not None:
+            self.nc.close()
+            self.nc = None
+        self.values = None
+
+    def __del__(self):
+        # Close open file
+        self.close()
+
+
+def get_experiment_config(nc):
+    """
+    Return the parameters of an experiment as a dictionary.
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset of an experiment
+
+    Returns
+    -------
+    config: dict of CONFIG_VARS attributes
+    """
+
+    config = dict()
+    config_vars = [v for v in CONFIG_VARS if v in nc.variables]
+    if not config_vars:
+        print("None of the variables {} found".format(", ".join(CONFIG_VARS)))
+    for v in config_vars:
+        ncv = nc.variables[v]
+        for attr in ncv.ncattrs():
+            config[attr] = getattr(ncv, attr)
+    return config
+
+
+def read_experiment_header(filename):
+    """
+    Return the file name and parameters of an experiment file
+    """
+
+    nc = NC(filename, "r")
+    config = get_experiment_config(nc)
+    nc.close()
+    return filename, config
+
+
+def parse_parameter_query(query):
+    """
+    Parse a parameter query.
+
+    A query is a comma-separated list of conditions "key<op>value",
+    where op is one of =, ==, !=, <, <=, >, >=, e.g.
+    "stress_balance.sia.enhancement_factor>=1.5,grid_dx_meters=900".
+    All conditions have to be met.
+
+    Parameters
+    ----------
+    query: string
+
+    Returns
+    -------
+    conditions: list of (key, op, value), value is float if numeric
+    """
+
+    conditions = []
+    for condition in query.split(","):
+        match = re.match(r"^\s*([^<>=!\s]+)\s*(==|=|!=|<=|>=|<|>)\s*(.*?)\s*$", condition)
+        if match is None:
+            raise ValueError("invalid parameter condition '{}'".format(condition))
+        key, op, value = match.groups()
+        if op == "==":
+            op = "="
+        try:
+            value = float(value)
+        except ValueError:
+            if op not in ("=", "!="):
+                raise ValueError("parameter condition '{}' needs a number".format(condition))
+        conditions.append((key, op, value))
+    return conditions
+
+
+class ExperimentIndex(object):
+
+    """
+    Persistent index of experiment parameters.
+
+    The parameters of experiment files are kept in a SQLite database, so
+    experiments can be selected by parameter without opening every file.
+    Files are only read if they are new or their modification time or
+    size has changed.
+
+    Parameters
+    ----------
+    filename: string, SQLite database file
+
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        super(ExperimentIndex, self).__init__(*args, **kwargs)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS params (path TEXT, key TEXT, num REAL, text TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS params_path ON params (path)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS params_key ON params (key, num)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'config_vars'").fetchone()
+        if row is None or row[0] != repr(CONFIG_VARS):
+            # Parameters were indexed from other variables, start over
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM params")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('config_vars', ?)", (repr(CONFIG_VARS),))
+        self.db.commit()
+
+    def __repr__(self):
+        return "ExperimentIndex"
+
+    def update(self, filenames, n_procs=1):
+        """
+        Add new and changed experiment files to the index
+
+        Parameters
+        ----------
+        filenames: list of experiment files
+        n_procs: int, number of processes to read files
+        """
+
+        stats = {}
+        for filename in filenames:
+            st = os.stat(filename)
+            stats[os.path.abspath(filename)] = (st.st_mtime, st.st_size)
+        known = dict(
+            (path, (mtime, size)) for path, mtime, size in self.db.execute("SELECT path, mtime, size FROM files")
+        )
+        stale = [path for path in stats if known.get(path) != stats[path]]
+        if n_procs > 1 and len(stale) > 1:
+            pool = mp.Pool(processes=n_procs)
+            try:
+                headers = pool.map(read_experiment_header, stale)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            headers = [read_experiment_header(path) for path in stale]
+        with self.db:
+            for path, config in headers:
+                self.db.execute("DELETE FROM params WHERE path = ?", (path,))
+                rows = []
+                for key, value in list(config.items()):
+                    num = None
+                    if np.size(value) == 1:
+                        value = np.asarray(value).ravel()[0]
+                        if isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_)):
+                            num = float(value)
+                    rows.append((path, key, num, str(value)))
+                self.db.executemany("INSERT INTO params VALUES (?, ?, ?, ?)", rows)
+                mtime, size = stats[path]
+                self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, mtime, size))
+        print(("  indexed {} of {} experiment files in {}".format(len(stale), len(stats), self.filename)))
+
+    def select(self, filenames, query):
+        """
+        Return experiment files whose parameters match a query
+
+        Parameters
+        ----------
+        filenames: list of indexed experiment files
+        query: string, see parse_parameter_query
+
+        Returns
+        -------
+        filenames: list of matching experiment files, in the given order
+        """
+
+        clauses = []
+        values = []
+        for key, op, value in parse_parameter_query(query):
+            column = "num" if isinstance(value, float) else "text"
+            clauses.append(
+                "path IN (SELECT path FROM params WHERE key = ? AND {} {} ?)".format(column, op)
+            )
+            values.extend([key, value])
+        sql = " ".join(["SELECT path FROM files WHERE", " AND ".join(clauses)])
+        matching = set([path for (path,) in self.db.execute(sql, values)])
+        return [filename for filename in filenames if os.path.abspath(filename) in matching]
+
+    def close(self):
+        """
+        Close database
+        """
+
+        self.db.close()
+
+
+class ExperimentDataset(Dataset):
+
+    """
+    A derived class for experiments
+
+    A derived class for handling PISM experiments.
+
+    Experiments are identified by id. Config and run_stats
+    attributes are attached to object as config dictionary.
+
+    """
+
+    def __init__(self, id, *args, **kwargs):
+        super(ExperimentDataset, self).__init__(*args, **kwargs)
+
+        print("Experiment {}".format(id))
+        self.id = id
+        self.config = get_experiment_config(self.nc)
+
+    def __repr__(self):
+        return "ExperimentDataset"
+
+
+class ObservationsDataset(Dataset):
+
+    """
+    A derived class for observations.
+
+    A derived class for handling observations.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ObservationsDataset, self).__init__(*args, **kwargs)
+        self.has_error = None
+        rows = None
+        if self.layout is not None:
+            rows = self.layout.rows
+        try:
+            self.clon = read_rows(self.nc.variables["clon"], rows)
+        except:
+            self.clon = None
+        try:
+            self.clat = read_rows(self.nc.variables["clat"], rows)
+        except:
+            self.clat = None
+        try:
+            self.flightline = read_rows(self.nc.variables["flightline"], rows)
+        except:
+            self.flightline = None
+        try:
+            self.glaciertype = read_rows(self.nc.variables["glaciertype"], rows)
+        except:
+            self.glaciertype = None
+        try:
+            self.flowtype = read_rows(self.nc.variables["flowtype"], rows)
+        except:
+            self.flowtype = None
+        varname = self.varname
+        error_varname = "_".join([varname, "error"])
+        if error_varname in list(self.nc.variables.keys()):
+            self.error = read_rows(self.nc.variables[error_varname], rows)
+            if self.layout is not None:
+                self.error = self.layout.pack(self.error)
+            self.has_error = True
+        # Attributes of the variable "config" describe the observations, e.g. the DEM
+        self.config = dict()
+        if "config" in self.nc.variables:
+            ncv = self.nc.variables["config"]
+            for attr in ncv.ncattrs():
+                self.config[attr] = getattr(ncv, attr)
+
+    def __repr__(self):
+        return "ObservationsDataset"
+
+
+class ExperimentResult(object):
+
+    """
+    Per-gate fluxes and misfit statistics of an experiment.
+
+    A compact record of an experiment that has been reduced right after
+    reading it. Profiles are only retained on request.
+
+    Parameters
+    ----------
+    id: int, experiment id
+    config: dict, pism_config and run_stats attributes
+    varname: string, variable name
+    varname_units: string, udunits unit of variable
+    fluxes: 1-d array, flux through each gate in output units
+    stats: dict of 1-d arrays as returned by get_batch_stats or None
+    values: array of profiles, only retained if needed for figures
+
+    For transient experiments, fluxes and stats have shape (time, gate)
+    and time, time_units and time_calendar describe the time axis.
+    With Monte Carlo error propagation, rmsd_samples holds the
+    cumulative RMSD from every perturbed observation.
+
+    """
+
+    def __init__(self, id, config, varname, varname_units, fluxes, stats=None, values=None, *args, **kwargs):
+        super(ExperimentResult, self).__init__(*args, **kwargs)
+        self.id = id
+        self.config = config
+        self.varname = varname
+        self.varname_units = varname_units
+        self.fluxes = fluxes
+        self.stats = stats
+        self.values = values
+        self.time = None
+        self.time_units = None
+        self.time_calendar = None
+        self.rmsd_samples = None
+
+    def __repr__(self):
+        return "ExperimentResult"
+
+
+def has_time_series(nc, varname):
+    """
+    Return True if varname has a time dimension with more than one record.
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset with profiles
+    varname: string, variable name or standard_name
+    """
+
+    for name in nc.variables:
+        if getattr(nc.variables[name], "standard_name", "") == varname:
+            varname = name
+    dims = nc.variables[varname].dimensions
+    return "time" in dims and len(nc.dimensions["time"]) > 1
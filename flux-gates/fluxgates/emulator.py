@@ -0,0 +1,388 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Surrogates of experiment outputs as functions of experiment parameters.
+"""
+
+import math
+import itertools
+import numpy as np
+import pandas as pa
+
+
+def get_parameter_matrix(experiments, params):
+    """
+    Return the values of parameters of all experiments.
+
+    Parameters
+    ----------
+    experiments: list of experiments with config dictionaries
+    params: list of parameter names
+
+    Returns
+    -------
+    X : 2-d array (n_experiments, n_params)
+    """
+
+    X = np.zeros((len(experiments), len(params)))
+    for k, exp in enumerate(experiments):
+        for m, param in enumerate(params):
+            value = exp.config.get(param)
+            try:
+                X[k, m] = float(np.asarray(value).ravel()[0])
+            except (TypeError, ValueError, IndexError):
+                raise ValueError("parameter {} of experiment {} is not a number".format(param, exp.id))
+    return X
+
+
+def get_emulator_outputs(table, ranking):
+    """
+    Return the outputs to emulate for all experiments.
+
+    Outputs are the flux and the RMSD of every gate, and the cumulative
+    RMSD of the ranking. Outputs with missing values are dropped.
+
+    Parameters
+    ----------
+    table: pandas.DataFrame as returned by get_ensemble_table
+    ranking: pandas.DataFrame as returned by rank_experiments
+
+    Returns
+    -------
+    outputs : pandas.DataFrame indexed by experiment
+    """
+
+    outputs = pa.concat(
+        [
+            table.pivot(index="experiment", columns="gate", values="flux").add_prefix("flux_"),
+            table.pivot(index="experiment", columns="gate", values="rmsd").add_prefix("rmsd_"),
+            ranking[["rmsd"]],
+        ],
+        axis=1,
+    )
+    return outputs.dropna(axis=1)
+
+
+class Emulator(object):
+
+    """
+    A base class for surrogates of experiment outputs.
+
+    Parameters are scaled to [-1, 1] over the range of the training
+    experiments. All outputs are fitted at once.
+
+    """
+
+    kind = None
+
+    def __init__(self, *args, **kwargs):
+        super(Emulator, self).__init__(*args, **kwargs)
+        self.lower = None
+        self.upper = None
+
+    def __repr__(self):
+        return "Emulator"
+
+    def _scale(self, X):
+        span = np.where(self.upper > self.lower, self.upper - self.lower, 1.0)
+        return 2.0 * (np.atleast_2d(X) - self.lower) / span - 1.0
+
+    def fit(self, X, Y):
+        """
+        Fit the emulator, including its hyperparameters
+
+        Parameters
+        ----------
+        X: 2-d array (n_experiments, n_params), parameters
+        Y: 2-d array (n_experiments, n_outputs), outputs
+
+        Returns
+        -------
+        self
+        """
+
+        self.lower = X.min(axis=0)
+        self.upper = X.max(axis=0)
+        return self.update(X, Y)
+
+    def update(self, X, Y):
+        """
+        Refit to new data, keeping scaling and hyperparameters
+        """
+
+        raise NotImplementedError
+
+    def predict(self, X, return_std=False):
+        """
+        Predict outputs
+
+        Parameters
+        ----------
+        X: 2-d array (n_points, n_params), parameters
+        return_std: bool, also return the standard deviation of the prediction
+
+        Returns
+        -------
+        mean : 2-d array (n_points, n_outputs)
+        std : 2-d array (n_points, n_outputs), if return_std
+        """
+
+        raise NotImplementedError
+
+    def loo_residuals(self):
+        """
+        Return leave-one-out residuals of the training experiments
+        """
+
+        raise NotImplementedError
+
+    def get_state(self):
+        """
+        Return a dict of arrays that describes the fitted emulator
+        """
+
+        return dict(
+            (key, val) for key, val in list(self.__dict__.items()) if isinstance(val, (np.ndarray, int, float))
+        )
+
+    def save(self, filename, **kwargs):
+        """
+        Save the fitted emulator and additional arrays to a .npz file
+        """
+
+        np.savez(filename, kind=self.kind, **dict(self.get_state(), **kwargs))
+
+
+class PolynomialEmulator(Emulator):
+
+    """
+    A polynomial chaos surrogate.
+
+    Outputs are expanded in products of Legendre polynomials of the
+    scaled parameters up to a total degree, fitted by least squares.
+
+    Parameters
+    ----------
+    degree: int, total polynomial degree
+
+    """
+
+    kind = "polynomial"
+
+    def __init__(self, degree=2, *args, **kwargs):
+        super(PolynomialEmulator, self).__init__(*args, **kwargs)
+        self.degree = degree
+        self.indexes = None
+        self.coef = None
+        self.sigma2 = None
+        self.cov = None
+        self.residuals = None
+
+    def __repr__(self):
+        return "PolynomialEmulator"
+
+    def _basis(self, X):
+        Xs = self._scale(X)
+        V = np.polynomial.legendre.legvander(Xs, self.degree)
+        # V has shape (n_points, n_params, degree + 1)
+        return np.prod(V[:, np.arange(Xs.shape[1]), self.indexes], axis=-1)
+
+    def update(self, X, Y):
+        n_params = X.shape[1]
+        indexes = [
+            index for index in itertools.product(range(self.degree + 1), repeat=n_params) if sum(index) <= self.degree
+        ]
+        self.indexes = np.array(indexes, dtype="int")
+        B = self._basis(X)
+        if len(X) <= B.shape[1]:
+            raise ValueError(
+                "{} experiments are too few for {} polynomial terms of degree {}".format(
+                    len(X), B.shape[1], self.degree
+                )
+            )
+        self.coef, _, _, _ = np.linalg.lstsq(B, Y, rcond=None)
+        residuals = Y - B.dot(self.coef)
+        self.sigma2 = np.sum(residuals ** 2, axis=0) / (len(X) - B.shape[1])
+        self.cov = np.linalg.pinv(B.T.dot(B))
+        leverage = np.einsum("ij,jk,ik->i", B, self.cov, B)
+        self.residuals = residuals / (1 - np.minimum(leverage, 1 - 1e-12))[:, np.newaxis]
+        return self
+
+    def predict(self, X, return_std=False):
+        B = self._basis(X)
+        mean = B.dot(self.coef)
+        if not return_std:
+            return mean
+        leverage = np.einsum("ij,jk,ik->i", B, self.cov, B)
+        return mean, np.sqrt(np.outer(leverage, self.sigma2))
+
+    def loo_residuals(self):
+        return self.residuals
+
+
+class GaussianProcessEmulator(Emulator):
+
+    """
+    A Gaussian process surrogate.
+
+    Outputs are standardized and share a squared exponential kernel.
+    The length scale and noise level maximize the summed log marginal
+    likelihood of all outputs over a grid of candidates.
+
+    Parameters
+    ----------
+    length_scales: list of candidate length scales of the scaled parameters
+    noise_levels: list of candidate noise variances of standardized outputs
+
+    """
+
+    kind = "gp"
+
+    def __init__(self, length_scales=None, noise_levels=None, *args, **kwargs):
+        super(GaussianProcessEmulator, self).__init__(*args, **kwargs)
+        if length_scales is None:
+            length_scales = [0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+        if noise_levels is None:
+            noise_levels = [1e-4, 1e-3, 1e-2, 1e-1, 1.0]
+        self.length_scales = length_scales
+        self.noise_levels = noise_levels
+        self.length_scale = None
+        self.noise = None
+        self.X_train = None
+        self.y_mean = None
+        self.y_std = None
+        self.alpha = None
+        self.L = None
+
+    def __repr__(self):
+        return "GaussianProcessEmulator"
+
+    def _kernel(self, A, B, length_scale):
+        d2 = np.sum((A[:, np.newaxis, :] - B[np.newaxis, :, :]) ** 2, axis=-1)
+        return np.exp(-0.5 * d2 / length_scale ** 2)
+
+    def _solve(self, Xs, Ys, length_scale, noise):
+        K = self._kernel(Xs, Xs, length_scale) + noise * np.eye(len(Xs))
+        L = np.linalg.cholesky(K)
+        alpha = np.linalg.solve(L.T, np.linalg.solve(L, Ys))
+        lml = -0.5 * np.sum(Ys * alpha) - Ys.shape[1] * np.sum(np.log(np.diag(L)))
+        return L, alpha, lml
+
+    def fit(self, X, Y):
+        self.lower = X.min(axis=0)
+        self.upper = X.max(axis=0)
+        self.length_scale = None
+        self.noise = None
+        return self.update(X, Y)
+
+    def update(self, X, Y):
+        self.X_train = self._scale(X)
+        self.y_mean = Y.mean(axis=0)
+        self.y_std = np.where(Y.std(axis=0) > 0, Y.std(axis=0), 1.0)
+        Ys = (Y - self.y_mean) / self.y_std
+        if self.length_scale is None:
+            best = None
+            for length_scale, noise in itertools.product(self.length_scales, self.noise_levels):
+                try:
+                    L, alpha, lml = self._solve(self.X_train, Ys, length_scale, noise)
+                except np.linalg.LinAlgError:
+                    continue
+                if best is None or lml > best[0]:
+                    best = (lml, length_scale, noise)
+            self.length_scale, self.noise = best[1], best[2]
+        self.L, self.alpha, lml = self._solve(self.X_train, Ys, self.length_scale, self.noise)
+        return self
+
+    def predict(self, X, return_std=False):
+        Ks = self._kernel(self._scale(X), self.X_train, self.length_scale)
+        mean = Ks.dot(self.alpha) * self.y_std + self.y_mean
+        if not return_std:
+            return mean
+        v = np.linalg.solve(self.L, Ks.T)
+        var = np.maximum(1.0 - np.sum(v ** 2, axis=0), 0)
+        return mean, np.sqrt(np.outer(var, self.y_std ** 2))
+
+    def loo_residuals(self):
+        # closed form, Rasmussen and Williams (2006), eq. 5.12
+        K_inv = np.linalg.solve(self.L.T, np.linalg.solve(self.L, np.eye(len(self.L))))
+        return self.alpha / np.diag(K_inv)[:, np.newaxis] * self.y_std
+
+
+def load_emulator(filename):
+    """
+    Load an emulator saved with Emulator.save
+
+    Returns
+    -------
+    emulator: Emulator
+    arrays: dict of the additional arrays
+    """
+
+    data = dict(np.load(filename, allow_pickle=False))
+    kind = str(data.pop("kind"))
+    emulator = {"polynomial": PolynomialEmulator, "gp": GaussianProcessEmulator}[kind]()
+    state = {}
+    for key in list(data.keys()):
+        if key in emulator.__dict__:
+            value = data.pop(key)
+            state[key] = value[()] if value.ndim == 0 else value
+    emulator.__dict__.update(state)
+    return emulator, data
+
+
+def get_expected_improvement(mean, std, best):
+    """
+    Returns the expected improvement below best of normally distributed predictions
+    """
+
+    erf = np.frompyfunc(math.erf, 1, 1)
+    with np.errstate(all="ignore"):
+        z = np.where(std > 0, (best - mean) / std, 0)
+        cdf = 0.5 * (1 + erf(z / np.sqrt(2)).astype("float64"))
+        pdf = np.exp(-0.5 * z ** 2) / np.sqrt(2 * np.pi)
+        return np.where(std > 0, (best - mean) * cdf + std * pdf, np.maximum(best - mean, 0))
+
+
+def propose_experiments(emulator, X, Y, objective, n_proposals, n_candidates=10000, seed=0):
+    """
+    Propose parameters of the next experiments.
+
+    Candidates are drawn uniformly within the range of the tested
+    parameters and the one with the largest expected improvement of the
+    objective is chosen. For more proposals, the emulator is updated in
+    place with the predicted outputs at the chosen parameters ("kriging
+    believer"), which lowers the expected improvement near them.
+
+    Parameters
+    ----------
+    emulator: fitted Emulator
+    X: 2-d array (n_experiments, n_params), tested parameters
+    Y: 2-d array (n_experiments, n_outputs), outputs of tested experiments
+    objective: int, output column to minimize
+    n_proposals: int
+    n_candidates: int
+    seed: int, seed of the random number generator
+
+    Returns
+    -------
+    proposals : 2-d array (n_proposals, n_params)
+    mean, std, ei : 1-d arrays (n_proposals), predicted objective and expected improvement
+    """
+
+    rng = np.random.default_rng(seed)
+    candidates = emulator.lower + rng.random((n_candidates, X.shape[1])) * (emulator.upper - emulator.lower)
+    best = np.min(Y[:, objective])
+    proposals, means, stds, eis = [], [], [], []
+    for k in range(n_proposals):
+        mean, std = emulator.predict(candidates, return_std=True)
+        ei = get_expected_improvement(mean[:, objective], std[:, objective], best)
+        m = np.argmax(ei)
+        proposals.append(candidates[m])
+        means.append(mean[m, objective])
+        stds.append(std[m, objective])
+        eis.append(ei[m])
+        X = np.vstack([X, candidates[m]])
+        Y = np.vstack([Y, mean[m]])
+        candidates = np.delete(candidates, m, axis=0)
+        emulator.update(X, Y)
+    return np.array(proposals), np.array(means), np.array(stds), np.array(eis)
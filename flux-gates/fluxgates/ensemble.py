@@ -0,0 +1,143 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+An ensemble of experiments reduced at flux gates.
+"""
+
+from netCDF4 import Dataset as NC
+
+from .config import AnalysisConfig
+from .datasets import ObservationsDataset
+from .gates import read_flux_gates, calculate_batch_envelopes
+from .profiles import select_gates
+from .ranking import get_ensemble_table, rank_experiments, get_pareto_fronts
+from .reduce import reduce_experiments
+from .results import write_results_file
+from .stats import get_observed_values
+
+
+class Ensemble(object):
+
+    """
+    An ensemble of experiments, read and reduced once.
+
+    Meant for long-running processes and notebooks: all experiments are
+    reduced to per-gate fluxes and statistics on construction, after
+    which any number of tables and rankings are made in-process, e.g.
+
+    >>> ensemble = Ensemble(files, "observations.nc", AnalysisConfig("velsurf_mag"))
+    >>> ensemble.rank(by="flow_type")
+
+    Parameters
+    ----------
+    experiment_files: list of experiment files, all with the same profiles
+    obs_file: string, profile file with observations, or None
+    analysis_config: AnalysisConfig, default is AnalysisConfig()
+    gates: string, gate selector (see select_gates) or None for all gates
+    keep_values: bool, retain profiles, e.g. for envelopes
+    n_procs: int, number of processes to read experiments
+    cache: ResultCache or None
+
+    """
+
+    def __init__(
+        self,
+        experiment_files,
+        obs_file=None,
+        analysis_config=None,
+        gates=None,
+        keep_values=False,
+        n_procs=1,
+        cache=None,
+        *args,
+        **kwargs
+    ):
+        super(Ensemble, self).__init__(*args, **kwargs)
+        if analysis_config is None:
+            analysis_config = AnalysisConfig()
+        self.analysis_config = analysis_config
+        self.experiment_files = list(experiment_files)
+        self.obs_file = obs_file
+        varname = analysis_config.varname
+
+        nc = NC(self.experiment_files[0], "r")
+        rows = None
+        if gates:
+            rows = select_gates(nc, gates)
+        self.flux_gates, self.layout = read_flux_gates(nc, rows, analysis_config)
+        nc.close()
+
+        obs_vals = None
+        obs_error = None
+        if obs_file:
+            obs = ObservationsDataset(obs_file, varname, layout=self.layout)
+            for gate in self.flux_gates:
+                gate.add_observations(obs)
+            obs_vals = get_observed_values(obs.values.data).reshape(self.layout.axis.data.shape)
+            if obs.has_error:
+                obs_error = obs.error.data.reshape(self.layout.axis.data.shape)
+
+        results = reduce_experiments(
+            self.experiment_files,
+            self.flux_gates,
+            self.layout,
+            varname,
+            obs_vals=obs_vals,
+            keep_values=keep_values,
+            n_procs=n_procs,
+            cache=cache,
+            obs_error=obs_error,
+        )
+        for result in results:
+            for m, gate in enumerate(self.flux_gates):
+                gate.add_experiment_result(result, m)
+        for gate in self.flux_gates:
+            gate.finalize_results()
+        if keep_values:
+            calculate_batch_envelopes(self.flux_gates)
+        self._table = None
+
+    def __repr__(self):
+        return "Ensemble"
+
+    def __len__(self):
+        return len(self.flux_gates[0].experiments)
+
+    def get_table(self):
+        """
+        Return statistics of all experiments and gates, see get_ensemble_table
+        """
+
+        if self._table is None:
+            self._table = get_ensemble_table(self.flux_gates)
+        return self._table
+
+    def rank(self, by=None, threshold=None):
+        """
+        Rank experiments, see rank_experiments
+
+        Parameters
+        ----------
+        by: column name to group gates by, e.g. "flow_type", or None
+        threshold: float, correlation threshold, default pearson_r_threshold_high
+        """
+
+        if threshold is None:
+            threshold = self.analysis_config.pearson_r_threshold_high
+        return rank_experiments(self.get_table(), by=by, threshold=threshold)
+
+    def get_pareto(self, threshold=None):
+        """
+        Return the Pareto fronts of all experiments, see get_pareto_fronts
+        """
+
+        if threshold is None:
+            threshold = self.analysis_config.pearson_r_threshold_high
+        return get_pareto_fronts(self.get_table(), threshold=threshold)
+
+    def write_results_file(self, filename):
+        """
+        Write fluxes and statistics to a netCDF file, see write_results_file
+        """
+
+        write_results_file(filename, self.flux_gates, experiment_files=self.experiment_files)
@@ -0,0 +1,1083 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Flux gates and their experiments and observations.
+"""
+
+import numpy as np
+from unidecode import unidecode
+import cf_units
+
+from .config import AnalysisConfig
+from .profiles import ProfileLayout, PackedProfiles, read_rows
+from .stats import (
+    get_rmsd,
+    get_observed_values,
+    segment_trapz,
+    get_segment_stats,
+    get_batch_stats,
+    get_ensemble_percentiles,
+)
+
+
+def convert_flux(int_val, x_units, y_units, analysis_config):
+    """
+    Returns line integrals converted to flux output units
+
+    Parameters
+    ----------
+    int_val: float or array_like, line integral(s) of y along x
+    x_units: string, udunits unit of x
+    y_units: string, udunits unit of y
+    analysis_config: AnalysisConfig
+
+    Returns
+    -------
+    flux : float or array
+    """
+
+    # Here we need to directly access udunits2 since we want to
+    # multiply units
+    if analysis_config.vol_to_mass:
+        i_units = (
+            cf_units.Unit(x_units) * cf_units.Unit(y_units) * cf_units.Unit(analysis_config.ice_density_units)
+        )
+    else:
+        i_units = cf_units.Unit(x_units) * cf_units.Unit(y_units)
+    o_units = cf_units.Unit(analysis_config.v_flux_o_units)
+    return i_units.convert(int_val, o_units)
+
+
+class LinearFit(object):
+
+    """
+    Ordinary least squares fit of experiment on observed values.
+
+    Lightweight replacement for a statsmodels regression result, which
+    only carries the attributes used in the analysis.
+
+    Parameters
+    ----------
+    intercept: float, intercept
+    slope: float, slope
+    rsquared: float, coefficient of determination
+    nobs: int, number of observations
+
+    """
+
+    def __init__(self, intercept, slope, rsquared, nobs, *args, **kwargs):
+        super(LinearFit, self).__init__(*args, **kwargs)
+        self.params = np.array([intercept, slope], dtype="float64")
+        self.rsquared = float(rsquared)
+        self.nobs = int(nobs)
+
+    def __repr__(self):
+        return "LinearFit"
+
+
+class GateCatalog(object):
+
+    """
+    A table of flux gate metadata.
+
+    Each attribute is an array with one entry per gate, indexed by the
+    position of the gate. Lookup indexes map gate ids, names and
+    glacier and flow types to positions.
+
+    Parameters
+    ----------
+    gate_name: 1-d array, names of flux gates
+    gate_id: 1-d array, gate identifications
+    clon, clat: 1-d arrays, longitude and latitude of gate centers
+    flightline: 1-d array
+    glaciertype: 1-d array
+    flowtype: 1-d array
+    profile_axis: 2-d masked array (gate, point), profile axis values, or None
+    profile_axis_units: string, udunits unit of axis
+    profile_axis_name: string, descriptive name of axis
+
+    """
+
+    def __init__(
+        self,
+        gate_name,
+        gate_id,
+        clon,
+        clat,
+        flightline,
+        glaciertype,
+        flowtype,
+        profile_axis=None,
+        profile_axis_units=None,
+        profile_axis_name=None,
+        *args,
+        **kwargs
+    ):
+        super(GateCatalog, self).__init__(*args, **kwargs)
+        self.gate_name = gate_name
+        self.gate_id = gate_id
+        self.clon = clon
+        self.clat = clat
+        self.flightline = flightline
+        self.glaciertype = glaciertype
+        self.flowtype = flowtype
+        self.profile_axis = profile_axis
+        self.profile_axis_units = profile_axis_units
+        self.profile_axis_name = profile_axis_name
+        self.id_index = self._make_index(gate_id)
+        self.name_index = self._make_index([str(name) for name in gate_name])
+        self.type_index = {"glaciertype": self._make_index(glaciertype), "flowtype": self._make_index(flowtype)}
+
+    def __repr__(self):
+        return "GateCatalog"
+
+    def __len__(self):
+        return len(self.gate_name)
+
+    def _make_index(self, values):
+        index = {}
+        for pos_id, value in enumerate(values):
+            if np.ma.is_masked(value) or value is None:
+                continue
+            index.setdefault(np.ma.getdata(value)[()], []).append(pos_id)
+        return dict((key, np.array(pos_ids)) for key, pos_ids in list(index.items()))
+
+    def find_id(self, gate_id):
+        """
+        Return positions of gates with a gate id.
+        """
+        return self.id_index.get(gate_id, np.array([], dtype="int"))
+
+    def find_name(self, name):
+        """
+        Return positions of gates with a name.
+        """
+        return self.name_index.get(name, np.array([], dtype="int"))
+
+    def find_type(self, key, value):
+        """
+        Return positions of gates with a glacier type (key="glaciertype")
+        or flow type (key="flowtype").
+        """
+        return self.type_index[key].get(value, np.array([], dtype="int"))
+
+    def get_gates(self, analysis_config=None):
+        """
+        Return a FluxGate view for every gate.
+        """
+        return [FluxGate(self, pos_id, analysis_config) for pos_id in range(len(self))]
+
+
+class FluxGate(object):
+
+    """
+    A class for FluxGates.
+
+    The metadata of the gate is a view into a GateCatalog.
+
+    Parameters
+    ----------
+    catalog: GateCatalog
+    pos_id: int, pos of gate in catalog
+    analysis_config: AnalysisConfig, default is AnalysisConfig()
+
+    """
+
+    def __init__(self, catalog, pos_id, analysis_config=None, *args, **kwargs):
+        super(FluxGate, self).__init__(*args, **kwargs)
+        if analysis_config is None:
+            analysis_config = AnalysisConfig()
+        self.analysis_config = analysis_config
+        self.catalog = catalog
+        self.pos_id = pos_id
+        self.best_rmsd_exp_id = None
+        self.best_rmsd = None
+        self.best_corr_exp_id = None
+        self.best_corr = None
+        self.chi2 = None
+        self.corr = None
+        self.corr_units = None
+        self.envelope = None
+        self.experiments = []
+        self.exp_counter = 0
+        self.has_observations = None
+        self.has_fluxes = None
+        self.has_stats = None
+        self.linear_trend = None
+        self.linear_bias = None
+        self.linear_r2 = None
+        self.linear_p = None
+        self.N_corr = None
+        self.N_rmsd = None
+        self.observed_flux = None
+        self.observed_flux_units = None
+        self.observed_flux_error = None
+        self.observed_flux_p05 = None
+        self.observed_flux_p95 = None
+        self.observed_mean = None
+        self.observed_mean_units = None
+        self.p_ols = None
+        self.r2 = None
+        self.r2_units = None
+        self.rmsd = None
+        self.rmsd_units = None
+        self.S = None
+        self.S_units = None
+        self.sigma_obs = None
+        self.sigma_obs_N = None
+        self.sigma_obs_units = None
+        self.varname = None
+        self.varname_units = None
+
+    def __repr__(self):
+        return "FluxGate"
+
+    @property
+    def gate_name(self):
+        return self.catalog.gate_name[self.pos_id]
+
+    @property
+    def gate_id(self):
+        return self.catalog.gate_id[self.pos_id]
+
+    @property
+    def profile_axis(self):
+        if self.catalog.profile_axis is None:
+            return None
+        return self.catalog.profile_axis[self.pos_id]
+
+    @property
+    def profile_axis_units(self):
+        return self.catalog.profile_axis_units
+
+    @property
+    def profile_axis_name(self):
+        return self.catalog.profile_axis_name
+
+    @property
+    def clon(self):
+        return self.catalog.clon[self.pos_id]
+
+    @property
+    def clat(self):
+        return self.catalog.clat[self.pos_id]
+
+    @property
+    def flightline(self):
+        return self.catalog.flightline[self.pos_id]
+
+    @property
+    def glaciertype(self):
+        return self.catalog.glaciertype[self.pos_id]
+
+    @property
+    def flowtype(self):
+        return self.catalog.flowtype[self.pos_id]
+
+    def add_experiment(self, data):
+        """
+        Add an experiment to FluxGate
+
+        """
+
+        print(("      adding experiment to flux gate {0}".format(self.gate_name)))
+        pos_id = self.pos_id
+        fg_exp = FluxGateExperiment(data, pos_id)
+        self.experiments.append(fg_exp)
+        if self.varname is None:
+            self.varname = data.varname
+        if self.varname_units is None:
+            self.varname_units = data.varname_units
+        self.exp_counter += 1
+
+    def add_experiment_result(self, result, k):
+        """
+        Add an experiment that has already been reduced to FluxGate
+
+        Parameters
+        ----------
+        result: ExperimentResult
+        k: int, position of FluxGate in the result arrays
+
+        """
+
+        print(("      adding experiment result to flux gate {0}".format(self.gate_name)))
+        fg_exp = FluxGateExperiment(result, self.pos_id)
+        fg_exp.flux = result.fluxes[k]
+        self.experiments.append(fg_exp)
+        if self.varname is None:
+            self.varname = result.varname
+        if self.varname_units is None:
+            self.varname_units = result.varname_units
+        if result.stats is not None:
+            stats = dict((key, val[k : k + 1]) for key, val in list(result.stats.items()))
+            self._set_stats([result.id], stats, update_best=False)
+        self.exp_counter += 1
+
+    def add_results(self, gate):
+        """
+        Add experiments of another FluxGate with fluxes and statistics
+
+        Used to append new experiments to the results of a previous run,
+        see read_results_file. Experiments of gate are put first.
+
+        Parameters
+        ----------
+        gate: FluxGate
+
+        """
+
+        self.experiments = gate.experiments + self.experiments
+        self.exp_counter += gate.exp_counter
+        for name in ("experiment_fluxes", "experiment_fluxes_units"):
+            merged = dict(getattr(gate, name))
+            merged.update(getattr(self, name))
+            setattr(self, name, merged)
+        if gate.has_stats and self.has_stats:
+            names = ["rmsd", "N_rmsd", "r2", "corr", "S", "p_ols"]
+            if gate.chi2 is not None and self.chi2 is not None:
+                names.append("chi2")
+            else:
+                self.chi2 = None
+            for name in names:
+                merged = dict(getattr(gate, name))
+                merged.update(getattr(self, name))
+                setattr(self, name, merged)
+            self._update_best()
+
+    def finalize_results(self):
+        """
+        Calculate fluxes and best experiments after adding experiment results
+
+        """
+
+        self.calculate_fluxes()
+        if self.has_stats:
+            self._update_best()
+
+    def add_observations(self, data):
+        """
+        Add observations to FluxGate
+
+        """
+
+        print(("      adding observations to flux gate {0}".format(self.gate_name)))
+        pos_id = self.pos_id
+        fg_obs = FluxGateObservations(data, pos_id)
+        self.observations = fg_obs
+        if self.has_observations is not None:
+            print(("Flux gate {0} already has observations, overriding".format(self.gate_name.encode("utf-8"))))
+        self.has_observations = True
+
+    def calculate_fluxes(self):
+        """
+        Calculate fluxes
+
+        """
+
+        if self.has_observations:
+            self._calculate_observed_flux()
+        self._calculate_experiment_fluxes()
+        self.has_fluxes = True
+
+    def calculate_stats(self):
+        """
+        Calculate statistics
+        """
+
+        if not self.has_fluxes:
+            self.calculate_fluxes()
+        ids = [exp.id for exp in self.experiments]
+        obs_vals = get_observed_values(self.observations.values)
+        exp_vals = np.ma.stack([np.squeeze(exp.values) for exp in self.experiments])
+        obs_error = None
+        if self.observations.has_error:
+            obs_error = np.squeeze(self.observations.error)
+        stats = get_batch_stats(exp_vals, obs_vals, obs_error)
+        self._set_stats(ids, stats)
+
+    def _set_stats(self, ids, stats, update_best=True):
+        """
+        Attach statistics to FluxGate
+
+        Parameters
+        ----------
+        ids: list of experiment ids
+        stats: dict of 1-d arrays as returned by get_batch_stats,
+               ordered like ids
+        update_best: bool, find best experiments
+        """
+
+        if self.p_ols is None:
+            self.p_ols = {}
+            self.rmsd = {}
+            self.N_rmsd = {}
+            self.r2 = {}
+            self.corr = {}
+            self.S = {}
+        if "chi2" in stats and self.chi2 is None:
+            self.chi2 = {}
+        # Convert RMSD units for all experiments at once
+        i_units_cf = cf_units.Unit(self.varname_units)
+        o_units_cf = cf_units.Unit(self.analysis_config.v_o_units)
+        rmsd = i_units_cf.convert(np.asarray(stats["rmsd"], dtype="float64"), o_units_cf)
+        for k, id in enumerate(ids):
+            self.rmsd[id] = float(rmsd[k])
+            self.N_rmsd[id] = int(stats["N_rmsd"][k])
+            self.r2[id] = float(stats["r2"][k])
+            self.corr[id] = float(stats["corr"][k])
+            self.p_ols[id] = LinearFit(
+                stats["intercept"][k], stats["slope"][k], stats["r2"][k], stats["N"][k]
+            )
+            if "chi2" in stats:
+                self.chi2[id] = float(stats["chi2"][k])
+        if update_best:
+            self._update_best()
+        self.rmsd_units = self.analysis_config.v_o_units
+        self.S_units = "1"
+        self.r2_units = "1"
+        self.corr_units = "1"
+        self.has_stats = True
+        self.observed_mean = np.ma.masked_invalid(self.observations.values).mean()
+        self.observed_mean_units = self.varname_units
+
+    def _update_best(self):
+        """
+        Find experiments with lowest RMSD and highest correlation
+        """
+
+        best_rmsd_exp_id = sorted(self.p_ols, key=lambda x: self.rmsd[x], reverse=False)[0]
+        best_corr_exp_id = sorted(self.p_ols, key=lambda x: self.corr[x], reverse=True)[0]
+        self.best_rmsd_exp_id = best_rmsd_exp_id
+        self.best_rmsd = self.rmsd[best_rmsd_exp_id]
+        self.best_corr_exp_id = best_corr_exp_id
+        self.best_corr = self.corr[best_corr_exp_id]
+
+    def _calculate_observed_flux(self):
+        """
+        Calculate observed flux
+
+        Calculate observed flux using trapezoidal rule. If observations have
+        asscociated errors, the error in observed flux is calculated as well.
+        """
+
+        x = self.profile_axis
+        y = self.observations.values
+        int_val = self._line_integral(y, x)
+        if self.observations.has_error:
+            y = self.observations.error
+            int_error = self._line_integral(y, x)
+            error_norm, N = get_rmsd(np.ma.masked_invalid(y), np.zeros_like(y, dtype="float32"))
+            self._set_observed_flux(int_val, int_error, error_norm, N)
+        else:
+            self._set_observed_flux(int_val)
+
+    def _set_observed_flux(self, int_val, int_error=None, sigma_obs=None, sigma_obs_N=None):
+        """
+        Attach observed flux to FluxGate
+
+        Parameters
+        ----------
+        int_val: float, line integral of observations
+        int_error: float, line integral of observational errors
+        sigma_obs: float, root mean square of observational errors
+        sigma_obs_N: int, number of points used for sigma_obs
+        """
+
+        x_units = self.profile_axis_units
+        y_units = self.varname_units
+        if int_error is not None:
+            self.sigma_obs = sigma_obs
+            self.sigma_obs_N = sigma_obs_N
+            self.sigma_obs_units = self.varname_units
+            self.observed_flux_error = convert_flux(int_error, x_units, y_units, self.analysis_config)
+
+        self.observed_flux = convert_flux(int_val, x_units, y_units, self.analysis_config)
+        self.observed_flux_units = self.analysis_config.v_flux_o_units_str
+
+    def _calculate_experiment_fluxes(self):
+        """
+        Calculate experiment fluxes
+
+        Calculated experiment fluxes using trapeziodal rule.
+
+        """
+
+        ids = []
+        experiment_fluxes = []
+        for exp in self.experiments:
+            ids.append(exp.id)
+            if exp.flux is not None:
+                # experiment was reduced on ingestion
+                o_val = exp.flux
+            else:
+                o_val = self._get_flux(exp.values, self.varname_units)
+            experiment_fluxes.append(o_val)
+        self._set_experiment_fluxes(ids, experiment_fluxes)
+
+    def _set_experiment_fluxes(self, ids, fluxes):
+        """
+        Attach experiment fluxes to FluxGate
+
+        Parameters
+        ----------
+        ids: list of experiment ids
+        fluxes: 1-d array_like, fluxes in output units, ordered like ids
+        """
+
+        self.experiment_fluxes = dict(zip(ids, fluxes))
+        self.experiment_fluxes_units = dict((id, self.analysis_config.v_flux_o_units_str) for id in ids)
+
+    def _get_flux(self, y, y_units):
+        """
+        Return flux through the gate in output units
+
+        Parameters
+        ----------
+        y: 1-d array_like, profile values
+        y_units: string, udunits unit of y
+
+        Returns
+        -------
+        flux : float
+        """
+
+        int_val = self._line_integral(y, self.profile_axis)
+        return convert_flux(int_val, self.profile_axis_units, y_units, self.analysis_config)
+
+    def length(self):
+        """
+        Return length of the profile, rounded to the nearest meter.
+        """
+
+        return np.around(self.profile_axis.max())
+
+    def return_gate_flux_str(self, islast):
+        """
+        Returns a LaTeX-table compatible string
+        """
+
+        if not self.has_stats:
+            self.calculate_stats()
+        gate_name = self.gate_name
+        p_ols = self.p_ols
+        observed_flux = self.observed_flux
+        observed_flux_units = self.observed_flux_units
+        experiment_fluxes = self.experiment_fluxes
+        experiment_fluxes_units = self.experiment_fluxes_units
+        observed_flux_error = self.observed_flux_error
+        if observed_flux_error:
+            obs_str = "$\pm$".join(["{:2.1f}".format(observed_flux), "{:2.1f}".format(observed_flux_error)])
+        else:
+            obs_str = "{:2.1f}".format(observed_flux)
+        exp_str = " & ".join(
+            [
+                "".join(["{:2.1f}".format(experiment_fluxes[key]), "({:1.2f})".format(p_ols[key].rsquared)])
+                for key in experiment_fluxes
+            ]
+        )
+        if islast:
+            gate_str = " & ".join([gate_name, obs_str, "", exp_str])
+        else:
+            gate_str = " & ".join([gate_name, obs_str, "", " ".join([exp_str, r" \\"])])
+        return gate_str
+
+    def return_gate_flux_str_short(self):
+        """
+        Returns a LaTeX-table compatible string
+        """
+
+        if not self.has_stats:
+            self.calculate_stats()
+        gate_name = self.gate_name
+        p_ols = self.p_ols
+        observed_flux = self.observed_flux
+        observed_flux_units = self.observed_flux_units
+        experiment_fluxes = self.experiment_fluxes
+        experiment_fluxes_units = self.experiment_fluxes_units
+        observed_flux_error = self.observed_flux_error
+        if observed_flux_error:
+            obs_str = "$\pm$".join(["{:2.1f}".format(observed_flux), "{:2.1f}".format(observed_flux_error)])
+        else:
+            obs_str = "{:2.1f}".format(observed_flux)
+        gate_str = " & ".join([gate_name, obs_str])
+        return gate_str
+
+    def _line_integral(self, y, x):
+        """
+        Return line integral using the composite trapezoidal rule
+
+        Parameters
+        ----------
+        y: 1-d array_like
+           Input array to integrate
+        x: 1-d array_like
+           Spacing between elements
+
+        Returns
+        -------
+        trapz : float
+                Definite integral as approximated by trapezoidal rule.
+        """
+
+        # Due to the variable length of profiles, padded profiles have
+        # masked values at the profile end, which we drop. Missing values
+        # are treated as zero.
+
+        if isinstance(x, np.ma.MaskedArray):
+            valid = ~np.ma.getmaskarray(x)
+            x = x.compressed()
+            y = y[..., valid]
+
+        return float(np.squeeze(segment_trapz(y, x, np.array([0, x.shape[-1]]))))
+
+    def get_line_plot_data(self, **kwargs):
+        """
+        Prepare a line plot along a flux gate.
+
+        Profiles are converted to output units and labels are made, so the
+        figure can be rendered without access to the FluxGate.
+
+        With envelope=True, the ensemble is summarized by its 5/16/50/84/95
+        percentiles (see calculate_batch_envelopes) instead of one line per
+        experiment. With highlight_best=True, the experiment with the
+        lowest RMSD is added as the only line.
+
+        Legend labels, normalization and output units are taken from
+        the AnalysisConfig of the gate.
+
+        Returns
+        -------
+        data : dict of arrays and strings, see render_line_plot in
+               flux-gate-analysis.py
+        """
+
+        legend = self.analysis_config.legend
+        normalize = self.analysis_config.normalize
+        params_dict = self.analysis_config.params_dict
+        v_o_units = self.analysis_config.v_o_units
+        v_o_units_str = self.analysis_config.v_o_units_str
+        profile_axis_out_units = self.analysis_config.profile_axis_out_units
+        gate_name = self.gate_name
+        experiments = self.experiments
+        profile_axis = self.profile_axis
+        profile_axis_name = self.profile_axis_name
+        profile_axis_units = self.profile_axis_units
+        i_units_cf = cf_units.Unit(profile_axis_units)
+        o_units_cf = cf_units.Unit(profile_axis_out_units)
+        profile_axis_out = i_units_cf.convert(profile_axis, o_units_cf)
+        varname = self.varname
+        v_units = self.varname_units
+        has_observations = self.has_observations
+        if not self.has_fluxes:
+            self.calculate_fluxes()
+        if has_observations and not self.has_stats:
+            self.calculate_stats()
+
+        label = None
+        obs_o_vals = None
+        obs_error_o_vals = None
+        if has_observations:
+            obs = self.observations
+            if legend == "long":
+                if obs.has_error:
+                    label = "obs: {:6.1f}$\pm${:4.1f}".format(self.observed_flux, self.observed_flux_error)
+                else:
+                    label = "obs: {:6.1f}".format(self.observed_flux)
+            elif legend == "dem":
+                if obs.has_error:
+                    label = "obs: {:6.1f}$\pm${:4.1f}".format(self.observed_flux, self.observed_flux_error)
+                else:
+                    label = obs.config.get("dem")
+            elif legend in ("short", "regress", "exp"):
+                label = "observed"
+            elif legend in ("attr"):
+                label = "AERODEM"
+            else:
+                if obs.has_error:
+                    label = "{:6.1f}$\pm${:4.1f}".format(self.observed_flux, self.observed_flux_error)
+                else:
+                    label = "{:6.1f}".format(self.observed_flux)
+            i_vals = obs.values
+            i_units_cf = cf_units.Unit(v_units)
+            o_units_cf = cf_units.Unit(v_o_units)
+            obs_o_vals = i_units_cf.convert(i_vals, o_units_cf)
+            obs_max = np.nanmax(obs_o_vals)
+            if obs.has_error:
+                i_vals = obs.error
+                obs_error_o_vals = i_units_cf.convert(i_vals, o_units_cf)
+        obs_label = label
+
+        envelope = kwargs.get("envelope", False)
+        envelope_o_vals = None
+        envelope_label = None
+        if envelope:
+            if self.envelope is None:
+                self.envelope = get_ensemble_percentiles(
+                    np.ma.stack([np.ma.masked_invalid(np.squeeze(exp.values)) for exp in experiments])
+                )
+            i_units_cf = cf_units.Unit(v_units)
+            o_units_cf = cf_units.Unit(v_o_units)
+            envelope_o_vals = i_units_cf.convert(self.envelope, o_units_cf)
+            if normalize:
+                envelope_o_vals = envelope_o_vals * obs_max / np.nanmax(envelope_o_vals[2])
+            envelope_label = "ensemble ({})".format(len(experiments))
+            plot_experiments = []
+            if kwargs.get("highlight_best", False) and self.best_rmsd_exp_id is not None:
+                plot_experiments = [exp for exp in experiments if exp.id == self.best_rmsd_exp_id]
+        else:
+            # We need to carefully reverse list and properly order
+            # handles and labels to have first experiment plotted on top
+            plot_experiments = list(reversed(experiments))
+
+        exp_o_vals_list = []
+        exp_labels = []
+        for k, exp in enumerate(plot_experiments):
+            i_vals = exp.values
+            i_units_cf = cf_units.Unit(v_units)
+            o_units_cf = cf_units.Unit(v_o_units)
+            exp_o_vals = i_units_cf.convert(i_vals, o_units_cf)
+            if normalize:
+                exp_max = np.nanmax(exp_o_vals)
+                exp_o_vals *= obs_max / exp_max
+            if "label_param_list" in list(kwargs.keys()):
+                params = kwargs["label_param_list"]
+                config = exp.config
+                id = exp.id
+                exp_str = ", ".join(
+                    [
+                        "=".join([params_dict[key]["abbr"], params_dict[key]["format"].format(config.get(key))])
+                        for key in params
+                    ]
+                )
+                if has_observations:
+                    if legend == "long":
+                        label = ", ".join(
+                            [
+                                ": ".join([exp_str, "{:6.1f}".format(self.experiment_fluxes[id])]),
+                                "=".join(["r", "{:1.2f}".format(self.corr[id])]),
+                            ]
+                        )
+                        # label = ', '.join(['{:6.1f}'.format(self.experiment_fluxes[id]), '='.join(['r', '{:1.2f}'.format(self.corr[id])])])
+                    elif legend == "attr":
+                        [key for key in params]
+                    elif legend == "exp":
+                        # # Use this 
+                        # exp_str = ", ".join(
+                        #     [
+                        #         "=".join(
+                        #             [
+                        #                 params_dict[key]["abbr"],
+                        #                 params_dict[key]["format"].format(config.get(key) * ice_density),
+                        #             ]
+                        #         )
+                        #         for key in params
+                        #     ]
+                        # )
+                        exp_str = ", ".join(
+                            [
+                                "=".join(
+                                    [params_dict[key]["abbr"], params_dict[key]["format"].format(config.get(key))]
+                                )
+                                for key in params
+                            ]
+                        )
+                        label = exp_str
+                    elif legend == "dem":
+                        label = config.get("dem")
+                    else:
+                        label = "r={:1.2f}".format(self.corr[id])
+                    if legend == "regress":
+                        label = "{:4.0f}m, r={:1.2f}".format(config["grid_dx_meters"], self.corr[id])
+                    elif legend == "short":
+                        label = "r={:1.2f}".format(self.corr[id])
+                    else:
+                        pass
+                else:
+                    label = config.get("dem")
+                    # label = ", ".join([": ".join([exp_str, "{:6.1f}".format(self.experiment_fluxes[id])])])
+            exp_o_vals_list.append(np.ma.filled(np.ma.asarray(exp_o_vals, dtype="float64"), np.nan))
+            exp_labels.append(label)
+
+        if varname in list(self.analysis_config.var_name_dict.keys()):
+            v_name = self.analysis_config.var_name_dict[varname]
+        else:
+            v_name = varname
+        if normalize:
+            out_name = "_".join([unidecode(gate_name), varname, "normalized", "profile"])
+        else:
+            out_name = "_".join([unidecode(gate_name), varname, "profile"])
+        outname = ".".join([out_name, "pdf"]).replace(" ", "_")
+
+        if obs_o_vals is not None:
+            obs_o_vals = np.ma.filled(np.ma.asarray(obs_o_vals, dtype="float64"), np.nan)
+        if obs_error_o_vals is not None:
+            obs_error_o_vals = np.ma.filled(np.ma.asarray(obs_error_o_vals, dtype="float64"), np.nan)
+
+        return {
+            "gate_name": gate_name,
+            "outname": outname,
+            "profile_axis_out": np.ma.filled(np.ma.asarray(profile_axis_out, dtype="float64"), np.nan),
+            "xlabel": "{0} ({1})".format(profile_axis_name, profile_axis_out_units),
+            "ylabel": "{0} ({1})".format(v_name, v_o_units_str),
+            "legend_title": "{} ({})".format(self.analysis_config.flux_type, self.experiment_fluxes_units[0]),
+            "obs_label": obs_label,
+            "obs_values": obs_o_vals,
+            "obs_error": obs_error_o_vals,
+            "exp_labels": exp_labels,
+            "exp_values": exp_o_vals_list,
+            "envelope": envelope_o_vals,
+            "envelope_label": envelope_label,
+        }
+
+
+class FluxGateExperiment(object):
+    def __init__(self, data, pos_id, *args, **kwargs):
+        super(FluxGateExperiment, self).__init__(*args, **kwargs)
+        self.values = None
+        self.profiles = None
+        self.flux = None
+        if data.values is not None:
+            self.values = data.values[pos_id, Ellipsis]
+        if isinstance(data.values, PackedProfiles):
+            self.profiles = data.values
+        self.config = data.config
+        self.id = data.id
+
+    def __repr__(self):
+        return "FluxGateExperiment"
+
+
+class FluxGateObservations(object):
+    def __init__(self, data, pos_id, *args, **kwargs):
+        super(FluxGateObservations, self).__init__(*args, **kwargs)
+        self.has_error = None
+        self.profiles = None
+        self.error_profiles = None
+        self.values = data.values[pos_id, Ellipsis]
+        self.config = data.config
+        if isinstance(data.values, PackedProfiles):
+            self.profiles = data.values
+        if data.has_error:
+            self.error = data.error[pos_id, Ellipsis]
+            self.has_error = True
+            if isinstance(data.error, PackedProfiles):
+                self.error_profiles = data.error
+
+    def __repr__(self):
+        return "FluxGateObservations"
+
+
+def read_gate_catalog(nc, rows=None):
+    """
+    Read the gate catalog from the profiles of an open netCDF file.
+
+    Every metadata variable is read once for all gates.
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset with profiles
+    rows: 1-d array of rows to read, see select_gates, or None for all
+
+    Returns
+    -------
+    catalog: GateCatalog
+    layout: ProfileLayout of the profiles
+    """
+
+    profile_names = read_rows(nc.variables["profile_name"], rows)
+    layout = ProfileLayout(read_rows(nc.variables["profile_axis"], rows), rows=rows)
+    profile_ids = np.array(read_rows(nc.variables["profile_id"], rows), dtype="int")
+    n = len(profile_names)
+    columns = {}
+    for name, default in (("clon", 0.0), ("clat", 0.0), ("flightline", 0), ("glaciertype", ""), ("flowtype", "")):
+        if name in nc.variables:
+            columns[name] = read_rows(nc.variables[name], rows)
+        else:
+            columns[name] = np.full(n, default, dtype=object)
+    catalog = GateCatalog(
+        profile_names,
+        profile_ids,
+        columns["clon"],
+        columns["clat"],
+        columns["flightline"],
+        columns["glaciertype"],
+        columns["flowtype"],
+        layout.axis,
+        nc.variables["profile_axis"].units,
+        nc.variables["profile_axis"].long_name,
+    )
+
+    return catalog, layout
+
+
+def read_flux_gates(nc, rows=None, analysis_config=None):
+    """
+    Create flux gates from the profiles of an open netCDF file.
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset with profiles
+    rows: 1-d array of rows to read, see select_gates, or None for all
+    analysis_config: AnalysisConfig shared by all gates
+
+    Returns
+    -------
+    flux_gates: list of FluxGates
+    layout: ProfileLayout of the profiles
+    """
+
+    catalog, layout = read_gate_catalog(nc, rows)
+
+    return catalog.get_gates(analysis_config), layout
+
+
+def calculate_batch_fluxes(flux_gates):
+    """
+    Calculate fluxes through all flux gates at once.
+
+    Observed fluxes, their errors and the fluxes of all experiments are
+    each integrated in one segmented trapezoid pass over the packed
+    profiles of all gates.
+
+    Parameters
+    ----------
+    flux_gates: list of FluxGate objects
+    """
+
+    gates = [gate for gate in flux_gates if not gate.has_fluxes]
+    if not gates:
+        return
+    experiments = gates[0].experiments
+    if not all([exp.profiles is not None for exp in experiments]):
+        for gate in gates:
+            gate.calculate_fluxes()
+        return
+    layout = experiments[0].profiles.layout
+    x = layout.axis.data
+    offsets = layout.offsets
+    ids = [exp.id for exp in experiments]
+    exp_vals = np.stack([exp.profiles.data.reshape(x.shape) for exp in experiments])
+    int_vals = segment_trapz(exp_vals, x, offsets)
+    calculate_batch_observed_fluxes(gates)
+    for gate in gates:
+        fluxes = convert_flux(int_vals[:, gate.pos_id], gate.profile_axis_units, gate.varname_units, gate.analysis_config)
+        gate._set_experiment_fluxes(ids, fluxes)
+        gate.has_fluxes = True
+
+
+def calculate_batch_observed_fluxes(flux_gates):
+    """
+    Calculate observed fluxes through all flux gates at once.
+
+    Parameters
+    ----------
+    flux_gates: list of FluxGate objects, gates without observations
+                are skipped
+    """
+
+    gates = [gate for gate in flux_gates if gate.has_observations]
+    if not gates:
+        return
+    obs = gates[0].observations
+    layout = obs.profiles.layout
+    x = layout.axis.data
+    offsets = layout.offsets
+    obs_int = segment_trapz(obs.profiles.data.reshape(x.shape), x, offsets)
+    if obs.has_error:
+        error = obs.error_profiles.data.reshape(x.shape)
+        error_int = segment_trapz(error, x, offsets)
+        error_stats = get_segment_stats(error, np.zeros_like(error), offsets)
+    for gate in gates:
+        pos_id = gate.pos_id
+        if obs.has_error:
+            gate._set_observed_flux(
+                obs_int[pos_id], error_int[pos_id], error_stats["rmsd"][pos_id], error_stats["N_rmsd"][pos_id]
+            )
+        else:
+            gate._set_observed_flux(obs_int[pos_id])
+
+
+def calculate_batch_envelopes(flux_gates):
+    """
+    Calculate ensemble percentiles of all flux gates at once.
+
+    The 5/16/50/84/95 percentiles at every point of every gate are
+    computed in one pass over the packed (experiment, point) array.
+
+    Parameters
+    ----------
+    flux_gates: list of FluxGate objects
+    """
+
+    experiments = flux_gates[0].experiments
+    if not all([exp.profiles is not None for exp in experiments]):
+        # percentiles are calculated per gate in get_line_plot_data
+        return
+    layout = experiments[0].profiles.layout
+    x = layout.axis.data
+    exp_vals = np.stack([exp.profiles.data.reshape(x.shape) for exp in experiments])
+    percentiles = PackedProfiles(get_ensemble_percentiles(exp_vals), layout)
+    for gate in flux_gates:
+        gate.envelope = percentiles[gate.pos_id]
+
+
+def calculate_observed_flux_intervals(flux_gates, sampler):
+    """
+    Calculate the 5th and 95th percentile of observed fluxes.
+
+    The fluxes of all gates and samples of perturbed observations are
+    integrated in one segmented trapezoid pass per chunk of samples.
+
+    Parameters
+    ----------
+    flux_gates: list of FluxGate objects with observations
+    sampler: ObservationSampler
+    """
+
+    gates = [gate for gate in flux_gates if gate.has_observations]
+    if not gates:
+        return
+    layout = gates[0].observations.profiles.layout
+    x = layout.axis.data
+    int_vals = np.concatenate([segment_trapz(samples, x, layout.offsets) for samples in sampler.chunks()])
+    fluxes = convert_flux(int_vals, gates[0].profile_axis_units, gates[0].varname_units, gates[0].analysis_config)
+    p05, p95 = np.percentile(fluxes, [5, 95], axis=0)
+    for gate in gates:
+        gate.observed_flux_p05 = p05[gate.pos_id]
+        gate.observed_flux_p95 = p95[gate.pos_id]
+
+
+def calculate_batch_stats(flux_gates):
+    """
+    Calculate statistics for all flux gates at once.
+
+    Packed experiment and observed values of all gates are reduced in a
+    single segmented pass over the (experiment, point) array.
+
+    Parameters
+    ----------
+    flux_gates: list of FluxGate objects with observations
+    """
+
+    gates = [gate for gate in flux_gates if gate.has_observations and not gate.has_stats]
+    if not gates:
+        return
+    calculate_batch_fluxes(gates)
+    experiments = gates[0].experiments
+    if gates[0].observations.profiles is None or not all([exp.profiles is not None for exp in experiments]):
+        for gate in gates:
+            gate.calculate_stats()
+        return
+    layout = experiments[0].profiles.layout
+    x = layout.axis.data
+    ids = [exp.id for exp in experiments]
+    obs = gates[0].observations
+    obs_vals = get_observed_values(obs.profiles.data).reshape(x.shape)
+    obs_error = None
+    if obs.has_error:
+        obs_error = obs.error_profiles.data.reshape(x.shape)
+    exp_vals = np.stack([exp.profiles.data.reshape(x.shape) for exp in experiments])
+    stats = get_segment_stats(exp_vals, obs_vals, layout.offsets, obs_error)
+    for gate in gates:
+        gate._set_stats(ids, dict((key, val[:, gate.pos_id]) for key, val in list(stats.items())))
@@ -0,0 +1,168 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Ragged profiles packed CSR-style.
+"""
+
+import numpy as np
+
+
+class ProfileLayout(object):
+
+    """
+    Layout of ragged profiles packed CSR-style.
+
+    Profiles have variable length and are padded with masked values at
+    the profile end. A ProfileLayout drops the padding and packs all
+    profiles into one flat array, where profile k occupies
+    [offsets[k], offsets[k + 1]).
+
+    Parameters
+    ----------
+    profile_axis: 2-d masked array (profile, point), profile axis values
+    rows: 1-d array of the rows of the profiles in the files, or None
+          if all profiles are used
+
+    """
+
+    def __init__(self, profile_axis, rows=None, *args, **kwargs):
+        super(ProfileLayout, self).__init__(*args, **kwargs)
+        self.rows = rows
+        profile_axis = np.ma.masked_invalid(profile_axis)
+        self.valid = ~np.ma.getmaskarray(profile_axis)
+        self.lengths = self.valid.sum(axis=-1)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        self.axis = self.pack(profile_axis)
+
+    def __repr__(self):
+        return "ProfileLayout"
+
+    def pack(self, values):
+        """
+        Pack padded values
+
+        Parameters
+        ----------
+        values: array_like (profile, ..., point), padded values
+
+        Returns
+        -------
+        packed : PackedProfiles, missing values are NaN
+        """
+
+        values = np.ma.masked_invalid(values)
+        values = np.moveaxis(values, 0, -2)[..., self.valid]
+        dtype = np.result_type(values.dtype, np.float32)
+        return PackedProfiles(np.ma.filled(values.astype(dtype), np.nan), self)
+
+
+class PackedProfiles(object):
+
+    """
+    Values of ragged profiles packed CSR-style.
+
+    Indexing with a profile position returns a view of that profile,
+    so PackedProfiles can be used in place of a padded (profile, ...,
+    point) array.
+
+    Parameters
+    ----------
+    data: array_like (..., n), packed values
+    layout: ProfileLayout
+
+    """
+
+    def __init__(self, data, layout, *args, **kwargs):
+        super(PackedProfiles, self).__init__(*args, **kwargs)
+        self.data = data
+        self.layout = layout
+
+    def __repr__(self):
+        return "PackedProfiles"
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            key = key[0]
+        offsets = self.layout.offsets
+        return self.data[..., offsets[key] : offsets[key + 1]]
+
+    def __len__(self):
+        return len(self.layout.lengths)
+
+
+def read_rows(var, rows=None):
+    """
+    Read rows of a netCDF variable with profile as first dimension.
+
+    Each run of consecutive rows is read as one hyperslab.
+
+    Parameters
+    ----------
+    var: netCDF4.Variable
+    rows: sorted 1-d array of rows, or None to read all rows
+
+    Returns
+    -------
+    values : array
+    """
+
+    if rows is None:
+        return var[:]
+    rows = np.asarray(rows)
+    runs = np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1)
+    parts = [var[run[0] : run[-1] + 1, Ellipsis] for run in runs]
+    if any([isinstance(part, np.ma.MaskedArray) for part in parts]):
+        return np.ma.concatenate(parts, axis=0)
+    return np.concatenate(parts, axis=0)
+
+
+def select_gates(nc, selector):
+    """
+    Return the rows of the profiles matching a gate selector.
+
+    A selector is a semicolon-separated list of conditions "key=values",
+    where values is a comma-separated list. A profile matches a
+    condition if it matches any of its values, and the selector if it
+    matches all conditions. Keys are
+
+    - id: profile_id
+    - name: profile_name
+    - glaciertype, flowtype: glacier and flow type
+    - bbox: lon_min,lat_min,lon_max,lat_max on clon/clat
+
+    e.g. "flowtype=0,1;bbox=-55,68,-45,72".
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset with profiles
+    selector: string
+
+    Returns
+    -------
+    rows : 1-d array of matching rows
+    """
+
+    names = nc.variables["profile_name"][:]
+    selected = np.ones(len(names), dtype="bool")
+    for condition in selector.split(";"):
+        key, sep, values = condition.partition("=")
+        key = key.strip()
+        values = [value.strip() for value in values.split(",")]
+        if not sep:
+            raise ValueError("invalid gate condition '{}'".format(condition))
+        if key == "id":
+            ids = np.ma.filled(nc.variables["profile_id"][:], -1)
+            selected &= np.isin(ids, [int(value) for value in values])
+        elif key == "name":
+            selected &= np.array([str(name) in values for name in names], dtype="bool")
+        elif key in ("glaciertype", "flowtype"):
+            types = np.ma.filled(nc.variables[key][:], -1)
+            selected &= np.isin(types, [int(value) for value in values])
+        elif key == "bbox":
+            lon_min, lat_min, lon_max, lat_max = [float(value) for value in values]
+            clon = np.ma.filled(nc.variables["clon"][:], np.nan)
+            clat = np.ma.filled(nc.variables["clat"][:], np.nan)
+            selected &= (clon >= lon_min) & (clon <= lon_max) & (clat >= lat_min) & (clat <= lat_max)
+        else:
+            raise ValueError("unknown gate selector key '{}'".format(key))
+    return np.flatnonzero(selected)
@@ -0,0 +1,319 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Ranking of experiments by their misfit to observations.
+"""
+
+import numpy as np
+import pandas as pa
+
+
+def get_ensemble_table(flux_gates):
+    """
+    Return statistics of all experiments and gates as one long-form table.
+
+    Parameters
+    ----------
+    flux_gates: list of FluxGates with statistics
+
+    Returns
+    -------
+    table : pandas.DataFrame with one row per (experiment, gate)
+    """
+
+    ids = [exp.id for exp in flux_gates[0].experiments]
+    ng = len(flux_gates)
+    ne = len(ids)
+
+    def get_metric(name, dtype="float64"):
+        return np.array([[getattr(gate, name)[id] for gate in flux_gates] for id in ids], dtype=dtype).ravel()
+
+    lengths = [gate.length() if gate.profile_axis is not None else np.nan for gate in flux_gates]
+    table = pa.DataFrame(
+        {
+            "experiment": np.repeat(ids, ng),
+            "gate": np.tile(np.arange(ng), ne),
+            "name": np.tile([gate.gate_name for gate in flux_gates], ne),
+            "correlation": get_metric("corr"),
+            "rmsd": get_metric("rmsd"),
+            "N": get_metric("N_rmsd", dtype="int64"),
+            "glacier_type": np.tile([int(gate.glaciertype) for gate in flux_gates], ne),
+            "flow_type": np.tile([int(gate.flowtype) for gate in flux_gates], ne),
+            "length": np.tile(lengths, ne),
+            "flux": get_metric("experiment_fluxes"),
+        }
+    )
+    if all([gate.chi2 is not None for gate in flux_gates]):
+        table["chi2"] = get_metric("chi2")
+    if all([gate.observed_flux is not None for gate in flux_gates]):
+        table["observed_flux"] = np.tile(np.array([gate.observed_flux for gate in flux_gates], dtype="float64"), ne)
+    return table
+
+
+def rank_experiments(table, by=None, threshold=0.85):
+    """
+    Reduce a long-form table of gate statistics per experiment.
+
+    For every experiment, and every group if by is given, calculates the
+    N-weighted cumulative RMSD, the median correlation and the number of
+    gates with a correlation above threshold in one grouped reduction.
+
+    Parameters
+    ----------
+    table: pandas.DataFrame as returned by get_ensemble_table
+    by: column name to group gates by, e.g. "flow_type", or None
+    threshold: float, correlation threshold
+
+    Returns
+    -------
+    ranking : pandas.DataFrame indexed by experiment (and group) with
+              columns rmsd, correlation, no_glaciers and N, and the
+              median error-weighted misfit chi2 if the table has it
+    """
+
+    keys = ["experiment"]
+    if by is not None:
+        keys.append(by)
+    N = table["N"].values
+    # Gates without valid points do not contribute
+    rmsd2N = np.where(N > 0, table["rmsd"].values ** 2 * N, 0.0)
+    above = (table["correlation"].values > threshold).astype("int64")
+    grouped = table.assign(rmsd2N=rmsd2N, above=above).groupby(keys, sort=True)
+    sums = grouped[["rmsd2N", "N", "above"]].sum()
+    ranking = pa.DataFrame(
+        {
+            "rmsd": np.sqrt(sums["rmsd2N"] / sums["N"]),
+            "correlation": grouped["correlation"].median(),
+            "no_glaciers": sums["above"],
+            "N": sums["N"],
+        }
+    )
+    if "chi2" in table:
+        ranking["chi2"] = grouped["chi2"].median()
+    return ranking
+
+
+def export_ranking_csv(filename, table, threshold=0.85):
+    """
+    Write the ranking of all experiments, overall and per flow and glacier type, to a CSV file.
+
+    Parameters
+    ----------
+    filename: string
+    table: pandas.DataFrame as returned by get_ensemble_table
+    threshold: float, correlation threshold
+    """
+
+    rankings = []
+    for by in (None, "flow_type", "glacier_type"):
+        ranking = rank_experiments(table, by=by, threshold=threshold).reset_index()
+        if by is None:
+            ranking.insert(1, "group_by", "all")
+            ranking.insert(2, "group", -1)
+        else:
+            ranking.insert(1, "group_by", by)
+            ranking = ranking.rename(columns={by: "group"})
+        rankings.append(ranking)
+    pa.concat(rankings, ignore_index=True).to_csv(filename, index=False, float_format="%.4f")
+
+
+def get_objectives(table, threshold=0.85):
+    """
+    Return the calibration objectives of all experiments.
+
+    Objectives are the cumulative RMSD of each flow type, the median
+    correlation and, if observed fluxes are known, the flux bias, i.e.
+    the mean absolute difference between experiment and observed flux
+    over all gates.
+
+    Parameters
+    ----------
+    table: pandas.DataFrame as returned by get_ensemble_table
+    threshold: float, correlation threshold, see rank_experiments
+
+    Returns
+    -------
+    objectives : pandas.DataFrame indexed by experiment, one column per objective
+    maximize : list of bool, True for objectives to maximize
+    """
+
+    ranking = rank_experiments(table, threshold=threshold)
+    ranking_flow_type = rank_experiments(table, by="flow_type", threshold=threshold)
+    objectives = ranking_flow_type["rmsd"].unstack("flow_type")
+    objectives.columns = ["rmsd_flow_type_{}".format(flow_type) for flow_type in objectives.columns]
+    maximize = [False] * len(objectives.columns)
+    objectives["correlation"] = ranking["correlation"]
+    maximize.append(True)
+    if "observed_flux" in table:
+        bias = (table["flux"] - table["observed_flux"]).abs()
+        objectives["flux_bias"] = bias.groupby(table["experiment"]).mean()
+        maximize.append(False)
+    return objectives, maximize
+
+
+def count_dominators(P, Q, chunk_size=2 ** 22):
+    """
+    Returns for every point of P the number of points of Q that dominate it.
+
+    A point dominates another if it is no worse in all objectives and
+    better in at least one (minimization). Points are visited in order
+    of their sum of objectives, since only points with a smaller or
+    equal sum can dominate. Each block of points of P is compared to
+    the candidates of Q with broadcast comparisons of at most
+    chunk_size pairs.
+
+    Parameters
+    ----------
+    P : 2-d array (n_points, n_objectives)
+    Q : 2-d array (n_other, n_objectives)
+    chunk_size: int
+
+    Returns
+    -------
+    counts : 1-d array (n_points)
+    """
+
+    counts = np.zeros(len(P), dtype="int64")
+    if len(P) == 0 or len(Q) == 0:
+        return counts
+    p_order = np.argsort(P.sum(axis=1), kind="stable")
+    Q = Q[np.argsort(Q.sum(axis=1), kind="stable")]
+    q_sum = Q.sum(axis=1)
+    P = P[p_order]
+    p_sum = P.sum(axis=1)
+    block = max(1, chunk_size // len(Q))
+    for start in range(0, len(P), block):
+        Pb = P[start : start + block]
+        Qb = Q[: np.searchsorted(q_sum, p_sum[start : start + block][-1], side="right")]
+        le = np.ones((len(Pb), len(Qb)), dtype="bool")
+        lt = np.zeros((len(Pb), len(Qb)), dtype="bool")
+        for k in range(P.shape[1]):
+            le &= Qb[np.newaxis, :, k] <= Pb[:, np.newaxis, k]
+            lt |= Qb[np.newaxis, :, k] < Pb[:, np.newaxis, k]
+        counts[p_order[start : start + block]] = np.sum(le & lt, axis=-1)
+    return counts
+
+
+def non_dominated_sort(F, chunk_size=2 ** 22):
+    """
+    Returns the Pareto front of every point for minimization.
+
+    The number of dominating points is counted once for all points.
+    Whenever a front is removed, the counts of the remaining points are
+    reduced by the number of front members dominating them, and points
+    without dominators form the next front. This needs at most twice as
+    many comparisons as a single dominance check of all pairs, and the
+    comparisons are blocked, so memory stays bounded for tens of
+    thousands of points.
+
+    Parameters
+    ----------
+    F : 2-d array (n_points, n_objectives), objectives to minimize.
+        NaN is worse than any value.
+    chunk_size: int, maximum number of point pairs compared at once
+
+    Returns
+    -------
+    fronts : 1-d array (n_points), 0 for the non-dominated set
+    """
+
+    F = np.asarray(F, dtype="float64")
+    # replace NaN by a finite value worse than all others
+    worst = np.where(np.all(np.isnan(F), axis=0), 0.0, np.nanmax(np.where(np.isnan(F), -np.inf, F), axis=0)) + 1.0
+    F = np.where(np.isnan(F), worst, F)
+    fronts = np.full(len(F), -1, dtype="int")
+    counts = count_dominators(F, F, chunk_size)
+    remaining = np.ones(len(F), dtype="bool")
+    front = 0
+    members = np.flatnonzero(counts == 0)
+    while len(members) > 0:
+        fronts[members] = front
+        remaining[members] = False
+        others = np.flatnonzero(remaining)
+        counts[others] -= count_dominators(F[others], F[members], chunk_size)
+        members = others[counts[others] == 0]
+        front += 1
+    return fronts
+
+
+def crowding_distance(F, fronts):
+    """
+    Returns the crowding distance of every point within its front.
+
+    Parameters
+    ----------
+    F : 2-d array (n_points, n_objectives)
+    fronts : 1-d array (n_points), see non_dominated_sort
+
+    Returns
+    -------
+    distance : 1-d array (n_points), infinite for the extreme points of a front
+    """
+
+    F = np.where(np.isnan(F), np.inf, np.asarray(F, dtype="float64"))
+    distance = np.zeros(len(F))
+    for front in np.unique(fronts):
+        members = np.flatnonzero(fronts == front)
+        Fm = F[members]
+        if len(members) < 3:
+            distance[members] = np.inf
+            continue
+        order = np.argsort(Fm, axis=0, kind="stable")
+        Fs = np.take_along_axis(Fm, order, axis=0)
+        span = Fs[-1] - Fs[0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gaps = np.where(span > 0, (Fs[2:] - Fs[:-2]) / span, 0)
+        d = np.zeros_like(Fs)
+        d[1:-1] = np.nan_to_num(gaps)
+        d[0] = np.inf
+        d[-1] = np.inf
+        # scatter back from sorted order, summing over objectives
+        d_members = np.zeros_like(Fs)
+        np.put_along_axis(d_members, order, d, axis=0)
+        distance[members] = d_members.sum(axis=1)
+    return distance
+
+
+def get_pareto_fronts(table, threshold=0.85):
+    """
+    Return the Pareto fronts of all experiments.
+
+    Experiments are sorted by front and decreasing crowding distance.
+
+    Parameters
+    ----------
+    table: pandas.DataFrame as returned by get_ensemble_table
+    threshold: float, correlation threshold
+
+    Returns
+    -------
+    pareto : pandas.DataFrame indexed by experiment with the objectives,
+             front and crowding_distance
+    """
+
+    objectives, maximize = get_objectives(table, threshold=threshold)
+    F = objectives.values * np.where(maximize, -1.0, 1.0)
+    pareto = objectives.copy()
+    pareto["front"] = non_dominated_sort(F)
+    pareto["crowding_distance"] = crowding_distance(F, pareto["front"].values)
+    return pareto.sort_values(["front", "crowding_distance"], ascending=[True, False], kind="stable")
+
+
+def export_pareto_csv(filename, table, threshold=0.85):
+    """
+    Write the Pareto fronts of all experiments to a CSV file.
+
+    Parameters
+    ----------
+    filename: string
+    table: pandas.DataFrame as returned by get_ensemble_table
+    threshold: float, correlation threshold
+
+    Returns
+    -------
+    pareto : pandas.DataFrame, see get_pareto_fronts
+    """
+
+    pareto = get_pareto_fronts(table, threshold=threshold)
+    pareto.to_csv(filename, float_format="%.4f")
+    return pareto
@@ -0,0 +1,366 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Reduction of experiment files to per-gate fluxes and misfit statistics.
+"""
+
+import os
+import hashlib
+import pickle
+import multiprocessing as mp
+import numpy as np
+
+from .datasets import ExperimentDataset, ExperimentResult
+from .gates import convert_flux
+from .stats import segment_trapz, get_segment_stats, get_sample_rmsd
+
+
+def reduce_experiment(experiment, flux_gates, obs_vals=None, keep_values=False, obs_error=None, sampler=None):
+    """
+    Reduce an experiment to per-gate fluxes and misfit statistics.
+
+    Profiles with more than one time record are reduced for all
+    records at once.
+
+    Parameters
+    ----------
+    experiment: ExperimentDataset with packed values
+    flux_gates: list of FluxGate objects
+    obs_vals: 1-d array of packed observed values or None
+    keep_values: bool, retain profiles in result
+    obs_error: 1-d array of packed observational errors or None
+    sampler: ObservationSampler or None
+
+    Returns
+    -------
+    result: ExperimentResult, arrays are ordered like flux_gates along
+            the last axis
+    """
+
+    values = experiment.values
+    units = experiment.varname_units
+    layout = values.layout
+    x = layout.axis.data
+    pos_ids = np.array([gate.pos_id for gate in flux_gates], dtype="int")
+    data = values.data.reshape((-1,) + x.shape)
+    if data.shape[0] == 1:
+        data = data.reshape(x.shape)
+    int_vals = segment_trapz(data, x, layout.offsets)[..., pos_ids]
+    fluxes = convert_flux(int_vals, flux_gates[0].profile_axis_units, units, flux_gates[0].analysis_config)
+    stats = None
+    if obs_vals is not None:
+        stats = get_segment_stats(data, obs_vals, layout.offsets, obs_error)
+        stats = dict((key, val[..., pos_ids]) for key, val in list(stats.items()))
+    rmsd_samples = None
+    if sampler is not None:
+        rmsd_samples = get_sample_rmsd(data, sampler)
+    if not keep_values:
+        values = None
+    result = ExperimentResult(experiment.id, experiment.config, experiment.varname, units, fluxes, stats, values)
+    result.time = experiment.time
+    result.time_units = experiment.time_units
+    result.time_calendar = experiment.time_calendar
+    result.rmsd_samples = rmsd_samples
+    return result
+
+
+# State of ingestion worker processes, see _init_reduce_worker
+_reduce_worker = {}
+
+
+def _init_reduce_worker(flux_gates, layout, obs_vals, varname, keep_values, obs_error=None, sampler=None):
+    """
+    Initialize an ingestion worker process
+
+    Flux gates carry their AnalysisConfig, so this also works with the
+    "spawn" start method.
+    """
+
+    _reduce_worker.update(
+        flux_gates=flux_gates,
+        layout=layout,
+        obs_vals=obs_vals,
+        varname=varname,
+        keep_values=keep_values,
+        obs_error=obs_error,
+        sampler=sampler,
+    )
+
+
+def read_and_reduce(
+    id, filename, flux_gates, layout, varname, obs_vals=None, keep_values=False, obs_error=None, sampler=None
+):
+    """
+    Read an experiment file and reduce it.
+
+    Returns
+    -------
+    result: ExperimentResult
+    """
+
+    experiment = ExperimentDataset(id, filename, varname, layout=layout)
+    result = reduce_experiment(experiment, flux_gates, obs_vals, keep_values, obs_error, sampler)
+    experiment.close()
+    return result
+
+
+def _reduce_experiment_file(task):
+    """
+    Read and reduce an experiment file in a worker process
+    """
+
+    id, filename = task
+    return read_and_reduce(
+        id,
+        filename,
+        _reduce_worker["flux_gates"],
+        _reduce_worker["layout"],
+        _reduce_worker["varname"],
+        _reduce_worker["obs_vals"],
+        _reduce_worker["keep_values"],
+        _reduce_worker["obs_error"],
+        _reduce_worker["sampler"],
+    )
+
+
+def reduce_experiments_mp(
+    filenames,
+    flux_gates,
+    layout,
+    varname,
+    obs_vals=None,
+    keep_values=False,
+    n_procs=1,
+    ids=None,
+    obs_error=None,
+    sampler=None,
+):
+    """
+    Read and reduce experiment files in a pool of processes.
+
+    Parameters
+    ----------
+    filenames: list of experiment files
+    flux_gates: list of FluxGate objects
+    layout: ProfileLayout
+    varname: string, variable name
+    obs_vals: 1-d array of packed observed values or None
+    keep_values: bool, retain profiles in results
+    n_procs: int, number of processes
+    ids: list of experiment ids, default is the position in filenames
+    obs_error: 1-d array of packed observational errors or None
+    sampler: ObservationSampler or None
+
+    Returns
+    -------
+    results : iterator of ExperimentResult, in order of filenames
+    """
+
+    if ids is None:
+        ids = list(range(len(filenames)))
+    pool = mp.Pool(
+        processes=n_procs,
+        initializer=_init_reduce_worker,
+        initargs=(flux_gates, layout, obs_vals, varname, keep_values, obs_error, sampler),
+    )
+    try:
+        for result in pool.imap(_reduce_experiment_file, list(zip(ids, filenames))):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_file_hash(filename, blocksize=2 ** 20):
+    """
+    Return the SHA-1 hex digest of the content of a file
+    """
+
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ResultCache(object):
+
+    """
+    On-disk cache of reduced experiments.
+
+    An entry holds the fluxes and misfit statistics of all flux gates of
+    one experiment file. Entries are addressed by the content hash of the
+    experiment file together with a context (variable, gates, content
+    hash of the observation file, unit settings), so they are invalidated
+    whenever any of them changes. The least recently used entries are
+    evicted once the cache grows beyond max_size.
+
+    Parameters
+    ----------
+    cache_dir: string, cache directory, created if needed
+    context: list of values the results depend on besides the experiment file
+    max_size: float, maximum size of the cache in MB
+
+    """
+
+    version = 3
+
+    def __init__(self, cache_dir, context, max_size=1024.0, *args, **kwargs):
+        super(ResultCache, self).__init__(*args, **kwargs)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.context = repr([self.version] + list(context))
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._keys = {}
+
+    def __repr__(self):
+        return "ResultCache"
+
+    def _get_path(self, filename):
+        if filename not in self._keys:
+            h = hashlib.sha1(get_file_hash(filename).encode("utf-8"))
+            h.update(self.context.encode("utf-8"))
+            self._keys[filename] = h.hexdigest()
+        return os.path.join(self.cache_dir, ".".join([self._keys[filename], "pkl"]))
+
+    def get(self, filename, id, keep_values=False):
+        """
+        Return cached result of an experiment file or None
+
+        Parameters
+        ----------
+        filename: string, experiment file
+        id: int, experiment id of the returned result
+        keep_values: bool, only entries with profiles are used
+
+        Returns
+        -------
+        result: ExperimentResult or None
+        """
+
+        path = self._get_path(filename)
+        result = None
+        if os.path.isfile(path):
+            try:
+                with open(path, "rb") as f:
+                    result = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                result = None
+        if result is None or (keep_values and result.values is None):
+            self.misses += 1
+            return None
+        # mark as recently used
+        os.utime(path, None)
+        self.hits += 1
+        result.id = id
+        if not keep_values:
+            result.values = None
+        return result
+
+    def put(self, filename, result):
+        """
+        Store result of an experiment file
+        """
+
+        path = self._get_path(filename)
+        tmp_path = ".".join([path, str(os.getpid()), "tmp"])
+        with open(tmp_path, "wb") as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits into max_size
+        """
+
+        entries = []
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith(".pkl"):
+                st = os.stat(os.path.join(self.cache_dir, entry))
+                entries.append((st.st_mtime, st.st_size, entry))
+        entries.sort()
+        size = sum([e[1] for e in entries])
+        max_bytes = self.max_size * 2 ** 20
+        for mtime, entry_size, entry in entries:
+            if size <= max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, entry))
+            size -= entry_size
+
+
+def reduce_experiments(
+    filenames,
+    flux_gates,
+    layout,
+    varname,
+    obs_vals=None,
+    keep_values=False,
+    n_procs=1,
+    cache=None,
+    ids=None,
+    obs_error=None,
+    sampler=None,
+):
+    """
+    Read and reduce experiment files, using cached results where available.
+
+    Parameters
+    ----------
+    filenames: list of experiment files
+    flux_gates: list of FluxGate objects
+    layout: ProfileLayout
+    varname: string, variable name
+    obs_vals: 1-d array of packed observed values or None
+    keep_values: bool, retain profiles in results
+    n_procs: int, number of processes
+    cache: ResultCache or None
+    ids: list of experiment ids, default is the position in filenames
+    obs_error: 1-d array of packed observational errors or None
+    sampler: ObservationSampler or None
+
+    Returns
+    -------
+    results : iterator of ExperimentResult, in order of filenames
+    """
+
+    if ids is None:
+        ids = list(range(len(filenames)))
+    cached = {}
+    if cache is not None:
+        for id, filename in zip(ids, filenames):
+            result = cache.get(filename, id, keep_values)
+            if result is not None:
+                cached[id] = result
+        print(("  found {} of {} experiments in cache {}".format(len(cached), len(filenames), cache.cache_dir)))
+    missing = [(id, filename) for id, filename in zip(ids, filenames) if id not in cached]
+    if n_procs > 1 and len(missing) > 1:
+        reduced = reduce_experiments_mp(
+            [filename for id, filename in missing],
+            flux_gates,
+            layout,
+            varname,
+            obs_vals=obs_vals,
+            keep_values=keep_values,
+            n_procs=n_procs,
+            ids=[id for id, filename in missing],
+            obs_error=obs_error,
+            sampler=sampler,
+        )
+    else:
+        reduced = (
+            read_and_reduce(id, filename, flux_gates, layout, varname, obs_vals, keep_values, obs_error, sampler)
+            for id, filename in missing
+        )
+    for id, filename in zip(ids, filenames):
+        if id in cached:
+            yield cached.pop(id)
+        else:
+            result = next(reduced)
+            if cache is not None:
+                cache.put(filename, result)
+            yield result
+    if cache is not None:
+        cache.evict()
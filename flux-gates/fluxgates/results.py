@@ -0,0 +1,419 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+netCDF files of fluxes and statistics of all gates and experiments.
+"""
+
+import os
+import itertools
+import numpy as np
+from netCDF4 import Dataset as NC
+import cf_units
+
+from .config import AnalysisConfig
+from .datasets import ExperimentResult
+from .gates import GateCatalog, FluxGate, LinearFit
+
+
+def write_results_file(filename, flux_gates, experiment_files=None, observations_hash=None):
+    """
+    Write fluxes and statistics of all flux gates and experiments to a netCDF file.
+
+    Per-gate metrics have dimension (gate), per-experiment parameters
+    (experiment) and misfit metrics (gate, experiment). The pism_config
+    and run_stats parameters of each experiment are stored in the
+    group "config".
+
+    Parameters
+    ----------
+    filename: string, name of netCDF file
+    flux_gates: list of FluxGates
+    experiment_files: list of experiment file names, ordered like the experiments
+    observations_hash: string, content hash of the observation file
+    """
+
+    gate0 = flux_gates[0]
+    analysis_config = gate0.analysis_config
+    ids = [exp.id for exp in gate0.experiments]
+    ng = len(flux_gates)
+    ne = len(ids)
+    has_stats = gate0.has_stats is True
+
+    print(("  - saving {0}".format(filename)))
+    nc = NC(filename, "w")
+    nc.createDimension("gate", ng)
+    nc.createDimension("experiment", ne)
+    nc.varname = gate0.varname
+    nc.varname_units = gate0.varname_units
+    nc.profile_axis_units = gate0.profile_axis_units
+    nc.profile_axis_name = gate0.profile_axis_name
+    if observations_hash is not None:
+        nc.observations_hash = observations_hash
+
+    var = nc.createVariable("experiment", "i4", ("experiment",))
+    var[:] = ids
+    if experiment_files is not None:
+        var = nc.createVariable("experiment_file", str, ("experiment",))
+        for k, experiment_file in enumerate(experiment_files):
+            var[k] = os.path.abspath(experiment_file)
+    write_gate_variables(nc, flux_gates)
+    if has_stats:
+        write_gate_metric(nc, flux_gates, "observed_mean", "observed_mean", gate0.varname_units)
+
+    var = nc.createVariable("flux", "f8", ("gate", "experiment"))
+    var.units = analysis_config.v_flux_o_units
+    var[:] = np.array([[gate.experiment_fluxes[id] for id in ids] for gate in flux_gates], dtype="float64")
+    if has_stats:
+        for name, attr, units, dtype in (
+            ("rmsd", "rmsd", analysis_config.v_o_units, "f8"),
+            ("N", "N_rmsd", "1", "i4"),
+            ("r", "corr", "1", "f8"),
+            ("r2", "r2", "1", "f8"),
+        ):
+            var = nc.createVariable(name, dtype, ("gate", "experiment"))
+            var.units = units
+            var[:] = np.array([[getattr(gate, attr)[id] for id in ids] for gate in flux_gates], dtype=dtype)
+        if gate0.chi2 is not None:
+            var = nc.createVariable("chi2", "f8", ("gate", "experiment"))
+            var.units = "1"
+            var.long_name = "mean squared difference weighted by observational error"
+            var[:] = np.array([[gate.chi2[id] for id in ids] for gate in flux_gates], dtype="float64")
+        for name, k in (("ols_intercept", 0), ("ols_slope", 1)):
+            var = nc.createVariable(name, "f8", ("gate", "experiment"))
+            var[:] = np.array([[gate.p_ols[id].params[k] for id in ids] for gate in flux_gates], dtype="float64")
+
+    write_config_group(nc, [exp.config for exp in gate0.experiments])
+    nc.close()
+
+
+def write_gate_metric(nc, flux_gates, name, attr, units, dtype="f8"):
+    """
+    Write a per-gate attribute of flux gates to an open netCDF file.
+
+    Nothing is written if any gate lacks the attribute.
+    """
+
+    values = [getattr(gate, attr) for gate in flux_gates]
+    if any([value is None for value in values]):
+        return
+    var = nc.createVariable(name, dtype, ("gate",))
+    var.units = units
+    var[:] = np.array(values, dtype=dtype)
+
+
+def write_gate_variables(nc, flux_gates):
+    """
+    Write gate metadata and observed fluxes to an open netCDF file
+    with a gate dimension.
+    """
+
+    gate0 = flux_gates[0]
+    v_flux_o_units = gate0.analysis_config.v_flux_o_units
+
+    def int_or_fill(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError, np.ma.MaskError):
+            return -1
+
+    var = nc.createVariable("gate", "i4", ("gate",))
+    var.long_name = "position of gate in analysis"
+    var[:] = [gate.pos_id for gate in flux_gates]
+    var = nc.createVariable("gate_name", str, ("gate",))
+    for k, gate in enumerate(flux_gates):
+        var[k] = str(gate.gate_name)
+    for name, attr in (
+        ("gate_id", "gate_id"),
+        ("flightline", "flightline"),
+        ("glacier_type", "glaciertype"),
+        ("flow_type", "flowtype"),
+    ):
+        var = nc.createVariable(name, "i4", ("gate",), fill_value=-1)
+        var[:] = [int_or_fill(getattr(gate, attr)) for gate in flux_gates]
+    for name in ("clon", "clat"):
+        var = nc.createVariable(name, "f8", ("gate",))
+        var[:] = [float(getattr(gate, name)) for gate in flux_gates]
+
+    write_gate_metric(nc, flux_gates, "observed_flux", "observed_flux", v_flux_o_units)
+    write_gate_metric(nc, flux_gates, "observed_flux_error", "observed_flux_error", v_flux_o_units)
+    write_gate_metric(nc, flux_gates, "observed_flux_p05", "observed_flux_p05", v_flux_o_units)
+    write_gate_metric(nc, flux_gates, "observed_flux_p95", "observed_flux_p95", v_flux_o_units)
+    write_gate_metric(nc, flux_gates, "sigma_obs", "sigma_obs", gate0.varname_units)
+    write_gate_metric(nc, flux_gates, "sigma_obs_N", "sigma_obs_N", "1", "i4")
+
+
+def write_config_group(nc, configs):
+    """
+    Write experiment parameters to the group "config" of an open netCDF
+    file with an experiment dimension.
+
+    Only scalar parameters are written.
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset
+    configs: list of dicts, pism_config and run_stats of each experiment
+    """
+
+    config_group = nc.createGroup("config")
+    keys = sorted(set(itertools.chain(*[list(config.keys()) for config in configs])))
+    for key in keys:
+        values = [config.get(key) for config in configs]
+        if any([np.size(value) != 1 for value in values if value is not None]):
+            continue
+        values = [None if value is None else np.asarray(value).ravel()[0] for value in values]
+        if all([isinstance(value, (str, type(None))) for value in values]):
+            var = config_group.createVariable(key, str, ("experiment",))
+            for k, value in enumerate(values):
+                var[k] = "" if value is None else value
+        else:
+            dtype = np.result_type(*[value for value in values if value is not None])
+            if dtype.kind not in "biuf":
+                continue
+            var = config_group.createVariable(key, dtype, ("experiment",))
+            var[:] = np.ma.masked_array(
+                [0 if value is None else value for value in values],
+                mask=[value is None for value in values],
+                dtype=dtype,
+            )
+
+
+def write_timeseries_file(filename, flux_gates, results, experiment_files=None, observations_hash=None):
+    """
+    Write flux and misfit time series of transient experiments to a netCDF file.
+
+    Fluxes and misfit metrics form (experiment, gate, time) cubes.
+    The time axis is the union of the time axes of all experiments,
+    records an experiment does not have are missing. Per-gate metrics
+    and experiment parameters are stored as in write_results_file.
+
+    Parameters
+    ----------
+    filename: string, name of netCDF file
+    flux_gates: list of FluxGates
+    results: list of ExperimentResults of transient experiments
+    experiment_files: list of experiment file names, ordered like results
+    observations_hash: string, content hash of the observation file
+    """
+
+    gate0 = flux_gates[0]
+    analysis_config = gate0.analysis_config
+    ng = len(flux_gates)
+    ne = len(results)
+    time_units = results[0].time_units
+    time_calendar = results[0].time_calendar
+    times = []
+    for result in results:
+        if result.time is None:
+            print(("ERROR: experiment {} has no time axis ... ending ...".format(result.id)))
+            import sys
+
+            sys.exit(1)
+        i_units = cf_units.Unit(result.time_units, calendar=result.time_calendar)
+        o_units = cf_units.Unit(time_units, calendar=time_calendar)
+        times.append(i_units.convert(result.time, o_units))
+    time = np.unique(np.concatenate(times))
+    nt = len(time)
+    stat_names = []
+    if results[0].stats is not None:
+        stat_names = [("rmsd", "rmsd"), ("N", "N_rmsd"), ("r", "corr"), ("r2", "r2")]
+        if "chi2" in results[0].stats:
+            stat_names.append(("chi2", "chi2"))
+
+    cubes = {"flux": np.full((ne, ng, nt), np.nan)}
+    for name, key in stat_names:
+        cubes[name] = np.full((ne, ng, nt), np.nan)
+    for e, result in enumerate(results):
+        k = np.searchsorted(time, times[e])
+        cubes["flux"][e][:, k] = np.reshape(result.fluxes, (len(k), ng)).T
+        for name, key in stat_names:
+            cubes[name][e][:, k] = np.reshape(result.stats[key], (len(k), ng)).T
+
+    print(("  - saving {0}".format(filename)))
+    nc = NC(filename, "w")
+    nc.createDimension("experiment", ne)
+    nc.createDimension("gate", ng)
+    nc.createDimension("time", nt)
+    nc.varname = results[0].varname
+    nc.varname_units = results[0].varname_units
+    nc.profile_axis_units = gate0.profile_axis_units
+    nc.profile_axis_name = gate0.profile_axis_name
+    if observations_hash is not None:
+        nc.observations_hash = observations_hash
+
+    var = nc.createVariable("time", "f8", ("time",))
+    var.units = time_units
+    var.calendar = time_calendar
+    var[:] = time
+    var = nc.createVariable("experiment", "i4", ("experiment",))
+    var[:] = [result.id for result in results]
+    if experiment_files is not None:
+        var = nc.createVariable("experiment_file", str, ("experiment",))
+        for k, experiment_file in enumerate(experiment_files):
+            var[k] = os.path.abspath(experiment_file)
+    write_gate_variables(nc, flux_gates)
+
+    for name, units, dtype in (
+        ("flux", analysis_config.v_flux_o_units, "f8"),
+        ("rmsd", analysis_config.v_o_units, "f8"),
+        ("N", "1", "i4"),
+        ("r", "1", "f8"),
+        ("r2", "1", "f8"),
+        ("chi2", "1", "f8"),
+    ):
+        if name not in cubes:
+            continue
+        if dtype == "i4":
+            var = nc.createVariable(name, dtype, ("experiment", "gate", "time"), fill_value=-1)
+            var[:] = np.where(np.isnan(cubes[name]), -1, cubes[name]).astype(dtype)
+        else:
+            var = nc.createVariable(name, dtype, ("experiment", "gate", "time"), fill_value=np.nan)
+            var[:] = cubes[name]
+        var.units = units
+
+    write_config_group(nc, [result.config for result in results])
+    nc.close()
+
+
+def read_results_file(filename, analysis_config=None):
+    """
+    Read flux gates from a netCDF file written by write_results_file.
+
+    The FluxGates carry fluxes and statistics, but no profiles.
+
+    Parameters
+    ----------
+    filename: string, name of netCDF file
+    analysis_config: AnalysisConfig, default is made from the variable of the file
+
+    Returns
+    -------
+    flux_gates: list of FluxGates
+    """
+
+    print(("  opening NetCDF file %s ..." % filename))
+    nc = NC(filename, "r")
+    ids = [int(id) for id in nc.variables["experiment"][:]]
+    config_group = nc.groups["config"]
+    configs = [dict() for id in ids]
+    for key, var in list(config_group.variables.items()):
+        values = var[:]
+        for k in range(len(ids)):
+            value = values[k]
+            if np.ma.is_masked(value) or (var.dtype == str and value == ""):
+                continue
+            configs[k][key] = value
+
+    varname = nc.varname
+    varname_units = nc.varname_units
+    if analysis_config is None:
+        analysis_config = AnalysisConfig(varname)
+    has_stats = "rmsd" in nc.variables
+    flux = np.ma.getdata(nc.variables["flux"][:])
+    ng = len(nc.dimensions["gate"])
+
+    def get_column(name, default=None):
+        column = np.full(ng, default, dtype=object)
+        if name in nc.variables:
+            values = nc.variables[name][:]
+            for g in range(ng):
+                if not np.ma.is_masked(values[g]):
+                    column[g] = np.ma.getdata(values[g])[()]
+        return column
+
+    # gates are stored in the order of their positions
+    catalog = GateCatalog(
+        nc.variables["gate_name"][:],
+        get_column("gate_id"),
+        get_column("clon"),
+        get_column("clat"),
+        get_column("flightline", ""),
+        get_column("glacier_type", ""),
+        get_column("flow_type", ""),
+        None,
+        nc.profile_axis_units,
+        nc.profile_axis_name,
+    )
+    flux_gates = []
+    for g in range(ng):
+
+        def get(name, default=None):
+            if name in nc.variables:
+                value = nc.variables[name][g]
+                if np.ma.is_masked(value):
+                    return default
+                return np.ma.getdata(value)[()]
+            return default
+
+        gate = FluxGate(catalog, g, analysis_config)
+        gate.varname = varname
+        gate.varname_units = varname_units
+        for k, id in enumerate(ids):
+            gate.add_experiment(ExperimentResult(id, configs[k], varname, varname_units, None))
+        gate._set_experiment_fluxes(ids, flux[g])
+        gate.has_fluxes = True
+        gate.observed_flux = get("observed_flux")
+        if gate.observed_flux is not None:
+            gate.has_observations = True
+            gate.observed_flux_units = analysis_config.v_flux_o_units_str
+        gate.observed_flux_error = get("observed_flux_error")
+        gate.observed_flux_p05 = get("observed_flux_p05")
+        gate.observed_flux_p95 = get("observed_flux_p95")
+        gate.sigma_obs = get("sigma_obs")
+        if gate.sigma_obs is not None:
+            gate.sigma_obs_N = get("sigma_obs_N")
+            gate.sigma_obs_units = varname_units
+        if has_stats:
+            rmsd = nc.variables["rmsd"][g]
+            N = nc.variables["N"][g]
+            corr = nc.variables["r"][g]
+            r2 = nc.variables["r2"][g]
+            intercept = nc.variables["ols_intercept"][g]
+            slope = nc.variables["ols_slope"][g]
+            gate.rmsd = dict((id, float(rmsd[k])) for k, id in enumerate(ids))
+            gate.N_rmsd = dict((id, int(N[k])) for k, id in enumerate(ids))
+            gate.corr = dict((id, float(corr[k])) for k, id in enumerate(ids))
+            gate.r2 = dict((id, float(r2[k])) for k, id in enumerate(ids))
+            if "chi2" in nc.variables:
+                chi2 = nc.variables["chi2"][g]
+                gate.chi2 = dict((id, float(chi2[k])) for k, id in enumerate(ids))
+            gate.S = {}
+            gate.p_ols = dict(
+                (id, LinearFit(intercept[k], slope[k], r2[k], N[k])) for k, id in enumerate(ids)
+            )
+            gate._update_best()
+            gate.rmsd_units = analysis_config.v_o_units
+            gate.S_units = "1"
+            gate.r2_units = "1"
+            gate.corr_units = "1"
+            gate.has_stats = True
+            gate.observed_mean = get("observed_mean")
+            gate.observed_mean_units = varname_units
+        flux_gates.append(gate)
+    nc.close()
+
+    return flux_gates
+
+
+def read_results_metadata(filename):
+    """
+    Read experiment files and observations hash from a results file.
+
+    Parameters
+    ----------
+    filename: string, name of netCDF file written by write_results_file
+
+    Returns
+    -------
+    experiment_files: list of absolute file names or None
+    observations_hash: string or None
+    """
+
+    nc = NC(filename, "r")
+    experiment_files = None
+    if "experiment_file" in nc.variables:
+        experiment_files = list(nc.variables["experiment_file"][:])
+    observations_hash = getattr(nc, "observations_hash", None)
+    nc.close()
+
+    return experiment_files, observations_hash
@@ -0,0 +1,652 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Sampling of gridded model output along flux gates.
+
+Gates are read from a line shapefile once. The bilinear interpolation
+from grid cells to gate points is a sparse operator with (at most) four
+non-zero weights per point; it is built once per combination of gates
+and grid and then applied to every variable and time slice of every
+file on that grid. The output has the layout of extract_profiles.py from
+pypismtools, so it can be read by read_flux_gates.
+"""
+
+import os
+import hashlib
+import multiprocessing as mp
+import numpy as np
+from netCDF4 import Dataset as NC
+
+try:
+    from osgeo import ogr, osr
+except ImportError:
+    import ogr
+    import osr
+
+
+PROFILE_FILL_VALUE = -2e9
+
+# Components normal to the gate: name, x component, y component, long_name
+NORMAL_COMPONENTS = [
+    ("velsurf_normal", "uvelsurf", "vvelsurf", "surface speed normal to gate"),
+    ("velbase_normal", "uvelbase", "vvelbase", "basal speed normal to gate"),
+    ("flux_normal", "uflux", "vflux", "flux normal to gate"),
+]
+
+# Attribute fields of gate shapefiles and the corresponding profile variables
+GATE_FIELDS = [("clon", "clon", "f8"), ("clat", "clat", "f8"), ("flightline", "flightline", "i4")]
+GATE_FIELDS += [("gtype", "glaciertype", "i4"), ("ftype", "flowtype", "i4")]
+
+# Attributes not copied from sampled variables
+SKIP_ATTRS = ("_FillValue", "missing_value", "grid_mapping", "coordinates", "valid_min", "valid_max", "valid_range")
+
+
+def resample_line(x, y, spacing):
+    """
+    Return points at equal distances along a polyline.
+
+    Parameters
+    ----------
+    x, y: 1-d arrays, vertices of the line
+    spacing: float, distance between points in units of x and y
+
+    Returns
+    -------
+    x, y: 1-d arrays of points, starting with the first vertex
+    """
+
+    s = np.concatenate([[0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+    n = int(np.floor(s[-1] / spacing)) + 1
+    s_new = np.arange(n) * spacing
+    return np.interp(s_new, s, x), np.interp(s_new, s, y)
+
+
+def get_normals(x, y, offsets):
+    """
+    Return unit normals of packed profiles.
+
+    Normals point to the right of the direction of the profile, the
+    tangent at a point is the centered difference of its neighbours.
+
+    Parameters
+    ----------
+    x, y: 1-d arrays of packed points
+    offsets: 1-d array, start of every profile and end of the last one
+
+    Returns
+    -------
+    nx, ny: 1-d arrays
+    """
+
+    tx = np.zeros_like(x)
+    ty = np.zeros_like(y)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        if end - start > 1:
+            tx[start:end] = np.gradient(x[start:end])
+            ty[start:end] = np.gradient(y[start:end])
+    norm = np.hypot(tx, ty)
+    norm[norm == 0] = 1.0
+    return ty / norm, -tx / norm
+
+
+class GateGeometry(object):
+
+    """
+    Points of all gates, packed into 1-d arrays.
+
+    Points of gate k are x[offsets[k]:offsets[k + 1]]. Gates with fewer
+    than two points are dropped.
+
+    Parameters
+    ----------
+    names: list of gate names
+    ids: list of int gate ids
+    lines: list of (x, y) arrays of points of every gate
+    columns: dict of gate attributes, e.g. {"glaciertype": [...]}
+    lon, lat: 1-d arrays of packed longitudes and latitudes or None
+
+    """
+
+    def __init__(self, names, ids, lines, columns=None, lon=None, lat=None, *args, **kwargs):
+        super(GateGeometry, self).__init__(*args, **kwargs)
+        keep = [k for k, (x, y) in enumerate(lines) if len(x) > 1]
+        self.names = [names[k] for k in keep]
+        self.ids = np.array([ids[k] for k in keep], dtype="int")
+        lengths = np.array([len(lines[k][0]) for k in keep], dtype="int")
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.x = np.concatenate([np.asarray(lines[k][0], dtype="float64") for k in keep])
+        self.y = np.concatenate([np.asarray(lines[k][1], dtype="float64") for k in keep])
+        self.columns = dict((key, [val[k] for k in keep]) for key, val in list((columns or {}).items()))
+        self.lon = lon
+        self.lat = lat
+        self.nx, self.ny = get_normals(self.x, self.y, self.offsets)
+        distance = np.zeros_like(self.x)
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            distance[start + 1 : end] = np.cumsum(np.hypot(np.diff(self.x[start:end]), np.diff(self.y[start:end])))
+        self.distance = distance
+        # Row and column of every point in padded (profile, nc) arrays
+        self.rows = np.repeat(np.arange(len(lengths)), lengths)
+        self.cols = np.arange(len(self.x)) - self.offsets[self.rows]
+
+    def __repr__(self):
+        return "GateGeometry"
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def n_points(self):
+        return int(np.max(np.diff(self.offsets)))
+
+    def get_hash(self):
+        """
+        Return the SHA-1 hex digest of the gate points
+        """
+
+        h = hashlib.sha1(self.x.tobytes())
+        h.update(self.y.tobytes())
+        h.update(self.offsets.tobytes())
+        return h.hexdigest()
+
+    def unpack(self, values):
+        """
+        Return packed values as (profile, nc) or (profile, time, nc) masked array
+
+        Parameters
+        ----------
+        values: (..., n) array of packed values, possibly masked
+        """
+
+        values = np.ma.asarray(values)
+        lead = values.shape[:-1]
+        out = np.ma.masked_all((len(self),) + lead + (self.n_points,), dtype=values.dtype)
+        if lead:
+            out[self.rows, ..., self.cols] = np.moveaxis(values, -1, 0)
+        else:
+            out[self.rows, self.cols] = values
+        return out
+
+
+def read_gate_lines(filename, spacing=None, proj4=None):
+    """
+    Read flux gates from a line shapefile.
+
+    Parameters
+    ----------
+    filename: string, line shapefile, e.g. greenland-flux-gates-29.shp
+    spacing: float, resample gates at this distance, or None to use the vertices
+    proj4: string, projection of the model grid, or None if gates and grid
+           share the projection
+
+    Returns
+    -------
+    geometry: GateGeometry in the coordinates of the grid
+    """
+
+    ds = ogr.Open(filename)
+    if ds is None:
+        raise IOError("could not open {}".format(filename))
+    layer = ds.GetLayer(0)
+    src_srs = layer.GetSpatialRef()
+    dst_srs = src_srs
+    if proj4 is not None:
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromProj4(proj4)
+    geo_srs = osr.SpatialReference()
+    geo_srs.ImportFromEPSG(4326)
+    for srs in (src_srs, dst_srs, geo_srs):
+        if srs is not None and hasattr(srs, "SetAxisMappingStrategy"):
+            # lon, lat order with GDAL >= 3
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_grid = None
+    if proj4 is not None and src_srs is not None:
+        to_grid = osr.CoordinateTransformation(src_srs, dst_srs)
+    to_geo = None
+    if dst_srs is not None:
+        to_geo = osr.CoordinateTransformation(dst_srs, geo_srs)
+
+    layer_defn = layer.GetLayerDefn()
+    field_names = [layer_defn.GetFieldDefn(k).GetName() for k in range(layer_defn.GetFieldCount())]
+    names = []
+    ids = []
+    lines = []
+    columns = dict((name, []) for field, name, dtype in GATE_FIELDS if field in field_names)
+    lon = []
+    lat = []
+    for k, feature in enumerate(layer):
+        geometry = feature.GetGeometryRef()
+        if to_grid is not None:
+            geometry.Transform(to_grid)
+        points = np.array(geometry.GetPoints(), dtype="float64")
+        x, y = points[:, 0], points[:, 1]
+        if spacing is not None:
+            x, y = resample_line(x, y, spacing)
+        lines.append((x, y))
+        if "name" in field_names:
+            names.append(feature.GetField("name"))
+        else:
+            names.append("Gate {}".format(k))
+        if "id" in field_names and feature.GetField("id") is not None:
+            ids.append(int(feature.GetField("id")))
+        else:
+            ids.append(k)
+        for field, name, dtype in GATE_FIELDS:
+            if name in columns:
+                columns[name].append(feature.GetField(field))
+        if to_geo is not None:
+            geo = np.array(to_geo.TransformPoints(np.column_stack([x, y]).tolist()), dtype="float64")
+            lon.append(geo[:, 0])
+            lat.append(geo[:, 1])
+    ds = None
+
+    geometry = GateGeometry(names, ids, lines, columns)
+    if to_geo is not None and len(geometry):
+        keep = [k for k, (x, y) in enumerate(lines) if len(x) > 1]
+        geometry.lon = np.concatenate([lon[k] for k in keep])
+        geometry.lat = np.concatenate([lat[k] for k in keep])
+    return geometry
+
+
+def get_grid_projection(nc):
+    """
+    Return the proj4 string of the grid of a PISM file, or None
+    """
+
+    for attr in ("proj", "proj4"):
+        if attr in nc.ncattrs():
+            return getattr(nc, attr)
+    for var in list(nc.variables.values()):
+        for attr in ("proj4text", "proj4", "proj_params"):
+            if attr in var.ncattrs():
+                return getattr(var, attr)
+    return None
+
+
+def get_grid(nc):
+    """
+    Return the coordinates of the horizontal grid of a file
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset with dimensions x and y
+
+    Returns
+    -------
+    x, y: 1-d arrays of cell centers
+    """
+
+    return np.asarray(nc.variables["x"][:], dtype="float64"), np.asarray(nc.variables["y"][:], dtype="float64")
+
+
+class InterpolationOperator(object):
+
+    """
+    Bilinear interpolation from a grid to gate points.
+
+    A sparse (n_points x n_cells) matrix stored row-wise with four
+    weights per point (ELLPACK format). Only the window of the grid that
+    contains all points is read from files, column indices refer to
+    cells of that window. Points outside the grid are masked; a point is
+    also masked if a cell with non-zero weight is masked.
+
+    Parameters
+    ----------
+    x, y: 1-d arrays of equally spaced cell centers of the grid
+    px, py: 1-d arrays of points in grid coordinates
+
+    """
+
+    def __init__(self, x=None, y=None, px=None, py=None, *args, **kwargs):
+        super(InterpolationOperator, self).__init__(*args, **kwargs)
+        if x is None:
+            return
+        fi = (px - x[0]) / (x[1] - x[0])
+        fj = (py - y[0]) / (y[1] - y[0])
+        self.inside = (fi >= 0) & (fi <= len(x) - 1) & (fj >= 0) & (fj <= len(y) - 1)
+        fi = np.clip(fi, 0, len(x) - 1)
+        fj = np.clip(fj, 0, len(y) - 1)
+        i0 = np.minimum(np.floor(fi).astype("int"), max(len(x) - 2, 0))
+        j0 = np.minimum(np.floor(fj).astype("int"), max(len(y) - 2, 0))
+        a = fi - i0
+        b = fj - j0
+        if np.any(self.inside):
+            self.window = np.array(
+                [j0[self.inside].min(), j0[self.inside].max() + 2, i0[self.inside].min(), i0[self.inside].max() + 2]
+            )
+        else:
+            self.window = np.array([0, 1, 0, 1])
+        self.window[1] = min(self.window[1], len(y))
+        self.window[3] = min(self.window[3], len(x))
+        j0w = np.clip(j0 - self.window[0], 0, self.window[1] - self.window[0] - 1)
+        i0w = np.clip(i0 - self.window[2], 0, self.window[3] - self.window[2] - 1)
+        nxw = self.window[3] - self.window[2]
+        nyw = self.window[1] - self.window[0]
+        j1w = np.minimum(j0w + 1, nyw - 1)
+        i1w = np.minimum(i0w + 1, nxw - 1)
+        self.indices = np.column_stack([j0w * nxw + i0w, j0w * nxw + i1w, j1w * nxw + i0w, j1w * nxw + i1w])
+        self.weights = np.column_stack([(1 - a) * (1 - b), a * (1 - b), (1 - a) * b, a * b])
+        self.weights[~self.inside] = 0.0
+
+    def __repr__(self):
+        return "InterpolationOperator"
+
+    def get_slices(self):
+        """
+        Return the (y, x) slices of the window of the grid
+        """
+
+        return slice(self.window[0], self.window[1]), slice(self.window[2], self.window[3])
+
+    def apply(self, values):
+        """
+        Interpolate values on the window of the grid to the points
+
+        Parameters
+        ----------
+        values: (..., ny, nx) array of the window, possibly masked
+
+        Returns
+        -------
+        profile : (..., n_points) masked array
+        """
+
+        values = np.ma.asarray(values)
+        flat = values.reshape(values.shape[:-2] + (-1,))
+        data = np.ma.filled(flat.astype("float64"), 0.0)
+        result = np.sum(data[..., self.indices] * self.weights, axis=-1)
+        mask = ~self.inside
+        if np.ma.is_masked(flat):
+            mask = mask | np.any(np.ma.getmaskarray(flat)[..., self.indices] & (self.weights > 0), axis=-1)
+        return np.ma.masked_array(result, mask=np.broadcast_to(mask, result.shape))
+
+    def save(self, filename):
+        """
+        Save operator to a npz file
+        """
+
+        tmp_filename = ".".join([filename, str(os.getpid()), "tmp.npz"])
+        np.savez(tmp_filename, window=self.window, indices=self.indices, weights=self.weights, inside=self.inside)
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load operator from a npz file
+        """
+
+        operator = cls()
+        with np.load(filename) as f:
+            operator.window = f["window"]
+            operator.indices = f["indices"]
+            operator.weights = f["weights"]
+            operator.inside = f["inside"]
+        return operator
+
+
+_operators = {}
+
+
+def get_interpolation_operator(geometry, x, y, cache_dir=None):
+    """
+    Return the interpolation operator from a grid to the points of gates.
+
+    Operators are kept for the lifetime of the process and, if cache_dir
+    is given, on disk, addressed by the gate points and grid coordinates.
+
+    Parameters
+    ----------
+    geometry: GateGeometry
+    x, y: 1-d arrays of cell centers of the grid
+    cache_dir: string or None
+
+    Returns
+    -------
+    operator : InterpolationOperator
+    """
+
+    h = hashlib.sha1(geometry.get_hash().encode("utf-8"))
+    h.update(x.tobytes())
+    h.update(y.tobytes())
+    key = h.hexdigest()
+    if key in _operators:
+        return _operators[key]
+    operator = None
+    filename = None
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        filename = os.path.join(cache_dir, ".".join(["operator", key, "npz"]))
+        if os.path.isfile(filename):
+            operator = InterpolationOperator.load(filename)
+    if operator is None:
+        operator = InterpolationOperator(x, y, geometry.x, geometry.y)
+        if filename is not None:
+            operator.save(filename)
+    _operators[key] = operator
+    return operator
+
+
+def get_grid_variables(nc, variables=None):
+    """
+    Return the names of variables of a file that can be sampled.
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset
+    variables: list of names or None for all variables on the (y, x) grid.
+               Components of normal velocities and fluxes are added.
+
+    Returns
+    -------
+    names : list of strings
+    normals : list of NORMAL_COMPONENTS that can be calculated
+    """
+
+    on_grid = [name for name, var in list(nc.variables.items()) if var.dimensions[-2:] == ("y", "x")]
+    on_grid = [name for name in on_grid if nc.variables[name].dimensions in (("y", "x"), ("time", "y", "x"))]
+    if variables is None:
+        names = [name for name in on_grid if name not in ("x", "y", "lon", "lat", "lon_bnds", "lat_bnds")]
+    else:
+        names = [name for name in variables if name in on_grid]
+    normals = []
+    for normal in NORMAL_COMPONENTS:
+        name, u, v, long_name = normal
+        if (variables is None or name in variables) and u in on_grid and v in on_grid:
+            normals.append(normal)
+            for component in (u, v):
+                if component not in names:
+                    names.append(component)
+    return names, normals
+
+
+def write_profile_header(nc, geometry, has_time):
+    """
+    Write dimensions and gate variables of a profile file
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset open for writing
+    geometry: GateGeometry
+    has_time: bool, create a time dimension
+    """
+
+    nc.createDimension("profile", len(geometry))
+    nc.createDimension("nc", geometry.n_points)
+    if has_time:
+        nc.createDimension("time", None)
+    var = nc.createVariable("profile_name", str, ("profile",))
+    for k, name in enumerate(geometry.names):
+        var[k] = name
+    var = nc.createVariable("profile_id", "i4", ("profile",))
+    var[:] = geometry.ids
+    var = nc.createVariable("profile_axis", "f8", ("profile", "nc"), fill_value=PROFILE_FILL_VALUE)
+    var.units = "m"
+    var.long_name = "distance along profile"
+    var[:] = geometry.unpack(geometry.distance)
+    for name, long_name, values in (
+        ("nx", "x-component of the right-hand-pointing normal vector", geometry.nx),
+        ("ny", "y-component of the right-hand-pointing normal vector", geometry.ny),
+        ("lon", "longitude", geometry.lon),
+        ("lat", "latitude", geometry.lat),
+    ):
+        if values is None:
+            continue
+        var = nc.createVariable(name, "f8", ("profile", "nc"), fill_value=PROFILE_FILL_VALUE)
+        var.long_name = long_name
+        if name in ("lon", "lat"):
+            var.units = "degrees_east" if name == "lon" else "degrees_north"
+        var[:] = geometry.unpack(values)
+    for field, name, dtype in GATE_FIELDS:
+        if name in geometry.columns:
+            values = [np.nan if val is None else val for val in geometry.columns[name]]
+            values = np.ma.masked_invalid(np.array(values, dtype="float64"))
+            nc.createVariable(name, dtype, ("profile",))[:] = values
+    if "clon" not in geometry.columns and geometry.lon is not None:
+        center = geometry.offsets[:-1] + np.diff(geometry.offsets) // 2
+        nc.createVariable("clon", "f8", ("profile",))[:] = geometry.lon[center]
+        nc.createVariable("clat", "f8", ("profile",))[:] = geometry.lat[center]
+
+
+def sample_profiles(filename, ofilename, geometry, variables=None, cache_dir=None):
+    """
+    Sample variables of a gridded file along flux gates and write a profile file.
+
+    Every variable is read once per time slice, restricted to the
+    window of the grid that contains the gates, and interpolated with
+    one sparse product. Normal components (see NORMAL_COMPONENTS) are
+    calculated from the sampled components in the same pass. Variables
+    without dimensions, e.g. pism_config and run_stats, are copied.
+
+    Parameters
+    ----------
+    filename: string, gridded file
+    ofilename: string, profile file
+    geometry: GateGeometry in grid coordinates
+    variables: list of variables to sample or None for all
+    cache_dir: string, directory of cached interpolation operators or None
+    """
+
+    nc = NC(filename, "r")
+    x, y = get_grid(nc)
+    operator = get_interpolation_operator(geometry, x, y, cache_dir=cache_dir)
+    j_slice, i_slice = operator.get_slices()
+    names, normals = get_grid_variables(nc, variables)
+    has_time = "time" in nc.dimensions and any(["time" in nc.variables[name].dimensions for name in names])
+    n_times = len(nc.dimensions["time"]) if has_time else 0
+
+    tmp_filename = ".".join([ofilename, str(os.getpid()), "tmp"])
+    out = NC(tmp_filename, "w", format="NETCDF4")
+    for attr in nc.ncattrs():
+        out.setncattr(attr, nc.getncattr(attr))
+    write_profile_header(out, geometry, has_time)
+    if has_time:
+        time = nc.variables["time"]
+        var = out.createVariable("time", time.dtype, ("time",))
+        var.setncatts(dict((attr, time.getncattr(attr)) for attr in time.ncattrs() if attr not in SKIP_ATTRS))
+        var[:] = time[:]
+        if "time_bounds" in nc.variables and "nv" in nc.dimensions:
+            out.createDimension("nv", len(nc.dimensions["nv"]))
+            out.createVariable("time_bounds", "f8", ("time", "nv"))[:] = nc.variables["time_bounds"][:]
+
+    out_vars = {}
+    for name in names + [normal[0] for normal in normals]:
+        if name in nc.variables:
+            src = nc.variables[name]
+            timed = "time" in src.dimensions
+            attrs = dict((attr, src.getncattr(attr)) for attr in src.ncattrs() if attr not in SKIP_ATTRS)
+        else:
+            normal = [n for n in normals if n[0] == name][0]
+            src = nc.variables[normal[1]]
+            timed = "time" in src.dimensions or "time" in nc.variables[normal[2]].dimensions
+            attrs = dict((attr, src.getncattr(attr)) for attr in ("units",) if attr in src.ncattrs())
+            attrs["long_name"] = normal[3]
+        dims = ("profile", "time", "nc") if timed else ("profile", "nc")
+        dtype = src.dtype if src.dtype.kind == "f" else "f8"
+        var = out.createVariable(name, dtype, dims, fill_value=PROFILE_FILL_VALUE, zlib=True)
+        var.setncatts(attrs)
+        out_vars[name] = (var, timed)
+    for name, var in list(nc.variables.items()):
+        if var.dimensions == () and name not in out.variables:
+            ovar = out.createVariable(name, var.dtype)
+            ovar.setncatts(dict((attr, var.getncattr(attr)) for attr in var.ncattrs() if attr not in SKIP_ATTRS))
+
+    for t in range(max(n_times, 1)):
+        profiles = {}
+        for name in names:
+            src = nc.variables[name]
+            if "time" in src.dimensions:
+                values = src[t, j_slice, i_slice]
+            elif t == 0:
+                values = src[j_slice, i_slice]
+            else:
+                continue
+            profiles[name] = operator.apply(values)
+        for name, u, v, long_name in normals:
+            if u in profiles and v in profiles:
+                profiles[name] = profiles[u] * geometry.nx + profiles[v] * geometry.ny
+        for name, values in list(profiles.items()):
+            var, timed = out_vars[name]
+            if timed:
+                var[:, t, :] = geometry.unpack(values)
+            else:
+                var[:] = geometry.unpack(values)
+    nc.close()
+    out.close()
+    os.rename(tmp_filename, ofilename)
+
+
+def _init_sample_worker(geometry, variables, cache_dir):
+    """
+    Initialize a sampling worker process
+    """
+
+    global _worker_args
+    _worker_args = (geometry, variables, cache_dir)
+
+
+def _sample_profiles_file(task):
+    """
+    Sample one file in a worker process
+    """
+
+    filename, ofilename = task
+    geometry, variables, cache_dir = _worker_args
+    sample_profiles(filename, ofilename, geometry, variables=variables, cache_dir=cache_dir)
+    return ofilename
+
+
+def sample_profiles_mp(filenames, ofilenames, geometry, variables=None, cache_dir=None, n_procs=1):
+    """
+    Sample files along flux gates in a pool of processes.
+
+    The gates are sent to the workers once. Interpolation operators
+    built before the pool is started are inherited by forked workers,
+    others are built once per worker or loaded from cache_dir.
+
+    Parameters
+    ----------
+    filenames: list of gridded files
+    ofilenames: list of profile files
+    geometry: GateGeometry
+    variables: list of variables to sample or None for all
+    cache_dir: string or None
+    n_procs: int, number of processes
+
+    Returns
+    -------
+    generator of written profile files
+    """
+
+    tasks = list(zip(filenames, ofilenames))
+    if n_procs == 1:
+        for task in tasks:
+            sample_profiles(task[0], task[1], geometry, variables=variables, cache_dir=cache_dir)
+            yield task[1]
+        return
+    pool = mp.Pool(processes=n_procs, initializer=_init_sample_worker, initargs=(geometry, variables, cache_dir))
+    try:
+        for ofilename in pool.imap(_sample_profiles_file, tasks):
+            yield ofilename
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,354 @@
+# Copyright (C) 2014-2020 Andy Aschwanden
+
+"""
+Misfit statistics of packed profiles.
+"""
+
+import warnings
+import numpy as np
+import pandas as pa
+
+
+def get_rmsd(a, b, w=None):
+    """
+    Returns the (weighted) root mean square differences between a and b.
+
+    Parameters
+    ----------
+    a, b : array_like
+    w : weights
+
+    Returns
+    -------
+    rmsd : scalar
+    """
+
+    if w is None:
+        w = np.ones_like(a)
+    # If observations or errors have missing values, don't count them
+    c = (a.ravel() - b.ravel()) / w.ravel()
+    if isinstance(c, np.ma.MaskedArray):
+        # count all non-masked elements
+        N = c.count()
+        # reduce to non-masked elements
+        return np.sqrt(np.linalg.norm(np.ma.compressed(c), 2) ** 2.0 / N), N
+    else:
+        N = c.shape[0]
+        return np.sqrt(np.linalg.norm(c, 2) ** 2.0 / N), N
+
+
+def get_observed_values(values):
+    """
+    Returns observed values prepared for comparison with experiments.
+
+    Observations that are missing or zero are set to zero.
+
+    Parameters
+    ----------
+    values: array_like, observed profile(s)
+
+    Returns
+    -------
+    obs_vals : array
+    """
+
+    obs_vals = np.squeeze(values)
+    # mask values where obs is zero
+    obs_vals = np.ma.masked_where(obs_vals == 0, obs_vals)
+    # mask missing values
+    obs_vals = np.ma.masked_invalid(obs_vals)
+    if isinstance(obs_vals, np.ma.MaskedArray):
+        obs_vals = obs_vals.filled(0)
+    return obs_vals
+
+
+def segment_sum(a, offsets):
+    """
+    Returns sums over segments of packed profiles.
+
+    Parameters
+    ----------
+    a : array_like (..., n), packed values
+    offsets : 1-d array (n_segments + 1), segment k is a[..., offsets[k]:offsets[k + 1]]
+
+    Returns
+    -------
+    sums : array (..., n_segments), zero for empty segments
+    """
+
+    a = np.asarray(a)
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    sums = np.zeros(a.shape[:-1] + lengths.shape, dtype=a.dtype)
+    # Empty segments are dropped, so that each remaining start is
+    # followed by the start of the next non-empty segment
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        sums[..., nonempty] = np.add.reduceat(a[..., : offsets[-1]], offsets[:-1][nonempty], axis=-1)
+    return sums
+
+
+def segment_trapz(y, x, offsets):
+    """
+    Return line integrals of packed profiles using the composite trapezoidal rule
+
+    All segments (profiles) of all leading dimensions are integrated
+    at once. Missing (NaN) values are treated as zero.
+
+    Parameters
+    ----------
+    y : array_like (..., n), packed values to integrate
+    x : 1-d array_like (n), packed profile axis
+    offsets : 1-d array (n_segments + 1), segment k is y[..., offsets[k]:offsets[k + 1]]
+
+    Returns
+    -------
+    trapz : array (..., n_segments)
+            Definite integrals as approximated by trapezoidal rule.
+    """
+
+    y = np.ma.filled(np.ma.masked_invalid(y), 0)
+    x = np.asarray(x)
+    n = x.shape[-1]
+    if n < 2:
+        return np.zeros(y.shape[:-1] + (len(offsets) - 1,))
+    parts = np.diff(x) * (y[..., 1:] + y[..., :-1]) / 2.0
+    # Intervals between the last point of a profile and the first
+    # point of the next one do not belong to any profile
+    starts = offsets[1:-1]
+    starts = starts[(starts > 0) & (starts < n)]
+    parts[..., starts - 1] = 0
+    return segment_sum(parts, np.minimum(offsets, n - 1))
+
+
+def get_segment_stats(exp_vals, obs_vals, offsets, obs_error=None):
+    """
+    Returns misfit statistics between experiments and observations.
+
+    All statistics are computed with a few segmented reductions along
+    the last (packed profile) axis, which allows to process any number
+    of gates and experiments at once. Points where either experiment
+    or observation are missing (NaN) are ignored.
+
+    Parameters
+    ----------
+    exp_vals : array_like (..., n), packed experiment values
+    obs_vals : array_like (..., n), packed observed values, must be
+               broadcastable to exp_vals
+    offsets : 1-d array (n_segments + 1), segment k is exp_vals[..., offsets[k]:offsets[k + 1]]
+    obs_error : array_like (..., n), packed observational errors or None
+
+    Returns
+    -------
+    stats : dict with arrays of shape exp_vals.shape[:-1] + (n_segments,)
+            rmsd: root mean square difference
+            N_rmsd: number of points used for rmsd
+            corr: Pearson correlation coefficient
+            r2: coefficient of determination of OLS fit exp ~ obs
+            slope, intercept: OLS parameters
+            N: number of points used for correlation and regression
+            chi2: mean squared difference weighted by the observational
+                  error, only if obs_error is given. Points without a
+                  positive error are ignored.
+    """
+
+    exp_vals = np.ma.filled(np.ma.masked_invalid(exp_vals), np.nan)
+    obs_vals = np.ma.filled(np.ma.masked_invalid(obs_vals), np.nan)
+    lengths = np.diff(offsets)
+    valid = np.isfinite(exp_vals) & np.isfinite(obs_vals)
+    N = segment_sum(valid.astype("int64"), offsets)
+    x = np.where(valid, obs_vals, 0)
+    y = np.where(valid, exp_vals, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rmsd = np.sqrt(segment_sum((y - x) ** 2, offsets) / N)
+        x_mean = segment_sum(x, offsets) / N
+        y_mean = segment_sum(y, offsets) / N
+        dx = np.where(valid, x - np.repeat(x_mean, lengths, axis=-1), 0)
+        dy = np.where(valid, y - np.repeat(y_mean, lengths, axis=-1), 0)
+        sxx = segment_sum(dx * dx, offsets)
+        syy = segment_sum(dy * dy, offsets)
+        sxy = segment_sum(dx * dy, offsets)
+        corr = sxy / np.sqrt(sxx * syy)
+        slope = sxy / sxx
+        intercept = y_mean - slope * x_mean
+        # for a simple linear regression with intercept, R^2 = r^2
+        r2 = corr ** 2
+    corr = np.where(N > 1, corr, np.nan)
+    r2 = np.where(N > 1, r2, np.nan)
+    stats = {"rmsd": rmsd, "N_rmsd": N, "corr": corr, "r2": r2, "slope": slope, "intercept": intercept, "N": N}
+    if obs_error is not None:
+        sigma = np.ma.filled(np.ma.masked_invalid(obs_error), np.nan)
+        weighted = valid & (np.nan_to_num(sigma) > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            residual = np.where(weighted, (y - x) / np.where(weighted, sigma, 1), 0)
+            stats["chi2"] = segment_sum(residual ** 2, offsets) / segment_sum(weighted.astype("int64"), offsets)
+
+    return stats
+
+
+def get_batch_stats(exp_vals, obs_vals, obs_error=None):
+    """
+    Returns misfit statistics between experiments and observations.
+
+    Like get_segment_stats, for profiles of equal length stacked along
+    the leading dimensions. Points where either experiment or
+    observation are masked are ignored.
+
+    Parameters
+    ----------
+    exp_vals : array_like (..., n_points), experiment values
+    obs_vals : array_like (..., n_points), observed values, must be
+               broadcastable to exp_vals
+    obs_error : array_like (..., n_points), observational errors or None
+
+    Returns
+    -------
+    stats : dict with arrays of shape exp_vals.shape[:-1], see get_segment_stats
+    """
+
+    exp_vals = np.ma.filled(np.ma.masked_invalid(exp_vals).astype("float64"), np.nan)
+    obs_vals = np.ma.filled(np.ma.masked_invalid(obs_vals).astype("float64"), np.nan)
+    offsets = np.array([0, exp_vals.shape[-1]])
+    if obs_error is not None:
+        obs_error = np.ma.filled(np.ma.masked_invalid(obs_error).astype("float64"), np.nan)
+    stats = get_segment_stats(exp_vals, obs_vals, offsets, obs_error)
+    return dict((key, val[..., 0]) for key, val in list(stats.items()))
+
+
+def get_sample_rmsd(exp_vals, sampler):
+    """
+    Returns the RMSD of an experiment from every perturbed observation.
+
+    Points of all gates are pooled, so the RMSD of a sample is the
+    N-weighted cumulative RMSD used to rank experiments.
+
+    Parameters
+    ----------
+    exp_vals : array_like (n), packed experiment values
+    sampler : ObservationSampler
+
+    Returns
+    -------
+    rmsd : array (n_samples)
+    """
+
+    exp_vals = np.ma.filled(np.ma.masked_invalid(exp_vals), np.nan)
+    valid = np.isfinite(exp_vals) & np.isfinite(sampler.obs_vals)
+    y = np.where(valid, exp_vals, 0)
+    sse = np.concatenate([np.sum(np.where(valid, y - samples, 0) ** 2, axis=-1) for samples in sampler.chunks()])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(sse / valid.sum())
+
+
+class ObservationSampler(object):
+
+    """
+    Draws perturbed observed profiles for Monte Carlo error propagation.
+
+    Observed values are perturbed by normally distributed errors with
+    the observational error as standard deviation, either independently
+    at every point or fully correlated along each profile. Samples are
+    drawn in chunks from generators seeded with (seed, chunk), so every
+    process draws the same samples.
+
+    Parameters
+    ----------
+    obs_vals: 1-d array (n), packed observed values
+    obs_error: 1-d array (n), packed observational errors
+    offsets: 1-d array, profile offsets, see ProfileLayout
+    n_samples: int, number of samples
+    seed: int, seed of the random number generator
+    correlated: bool, errors are fully correlated along profiles
+    chunk_size: int, number of samples drawn at once
+
+    """
+
+    def __init__(
+        self, obs_vals, obs_error, offsets, n_samples, seed=0, correlated=False, chunk_size=100, *args, **kwargs
+    ):
+        super(ObservationSampler, self).__init__(*args, **kwargs)
+        self.obs_vals = np.asarray(obs_vals, dtype="float64")
+        self.obs_error = np.nan_to_num(np.ma.filled(np.ma.masked_invalid(obs_error), 0).astype("float64"))
+        self.lengths = np.diff(offsets)
+        self.n_samples = n_samples
+        self.seed = seed
+        self.correlated = correlated
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return "ObservationSampler"
+
+    def chunks(self):
+        """
+        Iterate over chunks of samples
+
+        Returns
+        -------
+        samples : iterator of arrays (chunk size, n)
+        """
+
+        for k, start in enumerate(range(0, self.n_samples, self.chunk_size)):
+            size = min(self.chunk_size, self.n_samples - start)
+            rng = np.random.default_rng([self.seed, k])
+            if self.correlated:
+                z = np.repeat(rng.standard_normal((size, len(self.lengths))), self.lengths, axis=-1)
+            else:
+                z = rng.standard_normal((size, len(self.obs_vals)))
+            yield self.obs_vals + self.obs_error * z
+
+
+def get_ranking_robustness(rmsd_samples):
+    """
+    Return how robust the RMSD ranking of experiments is to observational errors.
+
+    Experiments are ranked for every sample of perturbed observations.
+
+    Parameters
+    ----------
+    rmsd_samples: dict of 1-d arrays (n_samples), cumulative RMSD of
+                  each experiment id, see get_sample_rmsd
+
+    Returns
+    -------
+    robustness : pandas.DataFrame indexed by experiment with columns
+                 p_best (fraction of samples the experiment ranks first),
+                 mean_rank, rank_05 and rank_95 (5th and 95th percentile
+                 of the rank), rmsd_05 and rmsd_95
+    """
+
+    ids = sorted(rmsd_samples)
+    rmsd = np.array([rmsd_samples[id] for id in ids])
+    # rank 1 is the lowest RMSD
+    ranks = np.argsort(np.argsort(rmsd, axis=0), axis=0) + 1
+    return pa.DataFrame(
+        {
+            "p_best": np.mean(ranks == 1, axis=1),
+            "mean_rank": np.mean(ranks, axis=1),
+            "rank_05": np.percentile(ranks, 5, axis=1),
+            "rank_95": np.percentile(ranks, 95, axis=1),
+            "rmsd_05": np.percentile(rmsd, 5, axis=1),
+            "rmsd_95": np.percentile(rmsd, 95, axis=1),
+        },
+        index=pa.Index(ids, name="experiment"),
+    )
+
+
+def get_ensemble_percentiles(exp_vals, q=(5, 16, 50, 84, 95)):
+    """
+    Returns per-point percentiles of an ensemble of profiles.
+
+    Parameters
+    ----------
+    exp_vals : array_like (n_experiments, ..., n), missing values are NaN
+    q : sequence of percentiles
+
+    Returns
+    -------
+    percentiles : array (len(q), ..., n), NaN where all experiments are missing
+    """
+
+    exp_vals = np.ma.filled(np.ma.masked_invalid(exp_vals).astype("float64"), np.nan)
+    with warnings.catch_warnings():
+        # all-NaN slices at missing points
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanpercentile(exp_vals, q, axis=0)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Copyright (C) 2020 Andy Aschwanden
+
+import os
+import time
+from argparse import ArgumentParser
+from netCDF4 import Dataset as NC
+
+from fluxgates import get_grid, get_grid_projection, get_interpolation_operator, read_gate_lines, sample_profiles_mp
+
+
+if __name__ == "__main__":
+
+    __spec__ = None
+
+    parser = ArgumentParser()
+    parser.description = """Sample gridded PISM files along flux gates and write profile files.
+    The interpolation from the grid to the gates is calculated once for all files on the same grid.
+    Normal components of surface and basal velocities and of fluxes are added."""
+    parser.add_argument("SHAPEFILE", nargs=1, help="Line shapefile with flux gates")
+    parser.add_argument("FILE", nargs="+", help="Gridded files, all on the same grid")
+    parser.add_argument(
+        "--cache_dir",
+        dest="cache_dir",
+        help="""Directory to cache interpolation weights between runs. Default is None (no caching)""",
+        default=None,
+    )
+    parser.add_argument(
+        "--n_procs", dest="n_procs", type=int, help="""Number of processes to sample files. Default=1""", default=1
+    )
+    parser.add_argument("--o_dir", dest="odir", help="Output directory. Default: current directory", default=".")
+    parser.add_argument(
+        "--prefix",
+        dest="prefix",
+        help="""Prefix of profile files, e.g. profiles_250m_greenland_. Default=profiles_""",
+        default="profiles_",
+    )
+    parser.add_argument(
+        "--overwrite", dest="overwrite", action="store_true", help="Overwrite existing profile files", default=False
+    )
+    parser.add_argument(
+        "--spacing",
+        dest="spacing",
+        type=float,
+        help="""Resample flux gates at this distance in meters. Default is None (use the vertices of the gates)""",
+        default=None,
+    )
+    parser.add_argument(
+        "-v",
+        "--variables",
+        dest="variables",
+        help="""Comma-separated list of variables to sample. Default is None (all variables on the grid)""",
+        default=None,
+    )
+
+    options = parser.parse_args()
+    shapefile = options.SHAPEFILE[0]
+    args = options.FILE
+    cache_dir = options.cache_dir
+    n_procs = options.n_procs
+    odir = options.odir
+    prefix = options.prefix
+    overwrite = options.overwrite
+    spacing = options.spacing
+    variables = options.variables
+    if variables is not None:
+        variables = list(variables.split(","))
+
+    if not os.path.exists(odir):
+        os.makedirs(odir)
+
+    filenames = []
+    ofilenames = []
+    for filename in args:
+        ofilename = os.path.join(odir, "".join([prefix, os.path.basename(filename)]))
+        if os.path.isfile(ofilename) and not overwrite:
+            print(("{} exists, skipping".format(ofilename)))
+            continue
+        filenames.append(filename)
+        ofilenames.append(ofilename)
+    if not filenames:
+        import sys
+
+        sys.exit(0)
+
+    filename = filenames[0]
+    print(("  opening NetCDF file %s ..." % filename))
+    try:
+        nc0 = NC(filename, "r")
+    except:
+        print(("ERROR:  file '%s' not found or not NetCDF format ... ending ..." % filename))
+        import sys
+
+        sys.exit(1)
+    proj4 = get_grid_projection(nc0)
+    x, y = get_grid(nc0)
+    nc0.close()
+
+    print(("  reading flux gates from %s ..." % shapefile))
+    try:
+        geometry = read_gate_lines(shapefile, spacing=spacing, proj4=proj4)
+    except IOError as e:
+        print(("ERROR: {} ... ending ...".format(e)))
+        import sys
+
+        sys.exit(1)
+    print(("  {} gates with {} points".format(len(geometry), len(geometry.x))))
+
+    # Build the interpolation operator before the worker processes are started
+    t0 = time.perf_counter()
+    get_interpolation_operator(geometry, x, y, cache_dir=cache_dir)
+    print(("  interpolation weights ready after {:.2f}s".format(time.perf_counter() - t0)))
+
+    t0 = time.perf_counter()
+    for k, ofilename in enumerate(
+        sample_profiles_mp(filenames, ofilenames, geometry, variables=variables, cache_dir=cache_dir, n_procs=n_procs)
+    ):
+        print(("  - saving {} ({}/{})".format(ofilename, k + 1, len(ofilenames))))
+    print(("  sampled {} files in {:.2f}s".format(len(ofilenames), time.perf_counter() - t0)))
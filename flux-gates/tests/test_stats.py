@@ -0,0 +1,28 @@
+# Copyright (C) 2020 Andy Aschwanden
+
+import numpy as np
+
+from fluxgates.stats import segment_sum, segment_trapz
+
+
+def test_segment_sum_empty_segments():
+    a = np.array([1, 2, 3, 4, 5])
+    assert np.array_equal(segment_sum(a, np.array([0, 3, 5, 5])), [6, 9, 0])
+    # leading, interior and trailing empty segments
+    assert np.array_equal(segment_sum(a, np.array([0, 0, 2, 2, 5, 5, 5])), [0, 3, 0, 12, 0, 0])
+    assert np.array_equal(segment_sum(a, np.array([0, 0, 0])), [0, 0])
+    assert np.array_equal(segment_sum(np.zeros(0), np.array([0, 0])), [0])
+
+
+def test_segment_sum_leading_dimensions():
+    a = np.arange(10.0).reshape(2, 5)
+    sums = segment_sum(a, np.array([0, 0, 2, 2, 5, 5]))
+    assert np.array_equal(sums, [[0, 1, 0, 9, 0], [0, 11, 0, 24, 0]])
+
+
+def test_segment_trapz_empty_segments():
+    assert np.allclose(segment_trapz(np.ones(6), np.arange(6.0), np.array([0, 3, 6, 6])), [2, 2, 0])
+    offsets = np.array([0, 0, 3, 3, 6, 6])
+    assert np.allclose(segment_trapz(np.ones((2, 6)), np.arange(6.0), offsets), [[0, 2, 0, 2, 0]] * 2)
+    # a profile with a single point has no length
+    assert np.allclose(segment_trapz(np.ones(6), np.arange(6.0), np.array([0, 5, 6])), [4, 0])
@@ -1,19 +1,12 @@
 # Extract profiles from simulations
+# All files of a grid are sampled in one process, the interpolation weights
+# are calculated once and normal components are added while sampling
 
 cd ${tl_dir}/${nc_dir}
-for file in g${GRID}m_*; do
-    if [ "${overwrite}" == "1" ]; then
-        extract_profiles.py /Volumes/negis/data/data_sets/GreenlandFluxGates/${region}-flux-gates-${pgs}m.shp $file ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file
-        ncap2 -O -s "flux_normal=uflux*nx+vflux*ny; velsurf_normal=uvelsurf*nx+vvelsurf*ny" ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file  ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file
-        ncatted -a long_name,flux_normal,o,c,"flux normal to gate" -a standard_name,flux_normal,d,, -a long_name,velsurf_normal,o,c,"surface speed normal to gate" ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file
-    else
-        if [ -f "../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file" ]; then
-            echo "$file exists, skipping"
-        else
-            extract_profiles.py /Volumes/negis/data/data_sets/GreenlandFluxGates/${region}-flux-gates-${pgs}m.shp $file ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file
-            ncap2 -O -s "flux_normal=uflux*nx+vflux*ny; velsurf_normal=uvelsurf*nx+vvelsurf*ny" ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file  ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file
-            ncatted -a long_name,flux_normal,o,c,"flux normal to gate" -a standard_name,flux_normal,d,, -a long_name,velsurf_normal,o,c,"surface speed normal to gate" ../../$tl_dir/$pr_dir/profiles_${pgs}m_${region}_$file
-        fi
-    fi
-done
+if [ "${overwrite}" == "1" ]; then
+    overwrite_flag="--overwrite"
+else
+    overwrite_flag=""
+fi
+sample-profiles.py ${overwrite_flag} --o_dir ../../$tl_dir/$pr_dir --prefix profiles_${pgs}m_${region}_ /Volumes/negis/data/data_sets/GreenlandFluxGates/${region}-flux-gates-${pgs}m.shp g${GRID}m_*
 cd ../../
@@ -1,40 +1,220 @@
 #!/usr/bin/env python
+# Copyright (C) 2017-2020 Andy Aschwanden
 
+import itertools
+import multiprocessing as mp
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import numpy as np
 from netCDF4 import Dataset as NC
 
-# set up the option parser
-parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
-parser.description = "Add normal-to-profile velocities to profile file."
-parser.add_argument("FILE", nargs=1)
-options = parser.parse_args()
-
-infile = options.FILE[0]
-nc = NC(infile, "a")
-
-u = nc.variables["uvelsurf"]
-v = nc.variables["vvelsurf"]
-nx = nc.variables["nx"]
-ny = nc.variables["ny"]
-
-var = "velsurf_normal"
-if var not in nc.variables:
-    v_n = nc.createVariable(var, "d", dimensions=u.dimensions, fill_value=-2.0e9)
-else:
-    v_n = nc.variables[var]
-v_n[:] = u[:] * nx[:] + v[:] * ny[:]
-
-if ('uvelsurf_error') and ('vvelsurf_error') in nc.variables:
-    ex = nc.variables["uvelsurf_error"]
-    ey = nc.variables["vvelsurf_error"]
-
-    var = "velsurf_normal_error"
-    if var not in nc.variables:
-        e_n = nc.createVariable(var, "d", dimensions=u.dimensions, fill_value=-2.0e9)
+fill_value = -2.0e9
+
+
+def get_chunk_shape(var, target_size=2 ** 18):
+    """
+    Return the chunk shape of a (profile, [time,] nc) variable.
+
+    The on-disk chunking is used if var is chunked, so every chunk of the
+    input is read once and written as one chunk of the output. Otherwise
+    chunks hold whole profiles with all records, since profiles are read
+    gate by gate, with about target_size values per chunk.
+
+    Parameters
+    ----------
+    var: netCDF4.Variable
+    target_size: int, number of values per chunk of contiguous variables
+
+    Returns
+    -------
+    chunks: tuple of ints
+    """
+
+    try:
+        chunking = var.chunking()
+    except AttributeError:
+        chunking = "contiguous"
+    if chunking not in ("contiguous", None):
+        return tuple(chunking)
+    shape = var.shape
+    profile_size = max(int(np.prod([max(n, 1) for n in shape[1:]])), 1)
+    return (max(1, min(shape[0], target_size // profile_size)),) + tuple([max(n, 1) for n in shape[1:]])
+
+
+def iterate_chunks(shape, chunks):
+    """
+    Iterate over the chunks of an array
+
+    Parameters
+    ----------
+    shape: tuple of ints, shape of the array
+    chunks: tuple of ints, shape of a chunk
+
+    Returns
+    -------
+    generator of tuples of slices, one per chunk
+    """
+
+    ranges = [range(0, n, c) for n, c in zip(shape, chunks)]
+    for starts in itertools.product(*ranges):
+        yield tuple([slice(s, min(s + c, n)) for s, c, n in zip(starts, chunks, shape)])
+
+
+def get_normal_slices(index, dimensions):
+    """
+    Return the (profile, nc) slices of nx and ny and how to broadcast them
+
+    Parameters
+    ----------
+    index: tuple of slices of a (profile, [time,] nc) chunk
+    dimensions: tuple of dimension names of the variable
+
+    Returns
+    -------
+    slices: tuple of slices of nx and ny
+    expand: index to broadcast nx and ny to the chunk
+    """
+
+    slices = (index[0], index[-1])
+    if len(dimensions) == 3:
+        return slices, (slice(None), np.newaxis, slice(None))
+    return slices, (slice(None), slice(None))
+
+
+def create_output_variable(nc, name, like, chunks, long_name, compress=True):
+    """
+    Return a float32 output variable with the dimensions of like
+
+    An existing variable is reused.
+
+    Parameters
+    ----------
+    nc: netCDF4.Dataset open for writing
+    name: string, variable name
+    like: netCDF4.Variable, input variable
+    chunks: tuple of ints, chunk shape
+    long_name: string
+    compress: bool, deflate output, needs a netCDF-4 file
+    """
+
+    if name in nc.variables:
+        return nc.variables[name]
+    if compress:
+        var = nc.createVariable(
+            name,
+            "f4",
+            dimensions=like.dimensions,
+            fill_value=fill_value,
+            zlib=True,
+            complevel=4,
+            shuffle=True,
+            chunksizes=chunks,
+        )
     else:
-        e_n = nc.variables[var]
+        var = nc.createVariable(name, "f4", dimensions=like.dimensions, fill_value=fill_value)
+    if "units" in like.ncattrs():
+        var.units = like.units
+    var.long_name = long_name
+    return var
+
+
+def add_normal_velocity(infile, target_size=2 ** 18):
+    """
+    Add normal-to-profile velocities and their errors to a profile file.
+
+    Velocities are read and written chunk by chunk (see
+    get_chunk_shape), so memory use does not depend on the number of
+    profiles. The normal is a unit vector, errors of the components are
+    assumed independent and are propagated as
+
+      e_n = sqrt((e_x n_x)^2 + (e_y n_y)^2)
+
+    Parameters
+    ----------
+    infile: string, profile file with uvelsurf, vvelsurf, nx and ny
+    target_size: int, number of values per chunk of contiguous variables
+
+    Returns
+    -------
+    infile : string
+    """
+
+    nc = NC(infile, "a")
+    compress = nc.data_model in ("NETCDF4", "NETCDF4_CLASSIC")
+    if not compress:
+        print(("  {} is {}, not compressing output".format(infile, nc.data_model)))
+
+    u = nc.variables["uvelsurf"]
+    v = nc.variables["vvelsurf"]
+    nx = nc.variables["nx"]
+    ny = nc.variables["ny"]
+    chunks = get_chunk_shape(u, target_size)
+    has_error = "uvelsurf_error" in nc.variables and "vvelsurf_error" in nc.variables
+
+    v_n = create_output_variable(nc, "velsurf_normal", u, chunks, "surface speed normal to gate", compress)
+    if has_error:
+        ex = nc.variables["uvelsurf_error"]
+        ey = nc.variables["vvelsurf_error"]
+        e_n = create_output_variable(
+            nc, "velsurf_normal_error", ex, chunks, "error of surface speed normal to gate", compress
+        )
 
-    e_n[:] = ex[:] * nx[:] + ey[:] * ny[:]
+    if compress:
+        # every chunk is touched once, a cache of two chunks per variable suffices
+        cache_size = 2 * int(np.prod(chunks)) * 8
+        for var in [u, v, v_n] + ([ex, ey, e_n] if has_error else []):
+            var.set_var_chunk_cache(size=cache_size)
 
-nc.close()
+    for index in iterate_chunks(u.shape, chunks):
+        normal_index, expand = get_normal_slices(index, u.dimensions)
+        nx_c = nx[normal_index][expand]
+        ny_c = ny[normal_index][expand]
+        v_n[index] = u[index] * nx_c + v[index] * ny_c
+        if has_error:
+            e_n[index] = np.ma.sqrt((ex[index] * nx_c) ** 2 + (ey[index] * ny_c) ** 2)
+
+    nc.close()
+    return infile
+
+
+def _add_normal_velocity_task(task):
+    """
+    Add normal velocities to one file in a worker process
+    """
+
+    infile, target_size = task
+    return add_normal_velocity(infile, target_size)
+
+
+if __name__ == "__main__":
+
+    __spec__ = None
+
+    # set up the option parser
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.description = "Add normal-to-profile velocities to profile files."
+    parser.add_argument("FILE", nargs="+")
+    parser.add_argument("--n_procs", dest="n_procs", type=int, help="Number of files processed in parallel", default=1)
+    parser.add_argument(
+        "--chunk_size",
+        dest="chunk_size",
+        type=int,
+        help="Number of values per chunk if the velocities are not chunked on disk",
+        default=2 ** 18,
+    )
+    options = parser.parse_args()
+    infiles = options.FILE
+    n_procs = options.n_procs
+    chunk_size = options.chunk_size
+
+    tasks = [(infile, chunk_size) for infile in infiles]
+    if n_procs > 1:
+        pool = mp.Pool(processes=n_procs)
+        try:
+            for infile in pool.imap_unordered(_add_normal_velocity_task, tasks):
+                print(("  - added normal velocities to {}".format(infile)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            print(("  - added normal velocities to {}".format(_add_normal_velocity_task(task))))
@@ -1,15 +1,12 @@
 #!/usr/bin/env python
-# Copyright (C) 2017 Andy Aschwanden
+# Copyright (C) 2017-2020 Andy Aschwanden
 
 import os
-try:
-    import subprocess32 as sub
-except:
-    import subprocess as sub
+import multiprocessing as mp
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+import numpy as np
 import gdal
-from nco import Nco
-nco = Nco()
-from nco import custom as c
+from netCDF4 import Dataset as NC
 
 import logging
 import logging.handlers
@@ -35,36 +32,187 @@ fh.setFormatter(formatter)
 logger.addHandler(ch)
 logger.addHandler(fh)
 
-var_dict = {'vx': 'uvelsurf', 'vy': 'vvelsurf', 'ex': 'uvelsurf_error', 'ey': 'vvelsurf_error'}
-
-basedir = 'measures'
-basename = 'greenland_vel_mosaic250'
-version = 'v1'
-gdal_nc_options = gdal.TranslateOptions(format='netCDF')
-
-ifile = '.'.join(['_'.join([basename, version]), 'tif'])
-ofile_merged = '.'.join(['_'.join([basename, version]), 'nc'])
-ifile_wp = os.path.join(basedir, ifile)
-ofile_merged_wp = os.path.join(basedir, ofile_merged) 
-logger.info('Converting {} to {}'.format(ifile_wp, ofile_merged_wp))
-gdal.Translate(ofile_merged_wp, ifile_wp, options=gdal_nc_options)
-rDict = {'Band1': 'velsurf_mag'}
-opt = [c.Rename('variable', rDict)]
-nco.ncrename(input=ofile_merged_wp, options=opt)
-opt = [c.Atted(mode="o", att_name="proj4", var_name='global', value="+init=epsg:3413", stype='c'),
-        c.Atted(mode="o", att_name="units", var_name='velsurf_mag', value="m year-1")]
-nco.ncatted(input=ofile_merged_wp, options=opt)
-for mvar in ('vx', 'vy', 'ex', 'ey'):
-    ifile = '.'.join(['_'.join([basename, mvar, version]), 'tif'])
-    ofile = '.'.join(['_'.join([basename, mvar, version]), 'nc'])
-    ofile_wp = os.path.join(basedir, ofile)
-    ifile_wp = os.path.join(basedir, ifile)
-    gdal.Translate(ofile_wp, ifile_wp, options=gdal_nc_options)
-    rDict = {'Band1': var_dict[mvar]}
-    opt = [c.Rename('variable', rDict)]
-    nco.ncrename(input=ofile_wp, options=opt)
-    opt = [c.Atted(mode="o", att_name="units", var_name=var_dict[mvar], value="m year-1")]
-    nco.ncatted(input=ofile_wp, options=opt)
-    nco.ncks(input=ofile_wp, output=ofile_merged_wp, append=True)
-ncap2_str = 'velsurf_mag_error=sqrt(uvelsurf_error^2+vvelsurf_error^2); velsurf_normal_error=velsurf_mag_error;'
-nco.ncap2(input='-s "{}" {}'.format(ncap2_str, ofile_merged_wp), output=ofile_merged_wp, overwrite=True)
+var_dict = {'mag': 'velsurf_mag', 'vx': 'uvelsurf', 'vy': 'vvelsurf', 'ex': 'uvelsurf_error', 'ey': 'vvelsurf_error'}
+long_name_dict = {
+    'velsurf_mag': 'magnitude of surface velocity',
+    'uvelsurf': 'x-component of surface velocity',
+    'vvelsurf': 'y-component of surface velocity',
+    'uvelsurf_error': 'error of x-component of surface velocity',
+    'vvelsurf_error': 'error of y-component of surface velocity',
+    'velsurf_mag_error': 'error of magnitude of surface velocity',
+    'velsurf_normal_error': 'error of surface velocity normal to flux gates',
+}
+fill_value = -2.0e9
+
+
+def get_mosaic_files(basedir, basename, version):
+    """
+    Return the GeoTIFFs of a mosaic version and the merged netCDF file
+
+    Returns
+    -------
+    ifiles: dict of GeoTIFF names, keys as in var_dict
+    ofile: string
+    """
+
+    ifiles = {'mag': os.path.join(basedir, '.'.join(['_'.join([basename, version]), 'tif']))}
+    for mvar in ('vx', 'vy', 'ex', 'ey'):
+        ifiles[mvar] = os.path.join(basedir, '.'.join(['_'.join([basename, mvar, version]), 'tif']))
+    ofile = os.path.join(basedir, '.'.join(['_'.join([basename, version]), 'nc']))
+    return ifiles, ofile
+
+
+def create_mosaic_file(ofile, ds, chunks):
+    """
+    Create the merged netCDF file with the grid of a GeoTIFF
+
+    Rows are stored south to north, like files written by gdal.Translate.
+
+    Parameters
+    ----------
+    ofile: string
+    ds: gdal.Dataset of the velocity magnitude
+    chunks: tuple of ints, (y, x) chunk shape
+
+    Returns
+    -------
+    nc : netCDF4.Dataset open for writing
+    """
+
+    n_rows, n_cols = ds.RasterYSize, ds.RasterXSize
+    x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+    nc = NC(ofile, 'w', format='NETCDF4')
+    nc.createDimension('x', n_cols)
+    nc.createDimension('y', n_rows)
+    var = nc.createVariable('x', 'f8', ('x',))
+    var.units = 'm'
+    var.standard_name = 'projection_x_coordinate'
+    var[:] = x0 + (np.arange(n_cols) + 0.5) * dx
+    var = nc.createVariable('y', 'f8', ('y',))
+    var.units = 'm'
+    var.standard_name = 'projection_y_coordinate'
+    var[:] = (y0 + (np.arange(n_rows) + 0.5) * dy)[::-1]
+    mapping = nc.createVariable('mapping', 'b')
+    mapping.spatial_ref = ds.GetProjection()
+    nc.proj4 = '+init=epsg:3413'
+    for name in list(var_dict.values()) + ['velsurf_mag_error', 'velsurf_normal_error']:
+        var = nc.createVariable(
+            name, 'f4', ('y', 'x'), fill_value=fill_value, zlib=True, complevel=4, shuffle=True, chunksizes=chunks
+        )
+        var.units = 'm year-1'
+        var.long_name = long_name_dict[name]
+        var.grid_mapping = 'mapping'
+    return nc
+
+
+def read_rows(band, row, n_rows):
+    """
+    Read rows of a band as masked array, flipped south to north
+
+    Parameters
+    ----------
+    band: gdal.Band
+    row: int, first row, counted from the north
+    n_rows: int, number of rows
+    """
+
+    values = band.ReadAsArray(0, row, band.XSize, n_rows).astype('float32')
+    nodata = band.GetNoDataValue()
+    if nodata is None:
+        values = np.ma.masked_invalid(values)
+    else:
+        values = np.ma.masked_where((values == nodata) | ~np.isfinite(values), values)
+    return values[::-1]
+
+
+def prepare_mosaic(basedir, basename, version, block_rows=1024, chunk_size=256):
+    """
+    Merge the GeoTIFFs of a MEaSUREs mosaic into one netCDF file.
+
+    All bands are read block by block and written once; the errors of
+    the magnitude and of normal components are calculated on the fly as
+
+      e = sqrt(e_x^2 + e_y^2)
+
+    Parameters
+    ----------
+    basedir: string, directory of GeoTIFFs and output
+    basename: string, e.g. greenland_vel_mosaic250
+    version: string, e.g. v1
+    block_rows: int, number of rows read at a time, rounded to chunk_size
+    chunk_size: int, chunk size of the output in x and y
+
+    Returns
+    -------
+    ofile : string
+    """
+
+    ifiles, ofile = get_mosaic_files(basedir, basename, version)
+    datasets = {}
+    for mvar, ifile in list(ifiles.items()):
+        logger.info('Reading {}'.format(ifile))
+        datasets[mvar] = gdal.Open(ifile)
+        if datasets[mvar] is None:
+            raise IOError('could not open {}'.format(ifile))
+    ds = datasets['mag']
+    n_rows, n_cols = ds.RasterYSize, ds.RasterXSize
+    for mvar, mds in list(datasets.items()):
+        if (mds.RasterYSize, mds.RasterXSize) != (n_rows, n_cols):
+            raise ValueError('{} and {} differ in size'.format(ifiles[mvar], ifiles['mag']))
+    chunks = (min(chunk_size, n_rows), min(chunk_size, n_cols))
+    block_rows = max(chunks[0], (block_rows // chunks[0]) * chunks[0])
+
+    tmp_ofile = '.'.join([ofile, str(os.getpid()), 'tmp'])
+    logger.info('Writing {}'.format(ofile))
+    nc = create_mosaic_file(tmp_ofile, ds, chunks)
+    bands = dict((mvar, mds.GetRasterBand(1)) for mvar, mds in list(datasets.items()))
+    # Output blocks start at the southern edge, so they are aligned with chunks
+    for start in range(0, n_rows, block_rows):
+        end = min(start + block_rows, n_rows)
+        block = dict((mvar, read_rows(band, n_rows - end, end - start)) for mvar, band in list(bands.items()))
+        for mvar, values in list(block.items()):
+            nc.variables[var_dict[mvar]][start:end, :] = values
+        error = np.ma.sqrt(block['ex'] ** 2 + block['ey'] ** 2)
+        nc.variables['velsurf_mag_error'][start:end, :] = error
+        nc.variables['velsurf_normal_error'][start:end, :] = error
+    nc.close()
+    os.rename(tmp_ofile, ofile)
+    return ofile
+
+
+def _prepare_mosaic_task(task):
+    """
+    Prepare one mosaic version in a worker process
+    """
+
+    return prepare_mosaic(*task)
+
+
+if __name__ == "__main__":
+
+    __spec__ = None
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.description = "Merge MEaSUREs velocity mosaics (GeoTIFFs of magnitude, components and errors) into netCDF files."
+    parser.add_argument("VERSION", nargs="*", help="Mosaic versions", default=["v1"])
+    parser.add_argument("--basedir", dest="basedir", help="Directory of the GeoTIFFs", default="measures")
+    parser.add_argument("--basename", dest="basename", help="Base name of the GeoTIFFs", default="greenland_vel_mosaic250")
+    parser.add_argument("--block_rows", dest="block_rows", type=int, help="Number of rows read at a time", default=1024)
+    parser.add_argument("--chunk_size", dest="chunk_size", type=int, help="Chunk size of the output in x and y", default=256)
+    parser.add_argument("--n_procs", dest="n_procs", type=int, help="Number of versions prepared in parallel", default=1)
+    options = parser.parse_args()
+
+    tasks = [
+        (options.basedir, options.basename, version, options.block_rows, options.chunk_size) for version in options.VERSION
+    ]
+    if options.n_procs > 1:
+        pool = mp.Pool(processes=options.n_procs)
+        try:
+            for ofile in pool.imap_unordered(_prepare_mosaic_task, tasks):
+                logger.info('Finished {}'.format(ofile))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            logger.info('Finished {}'.format(_prepare_mosaic_task(task)))